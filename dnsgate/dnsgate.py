@@ -12,7 +12,6 @@
 __version__ = "0.0.1"
 
 import click
-import copy
 import time
 import glob
 import hashlib
@@ -20,13 +19,36 @@ import sys
 import os
 import ast
 import shutil
-import requests
-import tldextract
-import pprint
+import urllib.parse
 import configparser
+import json
+import pickle
+import collections
+import array
+import heapq
+import itertools
+import signal
+import struct
+import io
+import zlib
+import select
+import mmap
+import fcntl
+import contextlib
 from shutil import copyfileobj
 import logging
 import string
+import re
+import threading
+import atexit
+from concurrent.futures import Future, as_completed, wait
+from concurrent.futures import TimeoutError as FuturesTimeoutError
+
+# imported by the functions that need them, commands that need neither the
+# network nor the PSL start without them (tests/test_startup.py, and
+# dev/benchmark --startup, check this)
+DEFERRED_MODULES = ['requests', 'tldextract', 'asyncio', 'multiprocessing',
+    'ctypes', 'lzma', 'zipfile', 'cProfile', 'socket']
 
 class logmaker():
     def __init__(self, output_format, name, level):
@@ -63,6 +85,60 @@ class Dnsgate_Config():
         self.sources = sources
         self.output = output
 
+class Run_Metrics():
+    '''
+    Wall clock time per generate stage plus per source and global counters,
+    see --metrics-json. stage(name) ends the running stage and starts name.
+    '''
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.started = time.time()
+        self.stages = collections.OrderedDict()
+        self.sources = collections.OrderedDict()
+        self.counters = collections.OrderedDict()
+        self.current_stage = None
+        self.stage_started = None
+        self.lock = threading.Lock()
+
+    def stage(self, name):
+        now = time.time()
+        if self.current_stage is not None:
+            self.stages[self.current_stage] = \
+                self.stages.get(self.current_stage, 0) + now - self.stage_started
+        self.current_stage = name
+        self.stage_started = now
+
+    def finish(self):
+        self.stage(None)
+
+    def source(self, url, **values):
+        with self.lock: # updated from the fetch threads
+            self.sources.setdefault(url, collections.OrderedDict()).update(values)
+
+    def count(self, name, value):
+        self.counters[name] = value
+
+    def source_total(self, name):
+        with self.lock:
+            return sum(values.get(name, 0) for values in self.sources.values())
+
+    def as_dict(self):
+        return collections.OrderedDict([
+            ('started', self.started),
+            ('total_seconds', sum(self.stages.values())),
+            ('stages', self.stages),
+            ('sources', self.sources),
+            ('counters', self.counters)])
+
+    def write_json(self, path):
+        with open(path, 'w') as fh:
+            json.dump(self.as_dict(), fh, indent=2)
+            fh.write('\n')
+
+METRICS = Run_Metrics()
+
 def set_verbose(ctx, param, verbose=False):
     if verbose:
         logger_quiet.logger.setLevel(LOG['DEBUG'])
@@ -77,6 +153,11 @@ CUSTOM_WHITELIST         = CONFIG_DIRECTORY + '/whitelist'
 OUTPUT_FILE_PATH         = CONFIG_DIRECTORY + '/' + OUTPUT_FILE_PATH_NAME
 CACHE_DIRECTORY          = CONFIG_DIRECTORY + '/cache'
 TLDEXTRACT_CACHE         = CACHE_DIRECTORY + '/tldextract_cache'
+PSL_CACHE                = CACHE_DIRECTORY + '/psl_cache'
+RULE_STATE               = CACHE_DIRECTORY + '/rule_state'
+RULE_INDEX               = CACHE_DIRECTORY + '/rule_index'
+PULL_DIRECTORY           = CACHE_DIRECTORY + '/pulled'
+SOURCE_CACHE_DIRECTORY   = CACHE_DIRECTORY + '/sources'
 
 DNSMASQ_CONFIG_INCLUDE_DIRECTORY = '/etc/dnsmasq.d'
 DNSMASQ_CONFIG_FILE      = '/etc/dnsmasq.conf'
@@ -96,7 +177,68 @@ ALL_REMOTE_BLACKLISTS = [
     # http://hosts-file.net/?s=Download
 
 CACHE_EXPIRE = 3600 * 24 * 2 # 48 hours
-TLD_EXTRACT = tldextract.TLDExtract(cache_file=TLDEXTRACT_CACHE)
+SOURCE_MAX_STALE = 3600 * 24 * 7 # cached copies used when their source cannot be fetched
+PARSED_CACHE_VERSION = b'2' # bump when parsing or validation changes
+SOURCE_CACHE_FORMAT = 1 # bump when the index or entry layout changes
+SOURCE_CACHE_MAX_BYTES = 256 * 1024 * 1024 # on disk, least recently used go first
+SOURCE_CACHE_MAX_AGE = 3600 * 24 * 30 # entries not fetched or revalidated since are dropped
+SOURCE_CACHE_COMPRESS_LEVEL = 1 # cheap enough to run inline with the download
+SOURCE_CACHE_TMP_AGE = 3600 # seconds before a leftover temporary file is removed
+# hosts format: "0.0.0.0 dom.com # comment", the second field is the DNS name
+HOSTS_LINE_REGEX = re.compile(rb'^[ \t\r\f\v]*[^\s#]+[ \t\r\f\v]+([^\s#]+)', re.M)
+# RFC 1123 labels, plus _ which blacklists (and dnsmasq) use, the TLD is not all digits
+DOMAIN_LABEL_PATTERN = rb'(?!-)[a-z0-9_-]{1,63}(?<!-)'
+DOMAIN_NAME_REGEX = re.compile(rb'(?:' + DOMAIN_LABEL_PATTERN + rb'\.)*(?![0-9]+\Z)' +
+    DOMAIN_LABEL_PATTERN)
+DOMAIN_NAME_MAX_LENGTH = 253
+NON_ASCII_REGEX = re.compile(rb'[^\x00-\x7f]')
+IDNA_CACHE_SIZE = 100000 # non-ASCII names kept normalized
+FETCH_WORKERS = 8
+FETCH_PER_HOST = 2
+FETCH_DEADLINE = 120 # seconds for all sources combined
+FETCH_TIMEOUT = 15.5 # seconds to connect, and between reads
+FETCH_RETRIES = 2 # per source, on connection errors and FETCH_RETRY_STATUSES
+FETCH_RETRY_BACKOFF = 0.5 # seconds, urllib3 doubles it on each further retry
+FETCH_RETRY_STATUSES = (429, 500, 502, 503, 504)
+FETCH_USER_AGENT = 'Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:24.0) Gecko/20100101 Firefox/24.0'
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+READ_CHUNK_SIZE = 256 * 1024 # files are read, and cached copies decompressed, this much at a time
+SOURCE_MAX_BYTES = 512 * 1024 * 1024 # decompressed, larger sources are skipped
+PARALLEL_MIN_BYTES = 1024 * 1024 # smaller sources are parsed in-process with --jobs
+PARALLEL_MIN_DOMAINS = 20000 # fewer psl lookups are done in-process with --jobs
+PARALLEL_CHUNK_BYTES = 512 * 1024 # per worker task
+PARALLEL_MAX_PENDING = 16 # worker tasks queued per source before waiting on the oldest
+PARALLEL_CHUNK_DOMAINS = 10000 # psl lookups per worker task
+OUTPUT_CHUNK_SIZE = 1024 * 1024 # bytes per write()
+RPZ_TTL = 60
+HOSTS_DEST_IP = b'0.0.0.0' # hosts mode without a configured dest_ip
+PROXY_LISTEN = '127.0.0.1'
+PROXY_PORT = 53
+PROXY_UPSTREAM = '8.8.8.8'
+PROXY_CACHE_SIZE = 10000 # responses
+PROXY_MAX_TTL = 3600
+PROXY_NEGATIVE_TTL = 60 # NXDOMAIN/NODATA without an SOA to take it from
+PROXY_BLOCKED_TTL = 60
+PROXY_TIMEOUT = 3.0
+PROXY_EDNS_SIZE = 1232 # UDP payload size advertised to EDNS clients on cached answers
+WATCH_POLL_INTERVAL = 1.0 # seconds between stat() calls without inotify
+WATCH_SETTLE = 0.05 # seconds to let an editor finish writing
+TLD_EXTRACT = None # see get_tld_extract()
+PSL_CACHE_SIZE = 2000000 # hostnames kept in memory
+PSL_CACHE_FORMAT = '3' # bump when lookup_psl_domain() changes
+RULE_STATE_FORMAT = '2' # bump when Rule_State or apply_local_rules() changes
+RULE_INDEX_MAGIC = b'dgindex\n'
+RULE_INDEX_PREFIX = struct.Struct('<8sQQ') # magic, header offset, header size
+RULE_INDEX_FORMAT = 1 # bump when the tables or the header change
+PUBLISH_FORMAT = 1 # bump when the manifest, rules or delta files change
+PUBLISH_MANIFEST = 'latest.json'
+PUBLISH_KEEP_VERSIONS = 5 # earlier versions a delta is published from
+PUBLISH_COMPRESS_LEVEL = 9 # written once, downloaded by every host
+PUBLISH_FILE_REGEX = re.compile(r'(?:rules-([0-9]+)|delta-([0-9]+)-([0-9]+))\.gz')
+# what pull reads from the manifest and each of its deltas, and their types
+PUBLISH_MANIFEST_KEYS = {'version': int, 'file': str, 'sha1': str, 'mode': str,
+    'covers_subdomains': bool, 'deltas': dict}
+PUBLISH_DELTA_KEYS = {'file': str}
 
 def eprint(*args, level, **kwargs):
     if level == LOG['INFO']:
@@ -112,7 +254,8 @@ def make_custom_blacklist_header(path):
 #
 # Examples:
 # google.com    # blocks *.google.com
-# biz           # blocks the TLD biz completely (*.biz)'''
+# biz           # blocks the TLD biz completely (*.biz)
+'''
     return output_file_header
 
 def make_custom_whitelist_header(path):
@@ -128,10 +271,13 @@ def make_custom_whitelist_header(path):
 #                           "dnsmasq generate [sources]" it's still blocked
 #                           unless explicitely whitelisted here.
 # lwn.net             # allows lwn.net
-#                           as above, explicitely blacklisted subdomains are blocked'''
+#                           as above, explicitely blacklisted subdomains are blocked
+'''
     return output_file_header
 
-def make_output_file_header(config_dict):
+OUTPUT_DIGEST_PREFIX = b'# content_sha1: '
+
+def make_output_file_header(config_dict, content_digest, comment=b'#'):
     configuration_string = '\n'.join(['#    ' + str(key) + ': ' +
         str(config_dict[key]) for key in sorted(config_dict.keys())])
     output_file_header = '#' * 64 + '''\n#
@@ -140,8 +286,30 @@ def make_output_file_header(config_dict):
 # EDIT ''' + CUSTOM_BLACKLIST + ' or ' + \
         CUSTOM_WHITELIST + ' instead.\n#\n' + \
         '\n#' + '\n# Configuration:\n' + configuration_string + \
+        '\n#\n' + OUTPUT_DIGEST_PREFIX.decode('utf8') + content_digest + \
         '\n#\n' + '#' * 64 + '\n\n'
-    return output_file_header.encode('utf8')
+    output_file_header = output_file_header.encode('utf8')
+    if comment != b'#': # zone files use ;
+        output_file_header = b'\n'.join([comment + line[1:] if line.startswith(b'#')
+            else line for line in output_file_header.split(b'\n')])
+    return output_file_header
+
+def read_output_file_digest(path):
+    '''
+    Return the content digest recorded in the header of a previously
+    generated output file, or None.
+    '''
+    try:
+        with open(path, 'rb') as fh:
+            for line in fh:
+                if line[:1] in (b'#', b';'):
+                    if line[1:].startswith(OUTPUT_DIGEST_PREFIX[1:]):
+                        return line[len(OUTPUT_DIGEST_PREFIX):].strip().decode('ascii')
+                elif line.strip(): # past the header
+                    return None
+    except FileNotFoundError:
+        pass
+    return None
 
 def contains_whitespace(s):
     return True in [c in s for c in string.whitespace]
@@ -161,14 +329,7 @@ def hash_str(string):
 
 def remove_comments_from_bytes(line):
     assert isinstance(line, bytes)
-    uncommented_line = b''
-    for char in line:
-        char = bytes([char])
-        if char != b'#':
-            uncommented_line += char
-        else:
-            break
-    return uncommented_line
+    return line.partition(b'#')[0]
 
 def comment_out_line_in_file(fh, line_to_match):
     '''
@@ -249,39 +410,343 @@ def uncomment_line_in_file(fh, line_to_match):
         return True
     return False
 
+def domain_to_store_key(domain):
+    labels = domain.split(b'.')
+    labels.reverse()
+    return b'\x00'.join(labels)
+
+def store_key_to_domain(key):
+    labels = key.split(b'\x00')
+    labels.reverse()
+    return b'.'.join(labels)
+
+class Domain_Store():
+    '''
+    Immutable sorted set of domains packed into a single bytes buffer.
+
+    Each domain is kept with its labels reversed and NUL separated
+    (www.google.com -> com\\x00google\\x00www), so the sorted keys are grouped
+    by TLD and every subdomain sorts directly after its parent domain.
+    Key i is buffer[offsets[i]:offsets[i + 1]].
+    '''
+    def __init__(self, domains=()):
+        if isinstance(domains, Domain_Store):
+            self.buffer = domains.buffer
+            self.offsets = domains.offsets
+        else:
+            self._pack(sorted(set(map(domain_to_store_key, domains))))
+
+    @classmethod
+    def from_sorted_keys(cls, keys):
+        store = cls.__new__(cls)
+        store._pack(keys)
+        return store
+
+    @classmethod
+    def from_packed(cls, buffer, offsets):
+        store = cls.__new__(cls)
+        store.buffer = buffer
+        store.offsets = offsets
+        return store
+
+    def _pack(self, keys):
+        buffer = bytearray()
+        offsets = array.array('I', [0]) # caps the buffer at 4GB
+        for key in keys:
+            buffer += key
+            offsets.append(len(buffer))
+        self.buffer = bytes(buffer)
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def key(self, index):
+        return self.buffer[self.offsets[index]:self.offsets[index + 1]]
+
+    def keys(self):
+        buffer = self.buffer
+        offsets = self.offsets
+        for index in range(len(offsets) - 1):
+            yield buffer[offsets[index]:offsets[index + 1]]
+
+    def __iter__(self):
+        for key in self.keys():
+            yield store_key_to_domain(key)
+
+    def _bisect(self, key):
+        low, high = 0, len(self)
+        while low < high:
+            middle = (low + high) // 2
+            if self.key(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def __contains__(self, domain):
+        key = domain_to_store_key(domain)
+        index = self._bisect(key)
+        return index < len(self) and self.key(index) == key
+
+    def union(self, other):
+        if not isinstance(other, Domain_Store):
+            other = Domain_Store(other)
+
+        def merged_keys():
+            previous = None
+            for key in heapq.merge(self.keys(), other.keys()):
+                if key != previous:
+                    yield key
+                    previous = key
+
+        return Domain_Store.from_sorted_keys(merged_keys())
+
+    def difference(self, other):
+        if not isinstance(other, Domain_Store):
+            other = Domain_Store(other)
+
+        def remaining_keys():
+            other_keys = other.keys()
+            other_key = next(other_keys, None)
+            for key in self.keys():
+                while other_key is not None and other_key < key:
+                    other_key = next(other_keys, None)
+                if key != other_key:
+                    yield key
+
+        return Domain_Store.from_sorted_keys(remaining_keys())
+
+    __or__ = union
+    __sub__ = difference
+
+    def covering_rule(self, domain):
+        '''
+        Return the shortest domain in the store that is domain or one of its
+        parent domains, or None.
+        '''
+        labels = domain.split(b'.')
+        for index in range(len(labels) - 1, -1, -1):
+            candidate = b'.'.join(labels[index:])
+            if candidate in self:
+                return candidate
+        return None
+
+    def covers(self, domain):
+        return self.covering_rule(domain) is not None
+
+    def without_redundant_rules(self):
+        '''
+        Returns the store without the domains whose parent domain is also in
+        it, in one sweep over the sorted keys.
+        '''
+        def minimal_keys():
+            cover = None
+            for key in self.keys():
+                if cover is None or not key.startswith(cover):
+                    cover = key + b'\x00'
+                    yield key
+
+        return Domain_Store.from_sorted_keys(minimal_keys())
+
+    def subtree_range(self, domain):
+        '''
+        Return (start, end), the indexes of domain and all of its subdomains.
+        They are contiguous since every subdomain key is the parent key + NUL.
+        '''
+        key = domain_to_store_key(domain)
+        return self._bisect(key), self._bisect(key + b'\x01')
+
+    def subtree(self, domain):
+        start, end = self.subtree_range(domain)
+        head = self.offsets[start]
+        return Domain_Store.from_packed(self.buffer[head:self.offsets[end]],
+            array.array('I', (offset - head for offset in self.offsets[start:end + 1])))
+
+    def replace_subtree(self, domain, other):
+        '''
+        Return a new store with domain and its subdomains replaced by the
+        domains in other, which must all be domain or its subdomains.
+        '''
+        if not isinstance(other, Domain_Store):
+            other = Domain_Store(other)
+        start, end = self.subtree_range(domain)
+        head = self.offsets[start]
+        tail = self.offsets[end]
+        shift = head + len(other.buffer) - tail
+        offsets = self.offsets[:start]
+        offsets.extend(head + offset for offset in other.offsets)
+        offsets.extend(offset + shift for offset in self.offsets[end + 1:])
+        return Domain_Store.from_packed(
+            self.buffer[:head] + other.buffer + self.buffer[tail:], offsets)
+
 def group_by_tld(domains):
     eprint('Sorting domains by their subdomain and grouping by TLD.',
         level=LOG['INFO'])
-    sorted_output = []
-    reversed_domains = []
-    for domain in domains:
-        rev_domain = domain.split(b'.')
-        rev_domain.reverse()
-        reversed_domains.append(rev_domain)
-    reversed_domains.sort() # sorting a list of lists by the tld
-    for rev_domain in reversed_domains:
-        rev_domain.reverse()
-        sorted_output.append(b'.'.join(rev_domain))
-    return sorted_output
+    return list(Domain_Store(domains))
 
-def extract_psl_domain(domain):
-    dom = TLD_EXTRACT(domain.decode('utf-8'))
-    dom = dom.domain + '.' + dom.suffix
+class Psl_Cache():
+    '''
+    Memoizes hostname -> psl domain lookups so each hostname goes through
+    tldextract at most once per run. Least recently used entries are
+    evicted past max_size. save()/load() persist it tagged with the public
+    suffix list version, a cache written against another list is ignored.
+    '''
+    def __init__(self, max_size=PSL_CACHE_SIZE):
+        self.max_size = max_size
+        self.domains = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.domains)
+
+    def get(self, domain):
+        domain_psl = self.domains.get(domain)
+        if domain_psl is None:
+            self.misses += 1
+            domain_psl = lookup_psl_domain(domain)
+            self.domains[domain] = domain_psl
+            if len(self.domains) > self.max_size:
+                self.domains.popitem(last=False)
+        else:
+            self.hits += 1
+            self.domains.move_to_end(domain)
+        return domain_psl
+
+    def put(self, domain, domain_psl):
+        '''
+        Store a lookup resolved elsewhere (a worker process).
+        '''
+        self.misses += 1
+        self.domains[domain] = domain_psl
+        if len(self.domains) > self.max_size:
+            self.domains.popitem(last=False)
+
+    def __contains__(self, domain):
+        return domain in self.domains
+
+    def load(self, path, version):
+        try:
+            with open(path, 'rb') as fh:
+                saved = pickle.load(fh)
+        except FileNotFoundError:
+            return False
+        except Exception as e:
+            eprint("WARNING: ignoring unreadable PSL cache %s: %s", path, e,
+                level=LOG['WARNING'])
+            return False
+        if saved.get('version') != version:
+            eprint("Public suffix list changed, discarding %s", path,
+                level=LOG['INFO'])
+            return False
+        self.domains.update(saved['domains'])
+        while len(self.domains) > self.max_size:
+            self.domains.popitem(last=False)
+        eprint("Loaded %d PSL lookups from %s", len(self.domains), path,
+            level=LOG['DEBUG'])
+        return True
+
+    def save(self, path, version):
+        saved = {'version': version, 'domains': self.domains}
+        write_file_bytes_atomic(path,
+            pickle.dumps(saved, protocol=pickle.HIGHEST_PROTOCOL))
+
+def get_tld_extract():
+    '''
+    tldextract (and requests, which it imports) is only loaded by the
+    commands that need psl domains.
+    '''
+    global TLD_EXTRACT
+    if TLD_EXTRACT is None:
+        import tldextract
+        TLD_EXTRACT = tldextract.TLDExtract(cache_file=TLDEXTRACT_CACHE)
+    return TLD_EXTRACT
+
+def get_psl_version():
+    suffixes = '\n'.join(sorted(get_tld_extract().tlds))
+    return hash_str(PSL_CACHE_FORMAT + '\n' + suffixes)
+
+def lookup_psl_domain(domain):
+    '''
+    Returns the psl domain of domain, or b'' if domain is a public suffix
+    itself (co.uk) and so has none.
+    '''
+    dom = (TLD_EXTRACT or get_tld_extract())(domain.decode('utf-8'))
+    if not dom.domain:
+        return b''
+    # names without a public suffix (localhost) are their own psl domain
+    dom = '.'.join([part for part in (dom.domain, dom.suffix) if part])
     return dom.encode('utf-8')
 
-def strip_to_psl(domains):
+PSL_DOMAINS = Psl_Cache()
+
+def extract_psl_domain(domain):
+    return PSL_DOMAINS.get(domain)
+
+def group_by_psl_domain(domains, pool=None):
+    '''
+    Returns a dict of psl domain -> list of the domains it was extracted
+    from, one psl lookup per domain.
+    '''
+    eprint('Grouping %d domains by psl domain.', len(domains), level=LOG['INFO'])
+    if pool is not None:
+        resolve_psl_domains(domains, pool)
+    groups = collections.defaultdict(list)
+    for domain in domains:
+        groups[extract_psl_domain(domain)].append(domain)
+    return groups
+
+def block_psl_groups(psl_groups, domains_whitelist):
     '''This causes ad-serving domains to be blocked at their root domain.
     Otherwise the subdomain can be changed until the --url lists are updated.
     It does not make sense to use this flag if you are generating a /etc/hosts
     format file since the effect would be to block google.com and not
-    *.google.com.'''
-    eprint('Removing subdomains on %d domains.', len(domains),
-        level=LOG['INFO'])
-    domains_stripped = set()
-    for line in domains:
-        line = extract_psl_domain(line)
-        domains_stripped.add(line)
-    return domains_stripped
+    *.google.com.
+
+    Returns the psl domains of psl_groups, except those that are, or are
+    the psl domain of, a whitelisted domain. The members of those groups
+    that are not whitelisted are returned instead. Public suffixes listed
+    by a source (the b'' group) are dropped, they would block every name
+    registered under them.'''
+    unblocked_psl_domains = set(domains_whitelist)
+    unblocked_psl_domains.update(map(extract_psl_domain, domains_whitelist))
+    domains_blocked = set()
+    for domain_psl, members in psl_groups.items():
+        if not domain_psl:
+            eprint("Skipping public suffixes: %s", b' '.join(members), level=LOG['DEBUG'])
+        elif domain_psl not in unblocked_psl_domains:
+            domains_blocked.add(domain_psl)
+        else:
+            eprint("Re-adding the subdomains of: %s", domain_psl, level=LOG['DEBUG'])
+            domains_blocked.update(member for member in members
+                if member not in domains_whitelist)
+    return domains_blocked
+
+def lookup_psl_domains_chunk(joined_domains):
+    '''
+    Process pool worker, newline joined domains in, their psl domains out
+    in the same order.
+    '''
+    return b'\n'.join(map(lookup_psl_domain, joined_domains.split(b'\n')))
+
+def resolve_psl_domains(domains, pool):
+    '''
+    Look up the psl domains PSL_DOMAINS does not hold yet in pool and store
+    them there, so the extract_psl_domain() calls that follow are all hits.
+    '''
+    missing = [domain for domain in domains if domain not in PSL_DOMAINS]
+    if len(missing) < PARALLEL_MIN_DOMAINS:
+        return
+    chunks = [missing[start:start + PARALLEL_CHUNK_DOMAINS]
+        for start in range(0, len(missing), PARALLEL_CHUNK_DOMAINS)]
+    eprint('Looking up %d psl domains in %d chunks.', len(missing), len(chunks),
+        level=LOG['DEBUG'])
+    results = pool.map(lookup_psl_domains_chunk,
+        (b'\n'.join(chunk) for chunk in chunks))
+    for chunk, joined_psls in zip(chunks, results):
+        for domain, domain_psl in zip(chunk, joined_psls.split(b'\n')):
+            PSL_DOMAINS.put(domain, domain_psl)
 
 def write_unique_line(line, file_to_write):
     '''
@@ -297,10 +762,10 @@ def write_unique_line(line, file_to_write):
 
 def backup_file_if_exists(file_to_backup):
     timestamp = str(time.time())
-    dest_file = file_to_backup.name + '.bak.' + timestamp
+    dest_file = file_to_backup + '.bak.' + timestamp
     try:
-        with open(file_to_backup.name, 'r') as sf:
-            with open(dest_file, 'x') as df:
+        with open(file_to_backup, 'rb') as sf:
+            with open(dest_file, 'xb') as df:
                 copyfileobj(sf, df)
     except FileNotFoundError:
         pass    # skip backup if file does not exist
@@ -326,25 +791,58 @@ def valid_name(domain):
 
     # Host software MUST handle host names of up to 63 characters and
     # SHOULD handle host names of up to 255 characters.
-    pass
 
+    # domain is lowercase ASCII bytes, 255 octets on the wire is 253 here
+    return len(domain) <= DOMAIN_NAME_MAX_LENGTH and \
+        DOMAIN_NAME_REGEX.fullmatch(domain) is not None
+
+IDNA_NAMES = {}
 
-def validate_domain_list(domains):
+def normalize_domain(domain):
+    '''
+    Returns domain lowercased, IDNA encoded if it is not ASCII, or None if
+    it is not a valid name. Only non-ASCII names go through the IDNA codec,
+    they are remembered in IDNA_NAMES.
+    '''
+    lowered = domain.lower()
+    if valid_name(lowered):
+        return lowered
+    if not NON_ASCII_REGEX.search(domain):
+        return None
+    try:
+        return IDNA_NAMES[domain]
+    except KeyError:
+        pass
+    try:
+        normalized = lowered.decode('utf-8').encode('idna')
+    except UnicodeError:
+        normalized = None
+    if normalized is not None and not valid_name(normalized):
+        normalized = None
+    if len(IDNA_NAMES) >= IDNA_CACHE_SIZE:
+        IDNA_NAMES.clear()
+    IDNA_NAMES[domain] = normalized
+    return normalized
+
+
+def validate_domain_list(domains, invalid_level=LOG['WARNING']):
+    '''
+    Returns the set of normalized valid domains, invalid ones are logged at
+    invalid_level (remote sources are full of them, local lists are not).
+    '''
     eprint('Validating %d domains.', len(domains), level=LOG['DEBUG'])
-    valid_domains = set([])
-    for hostname in domains:
-        try:
-            hostname = hostname.lower()
-            hostname = hostname.decode('utf-8')
-            hostname = hostname.encode('idna').decode('ascii')
-            valid_domains.add(hostname.encode('utf-8'))
-        except Exception as e:
-            eprint("WARNING: %s is not a valid domain. Skipping", hostname,
-                level=LOG['WARNING'])
+    normalized = list(map(normalize_domain, domains)) # in the order domains iterates
+    valid_domains = set(normalized)
+    if None in valid_domains: # hosts files nearly always list 0.0.0.0 or localhost
+        valid_domains.remove(None)
+        for hostname, domain in zip(domains, normalized):
+            if domain is None:
+                eprint("WARNING: %s is not a valid domain. Skipping",
+                    hostname.decode('utf-8', 'replace'), level=invalid_level)
     return valid_domains
 
 def extract_domain_from_iri(iri):
-    iri_urlparsed  = requests.utils.urlparse(iri)   # https://hg.python.org/cpython/file/tip/Lib/urllib/parse.py
+    iri_urlparsed  = urllib.parse.urlparse(iri)
     return iri_urlparsed.netloc
 
 def generate_dnsmasq_config_file_line():
@@ -364,124 +862,1017 @@ def hosts_install_help(output_file=OUTPUT_FILE_PATH):
     print('    $ cat /etc/hosts.default ' + output_file + ' > /etc/hosts',
         file=sys.stderr)
 
-def append_to_local_rule_file(rule_file, idn):
+def rpz_install_help(output_file=OUTPUT_FILE_PATH):
+    print('    add to named.conf:', file=sys.stderr)
+    print('    options { response-policy { zone "rpz.dnsgate"; }; };', file=sys.stderr)
+    print('    zone "rpz.dnsgate" { type master; file "' + output_file + '"; };',
+        file=sys.stderr)
+    print('    $ rndc reload', file=sys.stderr)
+
+def unbound_install_help(output_file=OUTPUT_FILE_PATH):
+    print('    $ echo \'include: "' + output_file + '"\' >> /etc/unbound/unbound.conf',
+        file=sys.stderr)
+    print('    $ unbound-control reload', file=sys.stderr)
+
+def append_to_local_rule_file(rule_file, idn, domains):
+    '''
+    Append idn to rule_file unless it is already in domains, the validated
+    domains of rule_file, which it is added to.
+    '''
     eprint("attempting to append %s to %s", idn, rule_file, level=LOG['INFO'])
-    hostname = idn.encode('idna').decode('ascii')
+    hostname = validate_domain_list(set([idn.encode('utf-8')]))
+    if not hostname:
+        return
+    hostname = hostname.pop()
+    if hostname in domains:
+        eprint("%s is already in %s", idn, rule_file, level=LOG['INFO'])
+        return
     eprint("appending hostname: %s to %s", hostname, rule_file, level=LOG['DEBUG'])
-    line = hostname + '\n'
-    write_unique_line(line, rule_file)
+    with open(rule_file, 'ab+') as fh:
+        if fh.tell() > 0: # files written before the headers ended with a newline
+            fh.seek(-1, os.SEEK_END)
+            if fh.read(1) != b'\n':
+                fh.write(b'\n')
+        fh.write(hostname + b'\n')
+    domains.add(hostname)
 
 def extract_domain_set_from_dnsgate_format_file(dnsgate_file):
     domains = set([])
     dnsgate_file = os.path.abspath(dnsgate_file)
-    dnsgate_file_bytes = read_file_bytes(dnsgate_file)
-    lines = dnsgate_file_bytes.splitlines()
-    for line in lines:
-        line = line.strip()
-        line = remove_comments_from_bytes(line)
-        # ignore leading/trailing .
-        line = b'.'.join(list(filter(None, line.split(b'.'))))
-        if len(line) > 0:
-            domains.add(line)
-    return set(domains)
+    with open(dnsgate_file, 'rb') as fh:
+        for block in iter_line_blocks(iter_file_chunks(fh)):
+            for line in block.splitlines():
+                line = remove_comments_from_bytes(line).strip()
+                # ignore leading/trailing .
+                line = b'.'.join(list(filter(None, line.split(b'.'))))
+                if len(line) > 0:
+                    domains.add(line)
+    return domains
 
 def read_file_bytes(path):
     with open(path, 'rb') as fh:
         file_bytes = fh.read()
     return file_bytes
 
-def extract_domain_set_from_hosts_format_url_or_cached_copy(url, no_cache=False,
-        cache_expire=CACHE_EXPIRE):
-    unexpired_copy = get_newest_unexpired_cached_url_copy(url=url,
-        cache_expire=cache_expire)
-    if unexpired_copy:
-        eprint("Using cached copy: %s", unexpired_copy, level=LOG['INFO'])
-        unexpired_copy_bytes = read_file_bytes(unexpired_copy)
-        assert isinstance(unexpired_copy_bytes, bytes)
-        return extract_domain_set_from_hosts_format_bytes(unexpired_copy_bytes)
-    else:
-        return extract_domain_set_from_hosts_format_url(url, no_cache)
-
-def generate_cache_file_name(url):
-    url_hash = hash_str(url)
-    file_name = CACHE_DIRECTORY + '/' + url_hash + '_hosts'
-    return file_name
-
-def get_newest_unexpired_cached_url_copy(url, cache_expire=CACHE_EXPIRE):
-    newest_copy = get_matching_cached_file(url)
-    if newest_copy:
-        newest_copy_timestamp = os.stat(newest_copy).st_mtime
-        expiration_timestamp = int(newest_copy_timestamp) + int(cache_expire)
-        if expiration_timestamp > time.time():
-            return newest_copy
-        else:
-            os.rename(newest_copy, newest_copy + '.expired')
-            return False
-    return False
+def iter_file_chunks(fh, chunk_size=READ_CHUNK_SIZE):
+    return iter(lambda: fh.read(chunk_size), b'')
 
-def get_matching_cached_file(url):
-    name = generate_cache_file_name(url)
-    matching_cached_file = glob.glob(name)
-    if matching_cached_file:
-        return matching_cached_file[0]
-    else:
+class Line_Block_Splitter():
+    '''
+    Cuts data fed in chunks of any size into blocks of whole lines of at
+    least block_size bytes, so a file is never held whole or as a list of
+    all its lines. Only the block that close() returns can lack a final
+    newline.
+    '''
+    def __init__(self, block_size=PARALLEL_CHUNK_BYTES):
+        self.block_size = block_size
+        self.pending = []
+        self.pending_size = 0
+
+    def feed(self, data):
+        '''
+        Returns the next block, or b'' until block_size bytes are pending.
+        '''
+        self.pending.append(data)
+        self.pending_size += len(data)
+        if self.pending_size < self.block_size:
+            return b''
+        block = b''.join(self.pending)
+        end = block.rfind(b'\n') + 1
+        self.pending = [block[end:]]
+        self.pending_size = len(block) - end
+        return block[:end]
+
+    def close(self):
+        block = b''.join(self.pending)
+        self.pending = []
+        self.pending_size = 0
+        return block
+
+def iter_line_blocks(chunks, block_size=PARALLEL_CHUNK_BYTES):
+    '''
+    Yields the blocks of whole lines (see Line_Block_Splitter) in chunks.
+    '''
+    splitter = Line_Block_Splitter(block_size)
+    for chunk in chunks:
+        block = splitter.feed(chunk)
+        if block:
+            yield block
+    block = splitter.close()
+    if block:
+        yield block
+
+def extract_domain_set_from_hosts_format_url_or_cached_copy(url, fetcher,
+        no_cache=False, cache_expire=CACHE_EXPIRE, pool=None, max_size=SOURCE_MAX_BYTES,
+        max_stale=SOURCE_MAX_STALE, deadline_at=None):
+    entry = SOURCE_CACHE.entry(url)
+    if entry and entry['checked'] + cache_expire > time.time():
+        eprint("Using cached copy of: %s", url, level=LOG['INFO'])
+        domains = read_cached_domains(url, no_cache, pool=pool)
+        if domains is not None:
+            METRICS.source(url, cache='hit', bytes=entry['size'])
+            return domains
+    domains = extract_domain_set_from_hosts_format_url(url, fetcher, no_cache, pool=pool,
+        max_size=max_size, deadline_at=deadline_at)
+    if domains is False and not no_cache:
+        if deadline_at is not None and time.monotonic() > deadline_at:
+            return False # abandoned, fetch_sources() fell back already
+        domains = read_stale_domains(url, max_stale, pool=pool)
+    return domains
+
+def read_stale_domains(url, max_stale=SOURCE_MAX_STALE, pool=None, level=LOG['WARNING']):
+    '''
+    Return the validated domain set of the cached copy of url if it was
+    fetched or revalidated less than max_stale seconds ago, for when url
+    cannot be fetched in time. False otherwise.
+    '''
+    entry = SOURCE_CACHE.entry(url)
+    if not entry:
+        return False
+    age = time.time() - entry['checked']
+    if age >= max_stale:
+        eprint("The cached copy of %s is %.1f hours old, not using it.", url,
+            age / 3600, level=LOG['INFO'])
         return False
+    domains = read_cached_domains(url, pool=pool)
+    if domains is None:
+        return False
+    eprint("Using the cached copy of %s from %.1f hours ago.", url, age / 3600,
+        level=level)
+    METRICS.source(url, cache='stale', stale_seconds=round(age))
+    return domains
+
+def read_cached_domains(url, no_cache=False, pool=None):
+    '''
+    Return the validated domain set of the cached copy of url, skipping the
+    parse if a set parsed from the same content was saved with it. None if
+    there is no readable copy.
+
+    Otherwise the copy is parsed as it is decompressed, like a download,
+    and the result is saved next to it for the next run.
+    '''
+    if not no_cache:
+        domains = SOURCE_CACHE.read_parsed(url)
+        if domains is not None:
+            eprint("Using parsed copy of: %s", url, level=LOG['DEBUG'])
+            METRICS.source(url, parsed_cache='hit', domains=len(domains))
+            return domains
+    entry = SOURCE_CACHE.entry(url)
+    if entry is None:
+        return None
+    parse_started = time.time()
+    if entry['size'] < PARALLEL_MIN_BYTES:
+        pool = None
+    parser = Hosts_Stream_Parser(pool)
+    if not SOURCE_CACHE.read_body(url, parser):
+        return None
+    domains = parser.close()
+    METRICS.source(url, parsed_cache='miss', domains=len(domains),
+        read_seconds=time.time() - parse_started, parse_seconds=parser.parse_seconds,
+        validate_seconds=parser.validate_seconds)
+    if not no_cache:
+        SOURCE_CACHE.store_parsed(url, parser.content_hash(), domains)
+    return domains
+
+def extract_validated_domains_chunk(hosts_format_bytes):
+    '''
+    Process pool worker, returns the domains newline joined since a single
+    bytes object pickles much faster than a set of millions of them, and
+    the seconds spent parsing and validating them.
+    '''
+    started = time.time()
+    domains = extract_domain_set_from_hosts_format_bytes(hosts_format_bytes)
+    parsed = time.time()
+    domains = b'\n'.join(validate_domain_list(domains, invalid_level=LOG['INFO']))
+    return domains, parsed - started, time.time() - parsed
+
+def make_process_pool(jobs):
+    '''
+    Returns a ProcessPoolExecutor for jobs > 1, else None. Workers come from
+    a fork server: forking the fetch threads could copy a held lock.
+    '''
+    if jobs <= 1:
+        return None
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    try:
+        context = multiprocessing.get_context('forkserver')
+    except ValueError: # not available on this platform
+        context = multiprocessing.get_context('spawn')
+    return ProcessPoolExecutor(max_workers=jobs, mp_context=context)
+
+def make_tmp_path(path):
+    return path + '.tmp.' + str(os.getpid()) + '.' + str(threading.get_ident())
+
+def write_file_bytes_atomic(path, file_bytes):
+    tmp_path = make_tmp_path(path)
+    with open(tmp_path, 'wb') as fh:
+        fh.write(file_bytes)
+    os.replace(tmp_path, path)
+
+class Source_Cache_Writer():
+    '''
+    Compresses a source body into a temporary file as it downloads,
+    Source_Cache.store() moves it into place.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.tmp_path = make_tmp_path(path)
+        self.fh = open(self.tmp_path, 'wb')
+        self.compressor = zlib.compressobj(SOURCE_CACHE_COMPRESS_LEVEL,
+            zlib.DEFLATED, 31) # gzip container
+
+    def write(self, data):
+        self.fh.write(self.compressor.compress(data))
+
+    def close(self):
+        self.fh.write(self.compressor.flush())
+        self.fh.close()
+
+    def discard(self):
+        self.fh.close()
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+class Source_Cache():
+    '''
+    gzip compressed copies of remote sources, and of the domain sets parsed
+    from them, in directory. index.json maps each url to an entry:
+
+        key            sha1(url), names the files key.gz and key.parsed.gz
+        fetched        when the body was downloaded
+        checked        when it was downloaded or last revalidated (304)
+        used           when it was last read
+        etag, last_modified  response validators for conditional requests
+        size           decompressed body bytes
+        stored_size    bytes on disk for both files
+        content_sha1   of the decompressed body
+        parsed         PARSED_CACHE_VERSION and content_sha1 of key.parsed.gz
+
+    Lookups are dict lookups on the index held in memory. Every change
+    re-reads, updates and atomically replaces index.json under a lock held
+    across threads and processes. Reads only note when they happened, the
+    next change writes the used times down with it, fetch_sources() ends
+    with one: evict() drops entries past max_age, then the least recently
+    used ones until the total is under max_bytes.
+    '''
+    def __init__(self, directory):
+        self.directory = directory
+        self.index_path = directory + '/index.json'
+        self.lock = threading.Lock()
+        self.entries = None
+        self.used = {} # url -> when it was read, not in index.json yet
+        self.used_lock = threading.Lock()
+
+    def read_index(self):
+        try:
+            with open(self.index_path, 'r') as fh:
+                index = json.load(fh)
+        except FileNotFoundError:
+            return {}
+        except ValueError as e:
+            eprint("WARNING: ignoring unreadable cache index %s: %s",
+                self.index_path, e, level=LOG['WARNING'])
+            return {}
+        if not isinstance(index, dict) or index.get('format') != SOURCE_CACHE_FORMAT:
+            return {} # the files it named are removed by evict()
+        return index['entries']
+
+    @contextlib.contextmanager
+    def locked_entries(self):
+        '''
+        Yields the current entries to modify in place, they are written
+        back when the block exits without an exception.
+        '''
+        with self.lock:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(self.directory + '/index.lock', 'a') as lock_fh:
+                fcntl.flock(lock_fh, fcntl.LOCK_EX)
+                entries = self.read_index()
+                with self.used_lock:
+                    used, self.used = self.used, {}
+                for url, used_time in used.items(): # before evict() sorts by them
+                    if url in entries:
+                        entries[url]['used'] = max(entries[url]['used'], used_time)
+                yield entries
+                write_file_bytes_atomic(self.index_path, json.dumps(
+                    {'format': SOURCE_CACHE_FORMAT, 'entries': entries},
+                    sort_keys=True, indent=1).encode('utf8'))
+                self.entries = entries
+
+    def entry(self, url):
+        if self.entries is None:
+            with self.lock:
+                if self.entries is None:
+                    self.entries = self.read_index()
+        return self.entries.get(url)
+
+    def file_path(self, entry, suffix):
+        return self.directory + '/' + entry['key'] + suffix
+
+    def stored_size(self, key):
+        size = 0
+        for suffix in ('.gz', '.parsed.gz'):
+            try:
+                size += os.stat(self.directory + '/' + key + suffix).st_size
+            except FileNotFoundError:
+                pass
+        return size
+
+    def mark_used(self, url):
+        with self.used_lock:
+            self.used[url] = time.time()
+
+    def update(self, url, **values):
+        with self.locked_entries() as entries:
+            if url in entries:
+                entries[url] = dict(entries[url], **values)
+
+    def iter_file(self, entry, suffix):
+        '''
+        Yields the file decompressed READ_CHUNK_SIZE bytes at a time, raises
+        OSError or zlib.error if it is missing or damaged.
+        '''
+        decompressor = zlib.decompressobj(31)
+        with open(self.file_path(entry, suffix), 'rb') as fh:
+            for chunk in iter_file_chunks(fh):
+                yield decompressor.decompress(chunk)
+        if not decompressor.eof:
+            raise zlib.error('truncated')
+
+    def read_body(self, url, parser):
+        '''
+        Feeds the cached body of url to parser (see Hosts_Stream_Parser) and
+        returns True, or False if there is no intact copy. A damaged copy is
+        removed, parser has been fed part of it by then.
+        '''
+        entry = self.entry(url)
+        if entry is None:
+            return False
+        try:
+            for chunk in self.iter_file(entry, '.gz'):
+                parser.feed(chunk)
+            intact = parser.content_hash() == entry['content_sha1']
+        except (OSError, zlib.error) as e:
+            eprint("WARNING: %s.gz: %s", entry['key'], e, level=LOG['WARNING'])
+            intact = False
+        if not intact:
+            eprint("WARNING: discarding damaged cached copy of %s", url,
+                level=LOG['WARNING'])
+            self.remove(url)
+            return False
+        self.mark_used(url)
+        return True
+
+    def read_parsed(self, url):
+        '''
+        Returns the domain set parsed from the cached body with the current
+        PARSED_CACHE_VERSION, or None.
+        '''
+        entry = self.entry(url)
+        if entry is None or entry['parsed'] != \
+                PARSED_CACHE_VERSION.decode('ascii') + ' ' + entry['content_sha1']:
+            return None
+        domains = set()
+        try:
+            for block in iter_line_blocks(self.iter_file(entry, '.parsed.gz')):
+                domains.update(block.split(b'\n'))
+        except (OSError, zlib.error) as e:
+            eprint("WARNING: %s.parsed.gz: %s", entry['key'], e, level=LOG['WARNING'])
+            self.update(url, parsed=None)
+            return None
+        self.mark_used(url)
+        domains.discard(b'')
+        return domains
+
+    def writer(self, url):
+        os.makedirs(self.directory, exist_ok=True)
+        return Source_Cache_Writer(self.directory + '/' + hash_str(url) + '.gz')
+
+    def store(self, url, writer, headers, size, content_sha1):
+        '''
+        Replace the cached copy of url with the body written to writer.
+        '''
+        writer.close()
+        now = time.time()
+        key = hash_str(url)
+        with self.locked_entries() as entries:
+            os.replace(writer.tmp_path, writer.path)
+            entries[url] = {
+                'key': key,
+                'fetched': now,
+                'checked': now,
+                'used': now,
+                'etag': headers.get('ETag'),
+                'last_modified': headers.get('Last-Modified'),
+                'size': size,
+                'stored_size': self.stored_size(key),
+                'content_sha1': content_sha1,
+                'parsed': None,
+                }
+
+    def store_parsed(self, url, content_sha1, domains):
+        entry = self.entry(url)
+        if entry is None or entry['content_sha1'] != content_sha1:
+            return # replaced meanwhile
+        compressor = zlib.compressobj(SOURCE_CACHE_COMPRESS_LEVEL, zlib.DEFLATED, 31)
+        write_file_bytes_atomic(self.file_path(entry, '.parsed.gz'),
+            compressor.compress(b'\n'.join(sorted(domains))) + compressor.flush())
+        self.update(url, parsed=PARSED_CACHE_VERSION.decode('ascii') + ' ' + content_sha1,
+            stored_size=self.stored_size(entry['key']))
+
+    def revalidated(self, url, headers):
+        '''
+        The server answered 304 Not Modified, restart the cache_expire clock.
+        '''
+        values = {'checked': time.time()}
+        if headers.get('ETag'):
+            values['etag'] = headers['ETag']
+        if headers.get('Last-Modified'):
+            values['last_modified'] = headers['Last-Modified']
+        self.update(url, **values)
+
+    def remove(self, url):
+        with self.locked_entries() as entries:
+            entry = entries.pop(url, None)
+            if entry:
+                self.remove_files(entry['key'])
+
+    def remove_files(self, key):
+        for suffix in ('.gz', '.parsed.gz'):
+            try:
+                os.remove(self.directory + '/' + key + suffix)
+            except FileNotFoundError:
+                pass
+
+    def evict(self, max_bytes=SOURCE_CACHE_MAX_BYTES, max_age=SOURCE_CACHE_MAX_AGE):
+        now = time.time()
+        with self.locked_entries() as entries:
+            for url, entry in list(entries.items()):
+                if now - entry['checked'] > max_age:
+                    eprint("Evicting %s, not fetched in %d seconds", url,
+                        now - entry['checked'], level=LOG['INFO'])
+                    del entries[url]
+            total_size = sum(entry['stored_size'] for entry in entries.values())
+            for url, entry in sorted(entries.items(), key=lambda item: item[1]['used']):
+                if total_size <= max_bytes:
+                    break
+                eprint("Evicting %s, the cache is over %d bytes", url, max_bytes,
+                    level=LOG['INFO'])
+                del entries[url]
+                total_size -= entry['stored_size']
+            keys = set(entry['key'] for entry in entries.values())
+            for name in os.listdir(self.directory):
+                path = self.directory + '/' + name
+                if name in ('index.json', 'index.lock'):
+                    continue
+                if '.tmp.' in name: # another fetch may still be writing it
+                    try:
+                        if now - os.stat(path).st_mtime > SOURCE_CACHE_TMP_AGE:
+                            os.remove(path)
+                    except FileNotFoundError:
+                        pass
+                elif name.split('.')[0] not in keys:
+                    os.remove(path)
+
+SOURCE_CACHE = Source_Cache(SOURCE_CACHE_DIRECTORY)
+
+def remove_legacy_source_cache(directory=CACHE_DIRECTORY):
+    '''
+    Before SOURCE_CACHE sources were cached uncompressed as sha1(url)_hosts
+    next to their _parsed and .validators files, indexed by sha1_index.
+    '''
+    legacy_files = glob.glob(directory + '/*_hosts*') + \
+        glob.glob(directory + '/*_parsed') + glob.glob(directory + '/sha1_index')
+    for path in legacy_files:
+        os.remove(path)
+
+class Source_Too_Large(Exception):
+    pass
+
+class Fetch_Deadline_Exceeded(Exception):
+    pass
+
+class Source_Http_Error(Exception):
+    pass
+
+class Source_Decompressor():
+    '''
+    decompress() and flush() yield the output DOWNLOAD_CHUNK_SIZE bytes at
+    a time at most, so a small chunk of a compression bomb never inflates
+    into a large buffer. Source_Too_Large is raised as soon as the bytes
+    fed in or the bytes yielded pass max_size (None for no limit).
+    '''
+    def __init__(self, max_size=None):
+        self.max_size = max_size
+        self.compressed_size = 0
+        self.size = 0
+
+    def received(self, data):
+        self.compressed_size += len(data)
+        if self.max_size is not None and self.compressed_size > self.max_size:
+            raise Source_Too_Large('larger than %d bytes compressed' % self.max_size)
+
+    def produced(self, data):
+        self.size += len(data)
+        if self.max_size is not None and self.size > self.max_size:
+            raise Source_Too_Large('larger than %d bytes decompressed' % self.max_size)
+        return data
+
+class Gzip_Decompressor(Source_Decompressor):
+    '''
+    Servers often send a .gz file with "Content-Encoding: gzip", requests
+    has then already decompressed it, so only a gzip magic number is inflated.
+    '''
+    def __init__(self, max_size=None):
+        super().__init__(max_size)
+        self.decompressor = None
+        self.plain = False
+
+    def decompress(self, data):
+        self.received(data)
+        if self.decompressor is None and not self.plain:
+            if data[:2] == b'\x1f\x8b':
+                self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            elif data:
+                self.plain = True
+        if self.decompressor is None:
+            if data:
+                yield self.produced(data)
+            return
+        while True: # a full chunk may leave output behind even without input
+            chunk = self.decompressor.decompress(data, DOWNLOAD_CHUNK_SIZE)
+            if chunk:
+                yield self.produced(chunk)
+            data = self.decompressor.unconsumed_tail
+            if not data and len(chunk) < DOWNLOAD_CHUNK_SIZE:
+                return
+
+    def flush(self):
+        chunk = self.decompressor.flush() if self.decompressor else b''
+        if chunk:
+            yield self.produced(chunk)
+
+class Xz_Decompressor(Source_Decompressor):
+    def __init__(self, max_size=None):
+        super().__init__(max_size)
+        import lzma
+        self.decompressor = lzma.LZMADecompressor()
+
+    def decompress(self, data):
+        self.received(data)
+        while True:
+            chunk = self.decompressor.decompress(data, DOWNLOAD_CHUNK_SIZE)
+            if chunk:
+                yield self.produced(chunk)
+            if self.decompressor.eof or self.decompressor.needs_input:
+                return
+            data = b''
+
+    def flush(self):
+        return ()
+
+class Zip_Decompressor(Source_Decompressor):
+    '''
+    zip keeps its directory at the end, so the body is buffered, up to
+    max_size, and every member is yielded, one after another, by flush().
+    '''
+    def __init__(self, max_size=None):
+        super().__init__(max_size)
+        self.chunks = []
+
+    def decompress(self, data):
+        self.received(data)
+        self.chunks.append(data)
+        return ()
+
+    def flush(self):
+        import zipfile
+        body = io.BytesIO(b''.join(self.chunks))
+        del self.chunks[:]
+        with zipfile.ZipFile(body) as archive:
+            members = [info for info in archive.infolist() if not info.filename.endswith('/')]
+            if self.max_size is not None and \
+                    sum(info.file_size for info in members) > self.max_size:
+                raise Source_Too_Large('zip members are larger than %d bytes' % self.max_size)
+            for number, info in enumerate(members):
+                if number:
+                    yield self.produced(b'\n')
+                with archive.open(info) as fh:
+                    for chunk in iter_file_chunks(fh, DOWNLOAD_CHUNK_SIZE):
+                        yield self.produced(chunk)
+
+def make_source_decompressor(url, max_size):
+    '''
+    Returns a decompressor for .gz, .xz and .zip urls, else None.
+    '''
+    path = urllib.parse.urlparse(url).path
+    if path.endswith('.gz'):
+        return Gzip_Decompressor(max_size)
+    if path.endswith('.xz'):
+        return Xz_Decompressor(max_size)
+    if path.endswith('.zip'):
+        return Zip_Decompressor(max_size)
+    return None
+
+class Hosts_Stream_Parser():
+    '''
+    Parses a hosts file fed in chunks of any size, while it downloads or is
+    read from the cache. Every PARALLEL_CHUNK_BYTES of complete lines are
+    parsed right away, in pool if one is given (see make_process_pool()),
+    with at most PARALLEL_MAX_PENDING of them waiting on it. close() returns
+    the validated domain set. parse_seconds and validate_seconds add up the
+    time spent on each, across the pool's processes if there is one.
+    '''
+    def __init__(self, pool=None):
+        self.pool = pool
+        self.splitter = Line_Block_Splitter(PARALLEL_CHUNK_BYTES)
+        self.domains = set()
+        self.futures = collections.deque()
+        self.digest = hashlib.sha1()
+        self.size = 0
+        self.parse_seconds = 0
+        self.validate_seconds = 0
+
+    def feed(self, data):
+        self.digest.update(data)
+        self.size += len(data)
+        block = self.splitter.feed(data)
+        if block:
+            self.parse(block)
+
+    def parse(self, block):
+        if self.pool is not None:
+            self.futures.append(self.pool.submit(extract_validated_domains_chunk, block))
+            if len(self.futures) > PARALLEL_MAX_PENDING:
+                self.add_chunk(self.futures.popleft().result())
+        else: # only valid domains are kept, as in the pool
+            started = time.time()
+            domains = extract_domain_set_from_hosts_format_bytes(block)
+            parsed = time.time()
+            self.domains.update(validate_domain_list(domains, invalid_level=LOG['INFO']))
+            self.parse_seconds += parsed - started
+            self.validate_seconds += time.time() - parsed
+
+    def add_chunk(self, result):
+        domains, parse_seconds, validate_seconds = result
+        self.domains.update(domains.split(b'\n'))
+        self.parse_seconds += parse_seconds
+        self.validate_seconds += validate_seconds
+
+    def close(self):
+        self.parse(self.splitter.close())
+        while self.futures:
+            self.add_chunk(self.futures.popleft().result())
+        self.domains.discard(b'')
+        return self.domains
+
+    def content_hash(self):
+        return self.digest.hexdigest()
+
+class Source_Fetcher():
+    '''
+    One pooled requests.Session shared by every source fetch, so sources on
+    the same host re-use a kept-alive connection instead of paying for a
+    new TCP and TLS handshake each. The session is only made (and requests
+    imported) once something is actually downloaded.
+
+    proxy is used for http and https, without it the usual HTTP_PROXY,
+    HTTPS_PROXY and NO_PROXY environment variables apply.
+    '''
+    def __init__(self, workers=FETCH_WORKERS, per_host=FETCH_PER_HOST,
+            retries=FETCH_RETRIES, retry_backoff=FETCH_RETRY_BACKOFF, proxy=None,
+            timeout=FETCH_TIMEOUT):
+        self.workers = workers
+        self.per_host = per_host
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        self.proxy = proxy
+        self.timeout = timeout
+        self.session = None
+        self.lock = threading.Lock()
+
+    def make_session(self):
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+        session = requests.Session()
+        session.headers.update({'User-Agent': FETCH_USER_AGENT,
+            'Accept-Encoding': 'gzip, deflate'})
+        if self.proxy:
+            session.proxies.update({'http': self.proxy, 'https': self.proxy})
+        # the body is streamed, so only the request itself is retried
+        retry = Retry(total=self.retries, backoff_factor=self.retry_backoff,
+            status_forcelist=FETCH_RETRY_STATUSES)
+        # one pool per host, each keeping up to per_host connections alive
+        adapter = HTTPAdapter(pool_connections=max(1, self.workers),
+            pool_maxsize=max(1, self.per_host), max_retries=retry)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def get(self, url, headers, deadline_at=None):
+        '''
+        Returns the streamed response to GET url, use it as a context manager.
+        With deadline_at, a time.monotonic() value, the timeout is cut to the
+        time left until then.
+        '''
+        timeout = self.timeout
+        if deadline_at is not None:
+            timeout = min(timeout, deadline_at - time.monotonic())
+            if timeout <= 0:
+                raise Fetch_Deadline_Exceeded('the deadline passed before the request')
+        with self.lock:
+            if self.session is None:
+                self.session = self.make_session()
+        return self.session.get(url, headers=headers, allow_redirects=True,
+            stream=True, timeout=timeout)
+
+    def close(self):
+        with self.lock:
+            if self.session is not None:
+                self.session.close()
+                self.session = None
+
+    def with_own_session(self):
+        '''
+        Returns a Source_Fetcher with the same settings and a session of its
+        own, for fetches that outlive the caller of this one.
+        '''
+        return Source_Fetcher(workers=self.workers, per_host=self.per_host,
+            retries=self.retries, retry_backoff=self.retry_backoff, proxy=self.proxy,
+            timeout=self.timeout)
+
+def read_url_domains(url, fetcher, no_cache=False, pool=None,
+        max_size=SOURCE_MAX_BYTES, deadline_at=None, conditional=True):
+    '''
+    Download url with fetcher (a Source_Fetcher) and return its validated
+    domain set, or False. The body is parsed while it streams in and written
+    to the cache as it arrives. The download is abandoned once
+    time.monotonic() passes deadline_at.
 
-def read_url_bytes(url, no_cache=False):
+    A non-2xx response, or one without domains when there is a cached copy,
+    is a failure and leaves the cached copy alone for the stale fallback.
+    '''
     eprint("GET: %s", url, level=LOG['DEBUG'])
-    user_agent = 'Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:24.0) Gecko/20100101 Firefox/24.0'
+    headers = {}
+    cached = None if no_cache else SOURCE_CACHE.entry(url)
+    entry = cached if conditional else None
+    if entry:
+        if entry['etag']:
+            headers['If-None-Match'] = entry['etag']
+        if entry['last_modified']:
+            headers['If-Modified-Since'] = entry['last_modified']
+    request_started = time.time()
+    cache_writer = None
     try:
-        raw_url_bytes = requests.get(url, headers={'User-Agent': user_agent},
-            allow_redirects=True, stream=False, timeout=15.500).content
+        with fetcher.get(url, headers, deadline_at=deadline_at) as response:
+            if response.status_code == 304 and entry:
+                domains = read_cached_domains(url, no_cache, pool=pool)
+                if domains is None:
+                    eprint("Not modified: %s, but the cached copy is gone, fetching it again",
+                        url, level=LOG['INFO'])
+                    response.close()
+                    return read_url_domains(url, fetcher, no_cache, pool=pool,
+                        max_size=max_size, deadline_at=deadline_at, conditional=False)
+                eprint("Not modified: %s, re-using cached copy", url, level=LOG['INFO'])
+                SOURCE_CACHE.revalidated(url, response.headers)
+                METRICS.source(url, cache='not_modified', status=304,
+                    fetch_seconds=time.time() - request_started, bytes=entry['size'])
+                return domains
+            if not 200 <= response.status_code < 300:
+                raise Source_Http_Error('HTTP %d %s' % (response.status_code,
+                    response.reason))
+
+            decompressor = make_source_decompressor(url, max_size)
+            parser = Hosts_Stream_Parser(pool)
+            if not no_cache:
+                cache_writer = SOURCE_CACHE.writer(url)
+            def feed(chunks):
+                for chunk in chunks:
+                    if parser.size + len(chunk) > max_size:
+                        raise Source_Too_Large('larger than %d bytes' % max_size)
+                    parser.feed(chunk)
+                    if cache_writer:
+                        cache_writer.write(chunk)
+
+            # iter_content() undoes Content-Encoding: gzip/deflate
+            for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                if deadline_at is not None and time.monotonic() > deadline_at:
+                    raise Fetch_Deadline_Exceeded('the deadline passed while downloading')
+                feed(decompressor.decompress(chunk) if decompressor else (chunk,))
+            if decompressor:
+                feed(decompressor.flush())
+            domains = parser.close()
+            if not domains and cached:
+                raise ValueError('no domains in the response, keeping the cached copy')
+            download_size = response.raw.tell() # before Content-Encoding is undone
     except Exception as e:
-        eprint(e, level=LOG['WARNING'])
+        if cache_writer:
+            cache_writer.discard()
+        if isinstance(e, Fetch_Deadline_Exceeded): # fetch_sources() reports it
+            return False
+        eprint("%s: %s", url, e, level=LOG['WARNING'])
+        METRICS.source(url, fetch_seconds=time.time() - request_started,
+            error=str(e))
         return False
-    if not no_cache:
-        cache_index_file = CACHE_DIRECTORY + '/sha1_index'
-        cache_file = generate_cache_file_name(url)
-        with open(cache_file, 'xb') as fh:
-            fh.write(raw_url_bytes)
-        line_to_write = cache_file + ' ' + url + '\n'
-        write_unique_line(line_to_write, cache_index_file)
 
-    eprint("Returning %d bytes from %s", len(raw_url_bytes), url, level=LOG['DEBUG'])
-    return raw_url_bytes
+    METRICS.source(url, cache='miss', status=response.status_code,
+        fetch_seconds=time.time() - request_started, bytes=parser.size,
+        download_bytes=download_size, parsed_cache='miss', domains=len(domains),
+        parse_seconds=parser.parse_seconds, validate_seconds=parser.validate_seconds)
+    if cache_writer:
+        SOURCE_CACHE.store(url, cache_writer, response.headers, parser.size,
+            parser.content_hash())
+        SOURCE_CACHE.store_parsed(url, parser.content_hash(), domains)
+
+    eprint("Parsed %d bytes from %s", parser.size, url, level=LOG['DEBUG'])
+    return domains
+
+def strip_extra_dots(domain):
+    '''
+    ignore leading/trailing . and collapse empty labels: .a..b. -> a.b
+    '''
+    if domain.startswith(b'.') or domain.endswith(b'.') or b'..' in domain:
+        # pylint: disable=bad-builtin
+        domain = b'.'.join(list(filter(None, domain.split(b'.'))))
+        # pylint: enable=bad-builtin
+    return domain
 
 def extract_domain_set_from_hosts_format_bytes(hosts_format_bytes):
+    '''
+    One regex scan over the whole buffer, no per-line copies.
+    Lines without a second field (before any #) are ignored.
+    '''
     assert isinstance(hosts_format_bytes, bytes)
-    domains = set()
-    hosts_format_bytes_lines = hosts_format_bytes.split(b'\n')
-    for line in hosts_format_bytes_lines:
-        line = line.replace(b'\t', b' ')         # expand tabs
-        line = b' '.join(line.split())           # collapse whitespace
-        line = line.strip()
-        line = remove_comments_from_bytes(line)
-        if b' ' in line:                         # hosts format
-            # get DNS name (the url's are in hosts 0.0.0.0 dom.com format
-            line = line.split(b' ')[1]
-            # pylint: disable=bad-builtin
-            # ignore leading/trailing .
-            line = b'.'.join(list(filter(None, line.split(b'.'))))
-            # pylint: enable=bad-builtin
-            domains.add(line)
+    domains = set(HOSTS_LINE_REGEX.findall(hosts_format_bytes))
+    dotted = [domain for domain in domains if domain.startswith(b'.') or
+        domain.endswith(b'.') or b'..' in domain]
+    for domain in dotted:
+        domains.remove(domain)
+        domain = strip_extra_dots(domain)
+        if domain:
+            domains.add(domain)
     return domains
 
-def extract_domain_set_from_hosts_format_url(url, no_cache=False):
-    url_bytes = read_url_bytes(url, no_cache)
-    domains = extract_domain_set_from_hosts_format_bytes(url_bytes)
+def extract_domain_set_from_hosts_format_url(url, fetcher, no_cache=False, pool=None,
+        max_size=SOURCE_MAX_BYTES, deadline_at=None):
+    domains = read_url_domains(url, fetcher, no_cache, pool=pool, max_size=max_size,
+        deadline_at=deadline_at)
+    if domains is False:
+        return False
     eprint("Domains in %s:%s", url, len(domains), level=LOG['DEBUG'])
     return domains
 
-def prune_redundant_rules(domains):
-    domains_orig = copy.deepcopy(domains) # need to iterate through _orig later
-    for domain in domains_orig:
-        domain_parts_msb = list(reversed(domain.split(b'.'))) # start with the TLD
-        for index in range(len(domain_parts_msb)):
-            domain_to_check = b'.'.join(domain_parts_msb[0:index])
-            if domain_to_check in domains_orig:
-                eprint("removing: %s because it's parent domain: %s is already blocked",
-                    domain, domain_to_check, level=LOG['DEBUG'])
-                domains.remove(domain)
+def start_fetch_task(slots, function, *args, inline=False):
+    '''
+    Run function(*args) in a daemon thread once it holds one of slots, a
+    semaphore, and return its Future, which can be cancelled until then.
+    Unlike a ThreadPoolExecutor worker, a task blocked on a hung server
+    past the deadline does not keep the interpreter from exiting. With
+    inline it runs in the calling thread before the Future is returned.
+    '''
+    future = Future()
+
+    def run():
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(function(*args))
+        except BaseException as e:
+            future.set_exception(e)
+
+    def run_in_slot():
+        with slots:
+            run()
+
+    if inline: # one at a time already, a task it starts would wait on its slot
+        run()
+    else:
+        threading.Thread(target=run_in_slot, daemon=True).start()
+    return future
+
+def finish_revalidations(futures, deadline_at, fetcher=None):
+    '''
+    atexit hook of fetch_sources(), waits for the stale_while_revalidate
+    fetches until deadline_at and then closes fetcher.
+    '''
+    wait(futures, timeout=max(0, deadline_at - time.monotonic()))
+    if fetcher is not None:
+        fetcher.close()
+
+def fetch_sources(urls, no_cache=False, cache_expire=CACHE_EXPIRE,
+        workers=FETCH_WORKERS, per_host=FETCH_PER_HOST, deadline=FETCH_DEADLINE,
+        pool=None, max_size=SOURCE_MAX_BYTES, fetcher=None,
+        max_stale=SOURCE_MAX_STALE, stale_while_revalidate=False, inline=False):
+    '''
+    Fetch and parse urls concurrently, large sources are parsed in chunks
+    across pool (see make_process_pool()) if one is given. With inline they
+    are fetched one after another in the calling thread instead, for a
+    profiler that only sees that thread, and a fetch stuck past the deadline
+    is waited for rather than abandoned.
+
+    At most workers sources are in flight at once, and at most per_host of
+    them against any single host. Sources that raise, return nothing, or are
+    still running when deadline seconds have passed fall back to a cached
+    copy less than max_stale seconds old (see read_stale_domains()), or map
+    to False.
+
+    The deadline bounds the downloads themselves: every request times out by
+    then, and a fetch still stuck in one is abandoned in its daemon thread
+    (see start_fetch_task()) instead of holding up the exit.
+
+    With stale_while_revalidate, expired sources with such a copy return it
+    right away and are re-fetched in the background for the next run, the
+    interpreter waits for those fetches on exit, up to the same deadline.
+
+    Downloads go through fetcher, a Source_Fetcher that keeps its connections
+    alive for the next call, without one a Source_Fetcher is made and closed
+    for these urls. The background re-fetches get a session of their own,
+    the caller may close fetcher as soon as this returns.
+
+    Returns a dict of url -> domain set.
+    '''
+    own_fetcher = fetcher is None
+    if own_fetcher:
+        fetcher = Source_Fetcher(workers=workers, per_host=per_host)
+    revalidation_fetcher = fetcher.with_own_session() if stale_while_revalidate else None
+    deadline_at = time.monotonic() + deadline
+    fetch_slots = threading.BoundedSemaphore(max(1, workers))
+    revalidations = []
+    host_slots = {}
+    for url in urls:
+        host = extract_domain_from_iri(url)
+        if host not in host_slots:
+            host_slots[host] = threading.BoundedSemaphore(per_host)
+
+    def fetch(url):
+        entry = None if no_cache else SOURCE_CACHE.entry(url)
+        if (stale_while_revalidate and entry and
+                entry['checked'] + cache_expire <= time.time()):
+            domains = read_stale_domains(url, max_stale, pool=pool, level=LOG['INFO'])
+            if domains is not False:
+                revalidations.append(start_fetch_task(fetch_slots, revalidate, url,
+                    inline=inline))
+                return domains
+        queued = time.time()
+        with host_slots[extract_domain_from_iri(url)]:
+            started = time.time()
+            eprint("Trying http:// blacklist location: %s", url, level=LOG['DEBUG'])
+            try:
+                domains = extract_domain_set_from_hosts_format_url_or_cached_copy(url,
+                    fetcher, no_cache, cache_expire, pool=pool, max_size=max_size,
+                    max_stale=max_stale, deadline_at=deadline_at)
+                if domains is False and inline and not no_cache and \
+                        time.monotonic() > deadline_at: # not abandoned, fall back here
+                    domains = read_stale_domains(url, max_stale, pool=pool)
+                return domains
+            finally:
+                METRICS.source(url, wait_seconds=started - queued,
+                    total_seconds=time.time() - started)
+
+    def revalidate(url):
+        # pool is shut down by the time this runs, parse in this thread
+        with host_slots[extract_domain_from_iri(url)]:
+            eprint("Revalidating: %s", url, level=LOG['DEBUG'])
+            extract_domain_set_from_hosts_format_url(url, revalidation_fetcher,
+                max_size=max_size, deadline_at=deadline_at)
+
+    results = {}
+    futures = {}
+    for url in urls:
+        if inline and time.monotonic() > deadline_at:
+            futures[Future()] = url # never run, falls back below
+        else:
+            futures[start_fetch_task(fetch_slots, fetch, url, inline=inline)] = url
+    try:
+        for future in as_completed(futures, timeout=max(0, deadline_at - time.monotonic())):
+            url = futures[future]
+            try:
+                results[url] = future.result()
+            except Exception as e:
+                eprint("Exception on blacklist url: %s", url, level=LOG['ERROR'])
+                eprint(e, level=LOG['ERROR'])
+                METRICS.source(url, error=str(e))
+                results[url] = False
+    except FuturesTimeoutError:
+        for future, url in futures.items():
+            if url not in results:
+                future.cancel() # running fetches give up at the deadline themselves
+                METRICS.source(url, error='deadline')
+                eprint('ERROR: %s did not finish within %d seconds.',
+                    url, deadline, level=LOG['ERROR'])
+                results[url] = not no_cache and read_stale_domains(url, max_stale,
+                    pool=pool)
+    if revalidations:
+        atexit.register(finish_revalidations, revalidations, deadline_at,
+            revalidation_fetcher)
+    if own_fetcher:
+        fetcher.close()
+    if not no_cache:
+        remove_legacy_source_cache()
+        SOURCE_CACHE.evict()
+    return results
 
 def is_broken_symlink(path):
     if os.path.islink(path):
@@ -532,6 +1923,569 @@ def symlink_relative(target, link_name):
     relative_target = os.path.relpath(target, link_name_folder)
     os.symlink(relative_target, link_name)
 
+DNS_TYPE_A = 1
+DNS_TYPE_SOA = 6
+DNS_TYPE_AAAA = 28
+DNS_TYPE_OPT = 41
+DNS_RCODE_NOERROR = 0
+DNS_RCODE_FORMERR = 1
+DNS_RCODE_SERVFAIL = 2
+DNS_RCODE_NXDOMAIN = 3
+DNS_FLAG_QR = 0x8000
+DNS_FLAG_TC = 0x0200
+DNS_FLAG_RA = 0x0080
+DNS_FLAGS_COPIED = 0x7900 # opcode and RD
+DNS_EDNS_DO = 0x8000 # in the TTL field of an OPT record
+DNS_UDP_SIZE = 512 # without EDNS, RFC 1035
+
+# udp_size is None when the query has no OPT record
+Dns_Query = collections.namedtuple('Dns_Query',
+    ['ident', 'flags', 'name', 'qtype', 'qclass', 'question', 'udp_size',
+     'dnssec_ok'])
+
+Dns_Record = collections.namedtuple('Dns_Record',
+    ['offset', 'rtype', 'rclass', 'ttl', 'rdlength', 'end'])
+
+class Dns_Error(Exception):
+    pass
+
+def read_dns_name(message, offset):
+    '''
+    Returns (name, offset of the byte after the name), follows compression
+    pointers.
+    '''
+    labels = []
+    end = None
+    jumps = 0
+    while True:
+        if offset >= len(message):
+            raise Dns_Error('truncated name')
+        length = message[offset]
+        if length & 0xc0 == 0xc0:
+            if offset + 1 >= len(message):
+                raise Dns_Error('truncated compression pointer')
+            if end is None:
+                end = offset + 2
+            offset = ((length & 0x3f) << 8) | message[offset + 1]
+            jumps += 1
+            if jumps > 64:
+                raise Dns_Error('compression loop')
+            continue
+        if length & 0xc0:
+            raise Dns_Error('bad label type')
+        offset += 1
+        if length == 0:
+            break
+        labels.append(message[offset:offset + length])
+        offset += length
+    if end is None:
+        end = offset
+    return b'.'.join(labels), end
+
+def iter_dns_records(message, offset, count):
+    '''
+    Yields a Dns_Record for each of the count records from offset, its
+    offset is that of the type field, right after the owner name.
+    '''
+    for _ in range(count):
+        offset = read_dns_name(message, offset)[1]
+        if offset + 10 > len(message):
+            raise Dns_Error('truncated record')
+        rtype, rclass, ttl, rdlength = struct.unpack('!HHIH',
+            message[offset:offset + 10])
+        end = offset + 10 + rdlength
+        if end > len(message):
+            raise Dns_Error('truncated record data')
+        yield Dns_Record(offset, rtype, rclass, ttl, rdlength, end)
+        offset = end
+
+def parse_dns_query(message):
+    if len(message) < 12:
+        raise Dns_Error('short header')
+    ident, flags, qdcount, ancount, nscount, arcount = \
+        struct.unpack('!HHHHHH', message[:12])
+    if flags & DNS_FLAG_QR or qdcount != 1:
+        raise Dns_Error('not a single question query')
+    name, offset = read_dns_name(message, 12)
+    if offset + 4 > len(message):
+        raise Dns_Error('truncated question')
+    qtype, qclass = struct.unpack('!HH', message[offset:offset + 4])
+    udp_size, dnssec_ok = None, False
+    for record in iter_dns_records(message, offset + 4, ancount + nscount + arcount):
+        if record.rtype == DNS_TYPE_OPT: # RFC 6891, the class is the payload size
+            udp_size = max(record.rclass, DNS_UDP_SIZE)
+            dnssec_ok = bool(record.ttl & DNS_EDNS_DO)
+    return Dns_Query(ident, flags, name.lower(), qtype, qclass,
+        message[12:offset + 4], udp_size, dnssec_ok)
+
+def make_opt_record(query):
+    '''
+    The OPT record for a response to query, b'' if it had none.
+    '''
+    if query.udp_size is None:
+        return b''
+    return b'\x00' + struct.pack('!HHIH', DNS_TYPE_OPT, PROXY_EDNS_SIZE,
+        DNS_EDNS_DO if query.dnssec_ok else 0, 0)
+
+def make_dns_response(query, rcode, answers=b'', ancount=0, flags=None):
+    if flags is None:
+        flags = DNS_FLAG_QR | (query.flags & DNS_FLAGS_COPIED) | DNS_FLAG_RA | rcode
+    return struct.pack('!HHHHHH', query.ident, flags, 1, ancount, 0, 0) + \
+        query.question + answers
+
+def make_blocked_response(query, dest_ip=None, ttl=PROXY_BLOCKED_TTL):
+    '''
+    NXDOMAIN, or dest_ip as the answer to A/AAAA queries (NODATA for other
+    types) like dnsmasq's address=/.domain/dest_ip.
+    '''
+    if not dest_ip:
+        return make_dns_response(query, DNS_RCODE_NXDOMAIN)
+    import socket
+    if ':' in dest_ip:
+        rtype, family = DNS_TYPE_AAAA, socket.AF_INET6
+    else:
+        rtype, family = DNS_TYPE_A, socket.AF_INET
+    if query.qtype != rtype:
+        return make_dns_response(query, DNS_RCODE_NOERROR)
+    rdata = socket.inet_pton(family, dest_ip)
+    answer = struct.pack('!HHHIH', 0xc00c, rtype, query.qclass, ttl,
+        len(rdata)) + rdata # 0xc00c points at the question name
+    return make_dns_response(query, DNS_RCODE_NOERROR, answer, ancount=1)
+
+def parse_dns_response_ttls(response):
+    '''
+    Returns (offset of the first record, [offsets of TTL fields],
+    seconds the response may be cached for, offset of its OPT record or
+    None) or None if it should not be cached. The OPT record, which
+    belongs to the query's sender, must be the last record.
+    '''
+    ident, flags, qdcount, ancount, nscount, arcount = \
+        struct.unpack('!HHHHHH', response[:12])
+    rcode = flags & 0x000f
+    if flags & DNS_FLAG_TC or rcode not in (DNS_RCODE_NOERROR, DNS_RCODE_NXDOMAIN):
+        return None
+    offset = 12
+    for _ in range(qdcount):
+        offset = read_dns_name(response, offset)[1] + 4
+    records_offset = offset
+    ttl_offsets = []
+    answer_ttls = []
+    negative_ttl = None
+    opt_offset = None
+    for index, record in enumerate(iter_dns_records(response, records_offset,
+            ancount + nscount + arcount)):
+        if opt_offset is not None:
+            return None # stripping the OPT record would move this one
+        if record.rtype == DNS_TYPE_OPT: # OPT abuses the TTL field for flags
+            opt_offset = offset
+        else:
+            ttl_offsets.append(record.offset + 4)
+            if index < ancount:
+                answer_ttls.append(record.ttl)
+            elif index < ancount + nscount and record.rtype == DNS_TYPE_SOA:
+                soa_minimum = struct.unpack('!I', response[record.end - 4:record.end])[0]
+                negative_ttl = min(record.ttl, soa_minimum)
+        offset = record.end
+    if answer_ttls and rcode == DNS_RCODE_NOERROR:
+        cache_ttl = min(answer_ttls)
+    elif negative_ttl is not None:
+        cache_ttl = negative_ttl
+    else:
+        cache_ttl = PROXY_NEGATIVE_TTL
+    return records_offset, ttl_offsets, cache_ttl, opt_offset
+
+class Dns_Cache():
+    '''
+    Bounded LRU cache of upstream responses, positive and negative, keyed
+    by (name, qtype, qclass, DO bit). Hits are re-addressed to the asking
+    client with the remaining TTL patched into every record. The upstream
+    OPT record is dropped, hits get one built from the asking client's
+    query, or none if it had none (RFC 6891). A hit larger than a UDP
+    client can take is answered with TC set and no records, it retries
+    over TCP.
+    '''
+    def __init__(self, max_entries=PROXY_CACHE_SIZE, max_ttl=PROXY_MAX_TTL):
+        self.max_entries = max_entries
+        self.max_ttl = max_ttl
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def clear(self):
+        self.entries.clear()
+
+    def put(self, query, response, now=None):
+        if self.max_entries <= 0:
+            return
+        try:
+            parsed = parse_dns_response_ttls(response)
+        except (Dns_Error, struct.error):
+            return
+        if parsed is None:
+            return
+        records_offset, ttl_offsets, cache_ttl, opt_offset = parsed
+        cache_ttl = min(cache_ttl, self.max_ttl)
+        if cache_ttl <= 0:
+            return
+        now = time.time() if now is None else now
+        key = (query.name, query.qtype, query.qclass, query.dnssec_ok)
+        arcount = struct.unpack('!H', response[10:12])[0]
+        if opt_offset is not None:
+            arcount -= 1
+        flags_and_counts = response[2:4] + response[6:10] + struct.pack('!H', arcount)
+        shifted_ttl_offsets = [ttl_offset - records_offset for ttl_offset in ttl_offsets]
+        self.entries[key] = (now + cache_ttl, flags_and_counts,
+            response[records_offset:opt_offset], shifted_ttl_offsets)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def get(self, query, now=None, tcp=False):
+        key = (query.name, query.qtype, query.qclass, query.dnssec_ok)
+        entry = self.entries.get(key)
+        now = time.time() if now is None else now
+        if entry is None or entry[0] <= now:
+            if entry is not None:
+                del self.entries[key]
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        expires, flags_and_counts, records, ttl_offsets = entry
+        opt = make_opt_record(query)
+        flags, ancount, nscount, arcount = struct.unpack('!HHHH', flags_and_counts)
+        size = 12 + len(query.question) + len(records) + len(opt)
+        if not tcp and size > (query.udp_size or DNS_UDP_SIZE):
+            return struct.pack('!HHHHHH', query.ident, flags | DNS_FLAG_TC, 1, 0, 0,
+                len(opt) and 1) + query.question + opt
+        remaining = max(1, int(expires - now))
+        records = bytearray(records)
+        for ttl_offset in ttl_offsets:
+            struct.pack_into('!I', records, ttl_offset, remaining)
+        return struct.pack('!HHHHHH', query.ident, flags, 1, ancount, nscount,
+            arcount + (len(opt) and 1)) + query.question + bytes(records) + opt
+
+class Suffix_Matcher():
+    '''
+    Hierarchical rules for the DNS proxy: the most specific blocked or
+    allowed domain covering a name decides, so a whitelisted
+    mail.example.com resolves even though example.com is blocked. When a
+    domain is in both it is blocked, the local blacklist was re-added to
+    blocked after the whitelist was subtracted. Without covers_subdomains
+    only the blocked names themselves are, like the lines of /etc/hosts.
+    '''
+    def __init__(self, blocked, allowed=(), covers_subdomains=True):
+        self.blocked = Domain_Store(blocked)
+        self.allowed = Domain_Store(allowed)
+        self.covers_subdomains = covers_subdomains
+
+    def blocking_rule(self, name):
+        if not self.covers_subdomains:
+            return name if name in self.blocked else None
+        labels = name.split(b'.')
+        for index in range(len(labels)):
+            candidate = b'.'.join(labels[index:])
+            if candidate in self.blocked:
+                return candidate
+            if candidate in self.allowed:
+                return None
+        return None
+
+def parse_host_port(value, default_port):
+    '''
+    host, host:port, [v6addr] or [v6addr]:port -> (host, port)
+    '''
+    if value.startswith('['):
+        host, _, port = value[1:].partition(']')
+        port = port.lstrip(':')
+    elif value.count(':') == 1:
+        host, _, port = value.partition(':')
+    else:
+        host, port = value, ''
+    return host, int(port) if port else default_port
+
+class Datagram_Protocol():
+    '''
+    What the event loop calls on an asyncio.DatagramProtocol, so the
+    protocols below can be defined without importing asyncio for every
+    command.
+    '''
+    def connection_made(self, transport):
+        pass
+
+    def connection_lost(self, exc):
+        pass
+
+    def pause_writing(self):
+        pass
+
+    def resume_writing(self):
+        pass
+
+    def datagram_received(self, data, addr):
+        pass
+
+    def error_received(self, exc):
+        pass
+
+# asyncio.TimeoutError is one of these, asyncio.IncompleteReadError an EOFError
+DNS_FORWARD_ERRORS = (OSError, EOFError, FuturesTimeoutError)
+
+class Upstream_Udp_Protocol(Datagram_Protocol):
+    def __init__(self, ident, future):
+        self.ident = ident
+        self.future = future
+
+    def datagram_received(self, data, addr):
+        if data[:2] == self.ident and not self.future.done():
+            self.future.set_result(data)
+
+    def error_received(self, exc):
+        if not self.future.done():
+            self.future.set_exception(exc)
+
+async def forward_dns_udp(message, upstream, timeout=PROXY_TIMEOUT):
+    import asyncio
+    loop = asyncio.get_event_loop()
+    future = loop.create_future()
+    transport, _ = await loop.create_datagram_endpoint(
+        lambda: Upstream_Udp_Protocol(message[:2], future), remote_addr=upstream)
+    try:
+        transport.sendto(message)
+        return await asyncio.wait_for(future, timeout)
+    finally:
+        transport.close()
+
+async def forward_dns_tcp(message, upstream, timeout=PROXY_TIMEOUT):
+    import asyncio
+    reader, writer = await asyncio.wait_for(asyncio.open_connection(*upstream), timeout)
+    try:
+        writer.write(struct.pack('!H', len(message)) + message)
+        length = struct.unpack('!H', await asyncio.wait_for(reader.readexactly(2), timeout))[0]
+        return await asyncio.wait_for(reader.readexactly(length), timeout)
+    finally:
+        writer.close()
+
+class Dns_Proxy():
+    '''
+    Answers blocked names itself and forwards everything else to upstream,
+    over the transport the client used. matcher can be swapped while
+    serving, see reload in serve().
+    '''
+    def __init__(self, matcher, upstream, dest_ip=None, cache=None,
+            timeout=PROXY_TIMEOUT):
+        self.matcher = matcher
+        self.upstream = upstream
+        self.dest_ip = dest_ip
+        self.cache = Dns_Cache() if cache is None else cache
+        self.timeout = timeout
+        self.blocked = 0
+        self.forwarded = 0
+
+    async def resolve(self, message, tcp=False):
+        try:
+            query = parse_dns_query(message)
+        except Dns_Error:
+            if len(message) >= 12 and not message[2] & 0x80:
+                return message[:2] + struct.pack('!HHHHH',
+                    DNS_FLAG_QR | DNS_RCODE_FORMERR, 0, 0, 0, 0)
+            return None # not worth answering
+        rule = self.matcher.blocking_rule(query.name)
+        if rule is not None:
+            eprint("Blocked: %s (%s)", query.name, rule, level=LOG['DEBUG'])
+            self.blocked += 1
+            return make_blocked_response(query, self.dest_ip)
+        response = self.cache.get(query, tcp=tcp)
+        if response is not None:
+            return response
+        self.forwarded += 1
+        try:
+            if tcp:
+                response = await forward_dns_tcp(message, self.upstream, self.timeout)
+            else:
+                response = await forward_dns_udp(message, self.upstream, self.timeout)
+        except DNS_FORWARD_ERRORS as e:
+            eprint("Upstream %s failed for %s: %r", self.upstream, query.name, e,
+                level=LOG['WARNING'])
+            return make_dns_response(query, DNS_RCODE_SERVFAIL)
+        self.cache.put(query, response)
+        return response
+
+    async def handle_tcp(self, reader, writer):
+        import asyncio
+        try:
+            while True:
+                length = struct.unpack('!H', await asyncio.wait_for(
+                    reader.readexactly(2), self.timeout * 10))[0]
+                message = await asyncio.wait_for(reader.readexactly(length),
+                    self.timeout * 10)
+                response = await self.resolve(message, tcp=True)
+                if response is None:
+                    break
+                writer.write(struct.pack('!H', len(response)) + response)
+                await writer.drain()
+        except DNS_FORWARD_ERRORS:
+            pass
+        finally:
+            writer.close()
+
+class Dns_Udp_Protocol(Datagram_Protocol):
+    def __init__(self, proxy):
+        self.proxy = proxy
+        self.transport = None
+        self.tasks = set() # the event loop only keeps weak references to them
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        import asyncio
+        task = asyncio.ensure_future(self.answer(data, addr))
+        self.tasks.add(task)
+        task.add_done_callback(self.answered)
+
+    def answered(self, task):
+        self.tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            eprint("ERROR: answering a query failed: %r", task.exception(),
+                level=LOG['ERROR'])
+
+    async def answer(self, data, addr):
+        response = await self.proxy.resolve(data)
+        if response is not None:
+            self.transport.sendto(response, addr)
+
+async def start_dns_proxy(proxy, listen=PROXY_LISTEN, port=PROXY_PORT):
+    '''
+    Returns (udp transport, tcp server) listening on listen:port.
+    '''
+    import asyncio
+    loop = asyncio.get_event_loop()
+    udp_transport, _ = await loop.create_datagram_endpoint(
+        lambda: Dns_Udp_Protocol(proxy), local_addr=(listen, port))
+    tcp_server = await asyncio.start_server(proxy.handle_tcp, listen, port)
+    return udp_transport, tcp_server
+
+def make_suffix_matcher(config):
+    '''
+    The rules are not pruned: a blocked name under a whitelisted subdomain
+    of a blocked domain needs its own rule to stay blocked.
+    '''
+    state = compile_rules(config, prune=False)
+    eprint("Serving %d blocked and %d allowed rules.", len(state.domains_combined),
+        len(state.domains_whitelist), level=LOG['INFO'])
+    return Suffix_Matcher(state.domains_combined, state.domains_whitelist,
+        covers_subdomains=OUTPUT_WRITERS[config.mode].covers_subdomains)
+
+class Inotify_Watcher():
+    '''
+    Waits for changes to paths with inotify(7) through ctypes. The parent
+    directories are watched rather than the files since editors (and
+    configure) replace files by renaming over them.
+    '''
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM  = 0x00000040
+    IN_MOVED_TO    = 0x00000080
+    IN_CREATE      = 0x00000100
+    IN_DELETE      = 0x00000200
+    EVENT = struct.Struct('iIII') # wd, mask, cookie, len, then len bytes of name
+
+    def __init__(self, paths, settle=WATCH_SETTLE):
+        self.paths = set(paths)
+        self.settle = settle
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        mask = self.IN_CLOSE_WRITE | self.IN_MOVED_FROM | self.IN_MOVED_TO | \
+            self.IN_CREATE | self.IN_DELETE
+        self.directories = {}
+        for directory in sorted(set(map(os.path.dirname, self.paths))):
+            wd = libc.inotify_add_watch(self.fd, os.fsencode(directory), mask)
+            if wd < 0:
+                errno = ctypes.get_errno()
+                os.close(self.fd)
+                raise OSError(errno, os.strerror(errno), directory)
+            self.directories[wd] = directory
+
+    def read_events(self):
+        changed = set()
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                return changed
+            offset = 0
+            while offset < len(data):
+                wd, _, _, length = self.EVENT.unpack_from(data, offset)
+                offset += self.EVENT.size
+                name = os.fsdecode(data[offset:offset + length].rstrip(b'\x00'))
+                offset += length
+                path = os.path.join(self.directories.get(wd, ''), name)
+                if path in self.paths:
+                    changed.add(path)
+
+    def wait(self, timeout):
+        '''
+        Returns the set of paths that changed, empty after timeout seconds.
+        '''
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return set()
+        time.sleep(self.settle)
+        return self.read_events()
+
+    def close(self):
+        os.close(self.fd)
+
+class Polling_Watcher():
+    '''
+    stat() based fallback for Inotify_Watcher.
+    '''
+    def __init__(self, paths, interval=WATCH_POLL_INTERVAL):
+        self.paths = list(paths)
+        self.interval = interval
+        self.stats = self.stat_paths()
+
+    def stat_paths(self):
+        stats = {}
+        for path in self.paths:
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                stats[path] = None
+            else:
+                stats[path] = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        return stats
+
+    def wait(self, timeout):
+        deadline = time.monotonic() + timeout
+        while True:
+            stats = self.stat_paths()
+            changed = set(path for path in self.paths if stats[path] != self.stats[path])
+            self.stats = stats
+            remaining = deadline - time.monotonic()
+            if changed or remaining <= 0:
+                return changed
+            time.sleep(min(self.interval, remaining))
+
+    def close(self):
+        pass
+
+def make_file_watcher(paths, poll=False):
+    if not poll:
+        try:
+            return Inotify_Watcher(paths)
+        except (OSError, AttributeError) as e: # AttributeError: libc without inotify
+            eprint("inotify is not available (%s), polling every %s seconds.", e,
+                WATCH_POLL_INTERVAL, level=LOG['INFO'])
+    return Polling_Watcher(paths)
+
 OUTPUT_FILE_HELP = '(for testing) output file (defaults to ' + OUTPUT_FILE_PATH + ')'
 DNSMASQ_CONFIG_HELP = 'dnsmasq config file (defaults to ' + DNSMASQ_CONFIG_FILE + ')'
 BACKUP_HELP = 'backup output file before overwriting'
@@ -545,13 +2499,41 @@ whitelists(s) defaults to:''' + CUSTOM_WHITELIST.replace(os.path.expanduser('~')
 BLOCK_AT_PSL_HELP = 'strips subdomains, for example: analytics.google.com -> google.com' + \
     ' (must manually whitelist inadvertently blocked domains)'
 VERBOSE_HELP = 'print debug information to stderr'
-NO_CACHE_HELP = 'do not cache --source files as sha1(url) to ~/.dnsgate/cache/'
+NO_CACHE_HELP = 'do not cache sources or their parsed domains in ' + SOURCE_CACHE_DIRECTORY
 CACHE_EXPIRE_HELP = 'seconds until cached remote sources are re-downloaded ' + \
     '(defaults to ' + str(CACHE_EXPIRE / 3600) + ' hours)'
+MAX_STALE_HELP = 'seconds since a cached source was last fetched or ' + \
+    'revalidated during which it is still used if the source cannot be ' + \
+    'fetched (defaults to ' + str(SOURCE_MAX_STALE / 3600) + ' hours)'
+STALE_WHILE_REVALIDATE_HELP = 'use expired cached sources within --max-stale ' + \
+    'right away and re-fetch them after the output is written, for the next run'
+WORKERS_HELP = 'number of remote sources to fetch concurrently ' + \
+    '(defaults to ' + str(FETCH_WORKERS) + ')'
+PER_HOST_HELP = 'maximum concurrent fetches against a single host ' + \
+    '(defaults to ' + str(FETCH_PER_HOST) + ')'
+NO_PSL_CACHE_HELP = 'do not load or save PSL lookups in ' + PSL_CACHE
+MAX_SOURCE_SIZE_HELP = 'skip remote sources larger than this many bytes ' + \
+    'after decompression (defaults to ' + str(SOURCE_MAX_BYTES) + ')'
+JOBS_HELP = 'processes to parse, validate and strip large sources to psl ' + \
+    'domains with (defaults to 1, all in this process)'
+METRICS_JSON_HELP = 'write per stage and per source timings and counters to this file'
+PROFILE_HELP = 'write cProfile stats to this file (read with python -m pstats), ' + \
+    'sources are fetched one at a time so that their download and parse are in them'
+RETRIES_HELP = 'times to retry a source after a connection error or a ' + \
+    ', '.join(map(str, FETCH_RETRY_STATUSES)) + ' response (defaults to ' + \
+    str(FETCH_RETRIES) + ')'
+RETRY_BACKOFF_HELP = 'backoff factor in seconds between retries of a source, ' + \
+    'the wait doubles on each further retry (defaults to ' + \
+    str(FETCH_RETRY_BACKOFF) + ')'
+PROXY_HELP = 'http(s) proxy URL to fetch remote sources through ' + \
+    '(defaults to the HTTP_PROXY and HTTPS_PROXY environment variables)'
+DEADLINE_HELP = 'seconds to wait for all remote sources before skipping ' + \
+    'the unfinished ones (defaults to ' + str(FETCH_DEADLINE) + ')'
 DEST_IP_HELP = 'IP to redirect blocked connections to (defaults to ' + \
-    '127.0.0.1 in hosts mode, specifying this in dnsmasq mode causes ' + \
-    'lookups to resolve rather than return NXDOMAIN)'
-NO_RESTART_DNSMASQ_HELP = 'do not restart the dnsmasq service'
+    HOSTS_DEST_IP.decode('ascii') + ' in hosts mode, specifying this in ' + \
+    'dnsmasq mode causes lookups to resolve rather than return NXDOMAIN)'
+NO_RESTART_DNSMASQ_HELP = 'do not restart the dnsmasq service ' + \
+    '(or reload bind/unbound in rpz/unbound mode)'
 BLACKLIST_HELP = 'Add domain(s) to ' + CUSTOM_BLACKLIST
 WHITELIST_HELP = 'Add domain(s) to ' + CUSTOM_WHITELIST
 DISABLE_HELP = 'Disable ' + OUTPUT_FILE_PATH
@@ -562,6 +2544,48 @@ CONFIGURE_HELP = '''Write ''' + CONFIG_FILE + '''
 [SOURCES] are the ''' + SOURCES_HELP
 GENERATE_HELP = 'Create ' + OUTPUT_FILE_PATH
 BLOCKALL_HELP = 'return NXDOMAIN on _ALL_ domains'
+CHECK_HELP = '''Show whether each DOMAIN is blocked, by which rule and which
+sources or local lists that rule came from. Reads the index the last generate
+wrote to ''' + RULE_INDEX + ''', nothing is fetched or compiled.'''
+SERVE_HELP = '''Run a filtering DNS proxy instead of using dnsmasq
+\b
+
+Blocked names get NXDOMAIN (or the configured dest_ip), everything else is
+forwarded to --upstream. The most specific whitelist or blacklist rule for a
+name wins, in hosts mode only the names listed are blocked, not their
+subdomains. SIGHUP rebuilds the rules without dropping the listening sockets.'''
+LISTEN_HELP = 'address to listen on (defaults to ' + PROXY_LISTEN + ')'
+PORT_HELP = 'UDP and TCP port to listen on (defaults to ' + str(PROXY_PORT) + ')'
+UPSTREAM_HELP = 'HOST[:PORT] of the resolver to forward to (defaults to ' + \
+    PROXY_UPSTREAM + ')'
+PROXY_CACHE_SIZE_HELP = 'upstream responses to cache, 0 disables the cache ' + \
+    '(defaults to ' + str(PROXY_CACHE_SIZE) + ')'
+MAX_TTL_HELP = 'longest time in seconds to cache an upstream response ' + \
+    '(defaults to ' + str(PROXY_MAX_TTL) + ')'
+WATCH_HELP = '''Keep the rules in memory and update ''' + OUTPUT_FILE_PATH + '''
+\b
+
+Edits to ''' + CUSTOM_WHITELIST + ''' and ''' + CUSTOM_BLACKLIST + ''' only
+recompile the domains under the changed rules, editing ''' + CONFIG_FILE + '''
+recompiles everything. Remote sources are re-fetched every --refresh seconds.'''
+PUBLISH_HELP = '''Publish the rules the last generate compiled to DIRECTORY
+\b
+
+Writes a versioned, checksummed copy of the rules and deltas from the previous
+--keep versions, for "dnsgate pull" on other hosts. Serve DIRECTORY over HTTP
+or share it. The whitelist and blacklist of this host apply to every host.'''
+KEEP_HELP = 'earlier versions to publish deltas from (defaults to ' + \
+    str(PUBLISH_KEEP_VERSIONS) + ')'
+PULL_HELP = '''Fetch the rules "dnsgate publish" wrote to LOCATION
+\b
+
+LOCATION is an http(s) URL or a directory. Only the delta from the version
+pulled last is downloaded if one was published. The rules are written to
+''' + OUTPUT_FILE_PATH + ''' in the mode of this host, nothing is compiled.'''
+REFRESH_HELP = 'seconds between re-fetching remote sources ' + \
+    '(defaults to ' + str(CACHE_EXPIRE / 3600) + ' hours)'
+POLL_HELP = 'poll the rule files every ' + str(WATCH_POLL_INTERVAL) + \
+    ' seconds instead of using inotify'
 
 # https://github.com/mitsuhiko/click/issues/441
 CONTEXT_SETTINGS = dict(help_option_names=['--help'],
@@ -582,82 +2606,104 @@ def dnsgate(ctx, no_restart_dnsmasq, backup):
     remote DNS blacklists. Use \"dnsgate (command) --help\"
     for more information.
     """
-    config = configparser.ConfigParser()
     if 'dnsgate configure' not in ' '.join(sys.argv):
         if 'dnsgate.py configure' not in ' '.join(sys.argv):
-            try:
-                with open(CONFIG_FILE, 'r') as cf:
-                    config.read_file(cf)
-            except FileNotFoundError:
-                eprint("No configuration file found, run " +
-                    "\"dnsgate configure --help\". Exiting.", level=LOG['ERROR'])
-                quit(1)
+            ctx.obj = read_config_file(no_restart_dnsmasq=no_restart_dnsmasq,
+                backup=backup)
 
-            mode = config['DEFAULT']['mode']
+def read_config_file(no_restart_dnsmasq=False, backup=False):
+    '''
+    Returns a Dnsgate_Config from CONFIG_FILE, quits if it is unusable.
+    '''
+    config = configparser.ConfigParser()
+    try:
+        with open(CONFIG_FILE, 'r') as cf:
+            config.read_file(cf)
+    except FileNotFoundError:
+        eprint("No configuration file found, run " +
+            "\"dnsgate configure --help\". Exiting.", level=LOG['ERROR'])
+        quit(1)
 
-            try:
-                output_path = config['DEFAULT']['output']
-            except KeyError:
-                eprint('ERROR: ' + CONFIG_FILE + ' has no "output" defined. ' +
-                    "run 'dnsgate configure --help' to fix. Exiting.",
-                    level=LOG['ERROR'])
-                quit(1)
-            assert isinstance(output_path, str)
-            if not os.path.exists(os.path.dirname(output_path)):
-                eprint("ERROR: dnsgate is configured for 'mode = dnsmasq' in " +
-                    CONFIG_FILE + " but dnsmasq_config_file is not set. " +
-                    "run 'dnsgate configure --help' to fix. Exiting.",
-                    level=LOG['ERROR'])
+    mode = config['DEFAULT']['mode']
 
-                quit(1)
+    try:
+        output_path = config['DEFAULT']['output']
+    except KeyError:
+        eprint('ERROR: ' + CONFIG_FILE + ' has no "output" defined. ' +
+            "run 'dnsgate configure --help' to fix. Exiting.",
+            level=LOG['ERROR'])
+        quit(1)
+    assert isinstance(output_path, str)
+    if not os.path.exists(os.path.dirname(output_path)):
+        eprint("ERROR: dnsgate is configured for 'mode = dnsmasq' in " +
+            CONFIG_FILE + " but dnsmasq_config_file is not set. " +
+            "run 'dnsgate configure --help' to fix. Exiting.",
+            level=LOG['ERROR'])
 
-            block_at_psl = config['DEFAULT'].getboolean('block_at_psl')
-            dest_ip = config['DEFAULT']['dest_ip'] # todo validate ip or False/None
-            if dest_ip == 'False':
-                dest_ip = None
-            sources = ast.literal_eval(config['DEFAULT']['sources']) # configparser has no .getlist()?
-            if mode == 'dnsmasq':
-                try:
-                    dnsmasq_config_file = \
-                        click.open_file(config['DEFAULT']['dnsmasq_config_file'], 'w',
-                            atomic=True, lazy=True)
-                    dnsmasq_config_file.close() # it exists and is writeable
-                except KeyError:
-                    eprint("ERROR: dnsgate is configured for 'mode = dnsmasq' in " +
-                        CONFIG_FILE + " but dnsmasq_config_file is not set. " +
-                        "run 'dnsgate configure --help' to fix. Exiting.",
-                        level=LOG['ERROR'])
-                    quit(1)
+        quit(1)
 
-                ctx.obj = Dnsgate_Config(mode=mode, block_at_psl=block_at_psl,
-                    dest_ip=dest_ip, no_restart_dnsmasq=no_restart_dnsmasq,
-                    dnsmasq_config_file=dnsmasq_config_file, backup=backup,
-                    sources=sources, output=output_path)
-            else:
-                if not dest_ip:
-                    dest_ip = '0.0.0.0'
-                ctx.obj = Dnsgate_Config(mode=mode, block_at_psl=block_at_psl,
-                    dest_ip=dest_ip, no_restart_dnsmasq=no_restart_dnsmasq,
-                    backup=backup, sources=sources, output=output_path)
+    block_at_psl = config['DEFAULT'].getboolean('block_at_psl')
+    dest_ip = config['DEFAULT']['dest_ip'] # todo validate ip or False/None
+    if dest_ip == 'False':
+        dest_ip = None
+    sources = ast.literal_eval(config['DEFAULT']['sources']) # configparser has no .getlist()?
+    if mode == 'dnsmasq':
+        try:
+            dnsmasq_config_file = \
+                click.open_file(config['DEFAULT']['dnsmasq_config_file'], 'w',
+                    atomic=True, lazy=True)
+            dnsmasq_config_file.close() # it exists and is writeable
+        except KeyError:
+            eprint("ERROR: dnsgate is configured for 'mode = dnsmasq' in " +
+                CONFIG_FILE + " but dnsmasq_config_file is not set. " +
+                "run 'dnsgate configure --help' to fix. Exiting.",
+                level=LOG['ERROR'])
+            quit(1)
+
+        dnsgate_config = Dnsgate_Config(mode=mode, block_at_psl=block_at_psl,
+            dest_ip=dest_ip, no_restart_dnsmasq=no_restart_dnsmasq,
+            dnsmasq_config_file=dnsmasq_config_file, backup=backup,
+            sources=sources, output=output_path)
+    else:
+        dnsgate_config = Dnsgate_Config(mode=mode, block_at_psl=block_at_psl,
+            dest_ip=dest_ip, no_restart_dnsmasq=no_restart_dnsmasq,
+            backup=backup, sources=sources, output=output_path)
 
-            os.makedirs(CACHE_DIRECTORY, exist_ok=True)
+    os.makedirs(CACHE_DIRECTORY, exist_ok=True)
+    return dnsgate_config
 
 
 @dnsgate.command(help=WHITELIST_HELP)
 @click.argument('domains', required=True, nargs=-1)
-def whitelist(domains):
+@click.pass_obj
+def whitelist(config, domains):
+    domains_whitelist = read_local_whitelist(config)
     for domain in domains:
-        append_to_local_rule_file(CUSTOM_WHITELIST, domain)
-    context = click.get_current_context()
-    context.invoke(generate)
+        append_to_local_rule_file(CUSTOM_WHITELIST, domain, domains_whitelist)
+    update_rules(config, domains_whitelist, read_local_blacklist())
 
 @dnsgate.command(help=BLACKLIST_HELP)
 @click.argument('domains', required=True, nargs=-1)
-def blacklist(domains):
+@click.pass_obj
+def blacklist(config, domains):
+    domains_blacklist = read_local_blacklist()
     for domain in domains:
-        append_to_local_rule_file(CUSTOM_BLACKLIST, domain)
-    context = click.get_current_context()
-    context.invoke(generate)
+        append_to_local_rule_file(CUSTOM_BLACKLIST, domain, domains_blacklist)
+    update_rules(config, read_local_whitelist(config), domains_blacklist)
+
+def update_rules(config, domains_whitelist, domains_blacklist):
+    '''
+    Patch the rules the last generate saved in RULE_STATE with the local
+    lists instead of compiling everything again. Runs generate if there is
+    no usable state.
+    '''
+    state = load_rule_state(config)
+    if state is None:
+        click.get_current_context().invoke(generate)
+        return
+    state = patch_local_rules(config, state, domains_whitelist, domains_blacklist)
+    publish_rules(config, state)
+    save_rule_state(config, state)
 
 @dnsgate.command(help=INSTALL_HELP_HELP)
 @click.pass_obj
@@ -666,6 +2712,10 @@ def install_help(config):
         dnsmasq_install_help(DNSMASQ_CONFIG_FILE)
     elif config.mode == 'hosts':
         hosts_install_help()
+    elif config.mode == 'rpz':
+        rpz_install_help(config.output)
+    elif config.mode == 'unbound':
+        unbound_install_help(config.output)
     quit(0)
 
 @dnsgate.command(help=ENABLE_HELP)
@@ -733,40 +2783,175 @@ def disable(config):
 @click.pass_obj
 def blockall(config):
     if config.mode == 'dnsmasq':
-        domains_combined = set(['.'])
-        write_output_file(domains_combined)
+        output_written = write_output_file(None, block_all=True)
+        if output_written and not config.no_restart_dnsmasq:
+            get_output_writer(config).reload()
     else:
         eprint("ERROR: blockall is only available with --mode dnsmasq. Exiting.",
             level=LOG['ERROR'])
         quit(1)
 
+class Output_Writer():
+    '''
+    Renders the final rules in one output format. Subclasses implement
+    rule(domain) -> bytes, rules() joins those into large chunks so the
+    output is written straight from the sorted domain iterator.
+    '''
+    comment = b'#'
+    covers_subdomains = True # a rule for a domain also blocks its subdomains
+    reload_command = None    # run after the output changed
+
+    def __init__(self, dest_ip=None):
+        self.dest_ip = dest_ip
+        self.dest_ip_bytes = dest_ip.encode('ascii') if dest_ip else None
+
+    def preamble(self):
+        '''
+        Written after the dnsgate header, not part of the content digest.
+        '''
+        return b''
+
+    def rule(self, domain):
+        raise NotImplementedError
+
+    def rules(self, domains):
+        chunk = []
+        chunk_size = 0
+        rule = self.rule
+        for domain in domains:
+            line = rule(domain)
+            chunk.append(line)
+            chunk_size += len(line)
+            if chunk_size >= OUTPUT_CHUNK_SIZE:
+                yield b''.join(chunk)
+                chunk = []
+                chunk_size = 0
+        if chunk:
+            yield b''.join(chunk)
+
+    def reload(self):
+        if self.reload_command:
+            os.system(self.reload_command + ' 1>&2')
+
+class Dnsmasq_Writer(Output_Writer):
+    def rule(self, domain):
+        if self.dest_ip_bytes:
+            return b'address=/.' + domain + b'/' + self.dest_ip_bytes + b'\n'
+        return b'server=/.' + domain + b'/\n'  # return NXDOMAIN
+
+    def block_all_rule(self):
+        '''
+        The rule for dnsgate blockall, # matches every domain.
+        '''
+        if self.dest_ip_bytes:
+            return b'address=/#/' + self.dest_ip_bytes + b'\n'
+        return b'server=/#/\n'
+
+    def reload(self):
+        restart_dnsmasq_service()
+
+class Hosts_Writer(Output_Writer):
+    covers_subdomains = False
+
+    def rule(self, domain):
+        return (self.dest_ip_bytes or HOSTS_DEST_IP) + b' ' + domain + b'\n'
+
+class Rpz_Writer(Output_Writer):
+    '''
+    BIND response policy zone, blocks the domain and *.domain.
+    '''
+    comment = b';'
+    reload_command = 'rndc reload'
+
+    def preamble(self):
+        serial = str(int(time.time())).encode('ascii')
+        return b'$TTL ' + str(RPZ_TTL).encode('ascii') + b'\n' + \
+            b'@ IN SOA localhost. root.localhost. (' + serial + \
+            b' 3600 600 86400 ' + str(RPZ_TTL).encode('ascii') + b')\n' + \
+            b'  IN NS localhost.\n\n'
+
+    def rule(self, domain):
+        if self.dest_ip_bytes:
+            rtype = b' AAAA ' if b':' in self.dest_ip_bytes else b' A '
+            action = rtype + self.dest_ip_bytes + b'\n'
+        else:
+            action = b' CNAME .\n' # NXDOMAIN
+        return domain + action + b'*.' + domain + action
+
+class Unbound_Writer(Output_Writer):
+    '''
+    unbound.conf include, local-zone covers subdomains.
+    '''
+    reload_command = 'unbound-control reload'
+
+    def preamble(self):
+        return b'server:\n'
+
+    def rule(self, domain):
+        if self.dest_ip_bytes:
+            rtype = b' AAAA ' if b':' in self.dest_ip_bytes else b' A '
+            return b'local-zone: "' + domain + b'." redirect\n' + \
+                b'local-data: "' + domain + b'.' + rtype + self.dest_ip_bytes + b'"\n'
+        return b'local-zone: "' + domain + b'." always_nxdomain\n'
+
+OUTPUT_WRITERS = collections.OrderedDict([
+    ('dnsmasq', Dnsmasq_Writer),
+    ('hosts', Hosts_Writer),
+    ('rpz', Rpz_Writer),
+    ('unbound', Unbound_Writer)])
+
+def get_output_writer(config):
+    return OUTPUT_WRITERS[config.mode](dest_ip=config.dest_ip)
+
 @click.pass_obj
-def write_output_file(config, domains_combined):
+def write_output_file(config, domains_combined, block_all=False):
+    '''
+    Returns False without touching config.output if the rules it already
+    holds are identical, True if it was (re)written, after a backup of the
+    old one with config.backup. With block_all the output is the writer's
+    block_all_rule() instead of domains_combined.
+    '''
+    writer = get_output_writer(config)
     config_dict = make_config_dict()
-
+    placeholder_digest = '0' * 40
+    header = make_output_file_header(config_dict, placeholder_digest,
+        comment=writer.comment)
+    content_digest = hashlib.sha1() # of the rules, a new header alone is no change
+    tmp_path = config.output + '.tmp.' + str(os.getpid())
+    try:
+        with open(tmp_path, 'wb') as fh:
+            fh.write(header)
+            fh.write(writer.preamble())
+            chunks = [writer.block_all_rule()] if block_all else \
+                writer.rules(domains_combined)
+            for chunk in chunks:
+                content_digest.update(chunk)
+                fh.write(chunk)
+            content_digest = content_digest.hexdigest()
+            if read_output_file_digest(config.output) == content_digest:
+                eprint("%s is unchanged, not rewriting it.", config.output,
+                    level=LOG['INFO'])
+                os.remove(tmp_path)
+                return False
+            fh.seek(header.rindex(placeholder_digest.encode('ascii')))
+            fh.write(content_digest.encode('ascii'))
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    if config.backup:
+        backup_file_if_exists(config.output)
     eprint("Writing output file: %s in %s format", config.output, config.mode, level=LOG['INFO'])
-    with click.open_file(config.output, 'wb', atomic=True, lazy=True) as fh:
-        fh.write(make_output_file_header(config_dict))
-        for domain in domains_combined:
-            if config.mode == 'dnsmasq':
-                if config.dest_ip:
-                    dnsmasq_line = 'address=/.' + domain.decode('utf8') + '/' + config.dest_ip + '\n'
-                else:
-                    dnsmasq_line = 'server=/.' + domain.decode('utf8') + '/' '\n'  # return NXDOMAIN
-                fh.write(dnsmasq_line.encode('utf8'))
-            elif config.mode == 'hosts':
-                if config.dest_ip:
-                    hosts_line = config.dest_ip + ' ' + domain.decode('utf8') + '\n'
-                else:
-                    hosts_line = '127.0.0.1' + ' ' + domain.decode('utf8') + '\n'
-                fh.write(hosts_line.encode('utf8'))
+    os.replace(tmp_path, config.output)
+    return True
 
 @dnsgate.command(help=CONFIGURE_HELP, short_help='write /etc/dnsgate/config')
 @click.argument('sources',      nargs=-1)
 @click.option('--mode',         is_flag=False,
-    type=click.Choice(['dnsmasq', 'hosts']), required=True)
+    type=click.Choice(list(OUTPUT_WRITERS)), required=True)
 @click.option('--block-at-psl', is_flag=True,  help=BLOCK_AT_PSL_HELP)
-@click.option('--dest-ip',      is_flag=False, help=DEST_IP_HELP, default=False)
+@click.option('--dest-ip',      is_flag=False, help=DEST_IP_HELP,
+    type=str, default=False)
 @click.option('--dnsmasq-config-file', is_flag=False, help=DNSMASQ_CONFIG_HELP,
     type=click.File(mode='w', atomic=True, lazy=True), default=DNSMASQ_CONFIG_FILE)
 @click.option('--output',       is_flag=False, help=OUTPUT_FILE_HELP,
@@ -821,10 +3006,305 @@ def make_config_dict(config): #todo, just cat the config file
 @click.option('--no-cache',     is_flag=True,  help=NO_CACHE_HELP)
 @click.option('--cache-expire', is_flag=False, help=CACHE_EXPIRE_HELP,
     type=int, default=CACHE_EXPIRE)
+@click.option('--max-stale',    is_flag=False, help=MAX_STALE_HELP,
+    type=click.IntRange(min=0), default=SOURCE_MAX_STALE)
+@click.option('--stale-while-revalidate', is_flag=True, help=STALE_WHILE_REVALIDATE_HELP)
+@click.option('--workers',      is_flag=False, help=WORKERS_HELP,
+    type=int, default=FETCH_WORKERS)
+@click.option('--per-host',     is_flag=False, help=PER_HOST_HELP,
+    type=int, default=FETCH_PER_HOST)
+@click.option('--deadline',     is_flag=False, help=DEADLINE_HELP,
+    type=int, default=FETCH_DEADLINE)
+@click.option('--retries',      is_flag=False, help=RETRIES_HELP,
+    type=click.IntRange(min=0), default=FETCH_RETRIES)
+@click.option('--retry-backoff', is_flag=False, help=RETRY_BACKOFF_HELP,
+    type=click.FloatRange(min=0), default=FETCH_RETRY_BACKOFF)
+@click.option('--proxy',        is_flag=False, help=PROXY_HELP, default=None)
+@click.option('--no-psl-cache', is_flag=True,  help=NO_PSL_CACHE_HELP)
+@click.option('--jobs',         is_flag=False, help=JOBS_HELP,
+    type=click.IntRange(min=1), default=1)
+@click.option('--max-source-size', is_flag=False, help=MAX_SOURCE_SIZE_HELP,
+    type=click.IntRange(min=1), default=SOURCE_MAX_BYTES)
+@click.option('--metrics-json', is_flag=False, help=METRICS_JSON_HELP,
+    type=click.Path(dir_okay=False, writable=True), default=None)
+@click.option('--profile',      is_flag=False, help=PROFILE_HELP,
+    type=click.Path(dir_okay=False, writable=True), default=None)
 @click.pass_obj
-def generate(config, no_cache, cache_expire):
-
+def generate(config, no_cache, cache_expire, max_stale, stale_while_revalidate, workers,
+        per_host, deadline, retries, retry_backoff, proxy, no_psl_cache, jobs,
+        max_source_size, metrics_json, profile):
+    METRICS.reset()
+    profiler = None
+    if profile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    fetcher = Source_Fetcher(workers=workers, per_host=per_host, retries=retries,
+        retry_backoff=retry_backoff, proxy=proxy)
+    try:
+        run_generate(config, no_cache=no_cache, cache_expire=cache_expire,
+            workers=workers, per_host=per_host, deadline=deadline,
+            no_psl_cache=no_psl_cache, jobs=jobs, max_source_size=max_source_size,
+            fetcher=fetcher, max_stale=max_stale,
+            stale_while_revalidate=stale_while_revalidate,
+            inline=profiler is not None) # cProfile only sees this thread
+    finally: # also on quit()
+        fetcher.close()
+        METRICS.finish()
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(profile)
+        if metrics_json:
+            METRICS.write_json(metrics_json)
+
+def run_generate(config, no_cache, cache_expire, workers, per_host, deadline,
+        no_psl_cache, jobs=1, max_source_size=SOURCE_MAX_BYTES, fetcher=None,
+        max_stale=SOURCE_MAX_STALE, stale_while_revalidate=False, inline=False):
     eprint('Using output file: %s', config.output, level=LOG['INFO'])
+    state = compile_rules(config, no_cache=no_cache, cache_expire=cache_expire,
+        workers=workers, per_host=per_host, deadline=deadline,
+        no_psl_cache=no_psl_cache, jobs=jobs, max_source_size=max_source_size,
+        fetcher=fetcher, max_stale=max_stale,
+        stale_while_revalidate=stale_while_revalidate, inline=inline)
+
+    if not state.domains_combined:
+        eprint("The list of domains to block is empty, nothing to do, exiting.",
+            level=LOG['INFO'])
+        quit(1)
+
+    publish_rules(config, state)
+    save_rule_state(config, state)
+
+def publish_rules(config, state):
+    '''
+    Write state.domains_combined to config.output and reload whatever
+    reads it. Returns False if the output already held these rules.
+    '''
+    METRICS.stage('write')
+    domains_combined = state.domains_combined
+    for domain in state.domains_whitelist:
+        if not OUTPUT_WRITERS[config.mode].covers_subdomains:
+            blocking_rule = domain if domain in domains_combined else None
+        else:
+            blocking_rule = domains_combined.covering_rule(domain)
+        if blocking_rule in state.domains_blacklist:
+            eprint('WARNING: %s is listed in both %s and %s, '
+                'the local blacklist always takes precedence.', domain.decode('UTF8'),
+                CUSTOM_BLACKLIST, CUSTOM_WHITELIST, level=LOG['WARNING'])
+        elif blocking_rule:
+            eprint('WARNING: %s is whitelisted but still blocked by the rule for %s.',
+                domain.decode('UTF8'), blocking_rule.decode('UTF8'), level=LOG['WARNING'])
+
+    write_rule_index(config, state)
+    output_written = write_output_file(domains_combined)
+    METRICS.count('output_written', output_written)
+    if not output_written:
+        return False # dnsmasq is already serving these rules
+
+    if not config.no_restart_dnsmasq:
+        METRICS.stage('restart')
+        get_output_writer(config).reload()
+    return True
+
+class Rule_State():
+    '''
+    What compile_rules() built: the validated remote domains before any
+    local rule was applied, the validated local lists and the final rules.
+    domains_sources keeps each source's domains apart for the rule index.
+    '''
+    def __init__(self, domains_remote, domains_whitelist, domains_blacklist,
+            domains_combined, domains_sources=None, fetched=None):
+        self.domains_remote = domains_remote         # Domain_Store
+        self.domains_whitelist = domains_whitelist   # set
+        self.domains_blacklist = domains_blacklist   # set
+        self.domains_combined = domains_combined     # Domain_Store
+        self.domains_sources = collections.OrderedDict() if domains_sources is None \
+            else domains_sources                     # url -> Domain_Store
+        self.fetched = time.time() if fetched is None else fetched
+
+def get_rule_state_key(config):
+    '''
+    A saved Rule_State can only be patched under the config it was compiled
+    with, dest_ip and output only change how the rules are written.
+    '''
+    key = [RULE_STATE_FORMAT, config.mode, str(config.block_at_psl)] + \
+        sorted(config.sources)
+    if config.block_at_psl:
+        key.append(get_psl_version())
+    return hash_str('\n'.join(key))
+
+def save_rule_state(config, state, path=RULE_STATE):
+    saved = {
+        'key': get_rule_state_key(config),
+        'fetched': state.fetched,
+        'remote': (state.domains_remote.buffer, state.domains_remote.offsets),
+        'whitelist': state.domains_whitelist,
+        'blacklist': state.domains_blacklist,
+        'combined': (state.domains_combined.buffer, state.domains_combined.offsets),
+        'sources': [(url, store.buffer, store.offsets)
+            for url, store in state.domains_sources.items()],
+        }
+    write_file_bytes_atomic(path, pickle.dumps(saved, protocol=pickle.HIGHEST_PROTOCOL))
+
+def load_rule_state(config, max_age=CACHE_EXPIRE, path=RULE_STATE):
+    '''
+    Returns the Rule_State saved by save_rule_state(), or None if it is
+    missing, from another config or its remote sources are older than max_age.
+    '''
+    try:
+        with open(path, 'rb') as fh:
+            saved = pickle.load(fh)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        eprint("WARNING: ignoring unreadable rule state %s: %s", path, e,
+            level=LOG['WARNING'])
+        return None
+    if saved.get('key') != get_rule_state_key(config):
+        eprint("%s was compiled with another configuration.", path, level=LOG['INFO'])
+        return None
+    if time.time() - saved['fetched'] > max_age:
+        eprint("%s is older than %d seconds.", path, max_age, level=LOG['INFO'])
+        return None
+    domains_sources = collections.OrderedDict((url, Domain_Store.from_packed(buffer, offsets))
+        for url, buffer, offsets in saved['sources'])
+    return Rule_State(Domain_Store.from_packed(*saved['remote']), saved['whitelist'],
+        saved['blacklist'], Domain_Store.from_packed(*saved['combined']),
+        domains_sources=domains_sources, fetched=saved['fetched'])
+
+def write_rule_table(fh, store):
+    '''
+    Write store's keys then its offsets, shifted to file positions, so a
+    reader can use the mapped file as the buffer of a Domain_Store.
+    '''
+    base = fh.tell()
+    fh.write(store.buffer)
+    fh.write(b'\x00' * (-fh.tell() % store.offsets.itemsize))
+    offsets_position = fh.tell()
+    fh.write(array.array('I', [offset + base for offset in store.offsets]).tobytes())
+    return {'count': len(store), 'offsets': offsets_position}
+
+def write_rule_index(config, state, path=RULE_INDEX):
+    '''
+    Write the final rules, the local whitelist and every source's domains
+    as Domain_Store tables that "dnsgate check" maps instead of compiling
+    anything. A JSON header at the end describes them.
+    '''
+    sources = list(state.domains_sources.items()) + \
+        [(CUSTOM_BLACKLIST, Domain_Store(state.domains_blacklist))]
+    tmp_path = make_tmp_path(path)
+    try:
+        with open(tmp_path, 'wb') as fh:
+            fh.write(RULE_INDEX_PREFIX.pack(RULE_INDEX_MAGIC, 0, 0))
+            header = {
+                'format': RULE_INDEX_FORMAT,
+                'byteorder': sys.byteorder,
+                'fetched': state.fetched,
+                'written': time.time(),
+                'mode': config.mode,
+                'block_at_psl': config.block_at_psl,
+                'covers_subdomains': OUTPUT_WRITERS[config.mode].covers_subdomains,
+                'output': config.output,
+                'rules': write_rule_table(fh, state.domains_combined),
+                'whitelist': write_rule_table(fh, Domain_Store(state.domains_whitelist)),
+                'sources': [dict(write_rule_table(fh, store), name=name)
+                    for name, store in sources],
+                }
+            header_bytes = json.dumps(header, sort_keys=True).encode('utf8')
+            header_offset = fh.tell()
+            fh.write(header_bytes)
+            fh.seek(0)
+            fh.write(RULE_INDEX_PREFIX.pack(RULE_INDEX_MAGIC, header_offset,
+                len(header_bytes)))
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    os.replace(tmp_path, path)
+
+class Rule_Index():
+    '''
+    Read only view of the file write_rule_index() wrote. The tables are
+    Domain_Stores over the memory mapped file, nothing is copied or
+    parsed until a key is compared.
+    '''
+    def __init__(self, path=RULE_INDEX):
+        with open(path, 'rb') as fh:
+            self.mapped = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, header_offset, header_size = RULE_INDEX_PREFIX.unpack_from(self.mapped)
+        if magic != RULE_INDEX_MAGIC:
+            raise ValueError(path + ' is not a dnsgate rule index')
+        self.header = json.loads(
+            self.mapped[header_offset:header_offset + header_size].decode('utf8'))
+        if self.header['format'] != RULE_INDEX_FORMAT or \
+                self.header['byteorder'] != sys.byteorder:
+            raise ValueError(path + ' was written by another version of dnsgate')
+        self.view = memoryview(self.mapped)
+        self.covers_subdomains = self.header['covers_subdomains']
+        self.rules = self.table(self.header['rules'])
+        self.whitelist = self.table(self.header['whitelist'])
+        self.sources = [(source['name'], self.table(source))
+            for source in self.header['sources']]
+
+    def table(self, entry):
+        offsets = self.view[entry['offsets']:entry['offsets'] + 4 * (entry['count'] + 1)]
+        return Domain_Store.from_packed(self.mapped, offsets.cast('I'))
+
+    def blocking_rule(self, domain):
+        if self.covers_subdomains:
+            return self.rules.covering_rule(domain)
+        return domain if domain in self.rules else None
+
+    def listed_by(self, domain, rule):
+        '''
+        Yield (source, listed domain) for every source behind rule, or if
+        domain is not blocked, every source that lists domain itself.
+        '''
+        for name, table in self.sources:
+            if rule is None or not self.covers_subdomains:
+                if (rule or domain) in table:
+                    yield name, rule or domain
+            else:
+                start, end = table.subtree_range(rule)
+                if start < end: # rule itself sorts first
+                    yield name, store_key_to_domain(table.key(start))
+
+def compile_rules(config, no_cache=False, cache_expire=CACHE_EXPIRE,
+        workers=FETCH_WORKERS, per_host=FETCH_PER_HOST, deadline=FETCH_DEADLINE,
+        no_psl_cache=False, jobs=1, max_source_size=SOURCE_MAX_BYTES, fetcher=None,
+        max_stale=SOURCE_MAX_STALE, stale_while_revalidate=False, prune=True,
+        inline=False):
+    '''
+    Fetch config.sources and apply the local whitelist and blacklist.
+    Returns a Rule_State, see apply_local_rules() for prune and
+    fetch_sources() for inline.
+    '''
+    METRICS.stage('read_whitelist')
+    domains_whitelist = read_local_whitelist(config)
+    pool = make_process_pool(jobs)
+    try:
+        domains_remote, domains_sources = fetch_remote_rules(config, no_cache=no_cache,
+            cache_expire=cache_expire, workers=workers, per_host=per_host,
+            deadline=deadline, pool=pool, max_source_size=max_source_size,
+            fetcher=fetcher, max_stale=max_stale,
+            stale_while_revalidate=stale_while_revalidate, inline=inline)
+        METRICS.count('whitelist_domains', len(domains_whitelist))
+        METRICS.stage('read_blacklist')
+        domains_blacklist = read_local_blacklist()
+        METRICS.count('blacklist_domains', len(domains_blacklist))
+        domains_combined = apply_local_rules(config, domains_remote, domains_whitelist,
+            domains_blacklist, no_psl_cache=no_psl_cache, pool=pool, prune=prune)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    # Domain_Store iterates sorted by subdomain and grouped by TLD
+    eprint('Final blacklisted domain count: %d', len(domains_combined),
+        level=LOG['INFO'])
+    METRICS.count('final_domains', len(domains_combined))
+    return Rule_State(domains_remote, domains_whitelist, domains_blacklist,
+        domains_combined, domains_sources=domains_sources)
+
+def read_local_whitelist(config):
     whitelist_file = os.path.abspath(CUSTOM_WHITELIST)
     try:
         domains_whitelist = extract_domain_set_from_dnsgate_format_file(whitelist_file)
@@ -846,29 +3326,64 @@ def generate(config, no_cache, cache_expire):
                 CONFIG_FILE + ' and 0 domains were obtained from %s. ' +
                 'If you get "Domain Not Found" errors, use "dnsgate whitelist --help"',
                 CUSTOM_WHITELIST, level=LOG['WARNING'])
+    return domains_whitelist
 
-    domains_combined_orig = set()   # domains from all sources, combined
+def read_local_blacklist():
+    blacklist_file = os.path.abspath(CUSTOM_BLACKLIST)
+    try:
+        domains_blacklist = extract_domain_set_from_dnsgate_format_file(blacklist_file)
+    except FileNotFoundError:
+        domains_blacklist = set()
+        eprint('WARNING: %s is missing, only the default remote sources ' +
+            'will be used. Run "dnsgate configure --help" to fix.',
+            CUSTOM_BLACKLIST, level=LOG['WARNING'])
+    else:
+        if domains_blacklist: # ignore empty blacklist
+            eprint("Got %s domains from the CUSTOM_BLACKLIST: %s",
+                len(domains_blacklist), blacklist_file, level=LOG['DEBUG'])
+            # the remote and whitelisted domains are already validated
+            domains_blacklist = validate_domain_list(domains_blacklist)
+    return domains_blacklist
+
+def fetch_remote_rules(config, no_cache=False, cache_expire=CACHE_EXPIRE,
+        workers=FETCH_WORKERS, per_host=FETCH_PER_HOST, deadline=FETCH_DEADLINE,
+        pool=None, max_source_size=SOURCE_MAX_BYTES, fetcher=None,
+        max_stale=SOURCE_MAX_STALE, stale_while_revalidate=False, inline=False):
+    '''
+    Returns the validated domains of every config.sources as one Domain_Store
+    and an OrderedDict of url -> Domain_Store of each one that was fetched.
+    '''
+    domains_combined_orig = Domain_Store()   # domains from all sources, combined
+    domains_sources = collections.OrderedDict()
     eprint("Reading remote blacklist(s):\n%s", str(config.sources), level=LOG['INFO'])
+    remote_sources = []
     for item in config.sources:
         if item.startswith('http'):
-            try:
-                eprint("Trying http:// blacklist location: %s", item, level=LOG['DEBUG'])
-                domains = extract_domain_set_from_hosts_format_url_or_cached_copy(item,
-                    no_cache, cache_expire)
-                if domains:
-                    domains_combined_orig = domains_combined_orig | domains # union
-                    eprint("len(domains_combined_orig): %s",
-                        len(domains_combined_orig), level=LOG['DEBUG'])
-                else:
-                    eprint('ERROR: Failed to get ' + item + ', skipping.', level=LOG['ERROR'])
-                    continue
-            except Exception as e:
-                eprint("Exception on blacklist url: %s", item, level=LOG['ERROR'])
-                eprint(e, level=LOG['ERROR'])
+            remote_sources.append(item)
         else:
             eprint('ERROR: ' + item +
                 ' must start with http:// or https://, skipping.', level=LOG['ERROR'])
 
+    METRICS.stage('fetch')
+    fetched = fetch_sources(remote_sources, no_cache=no_cache,
+        cache_expire=cache_expire, workers=workers, per_host=per_host,
+        deadline=deadline, pool=pool, max_size=max_source_size, fetcher=fetcher,
+        max_stale=max_stale, stale_while_revalidate=stale_while_revalidate,
+        inline=inline)
+    METRICS.count('parse_seconds', METRICS.source_total('parse_seconds'))
+    METRICS.count('validate_seconds', METRICS.source_total('validate_seconds'))
+    METRICS.stage('merge')
+    for item in remote_sources:     # union in config order
+        domains = fetched[item]
+        fetched[item] = None # only keep the packed copy
+        if domains:
+            domains_sources[item] = Domain_Store(domains)
+            domains_combined_orig = domains_combined_orig | domains_sources[item] # union
+            eprint("len(domains_combined_orig): %s",
+                len(domains_combined_orig), level=LOG['DEBUG'])
+        else:
+            eprint('ERROR: Failed to get ' + item + ', skipping.', level=LOG['ERROR'])
+
     eprint("%d domains from remote blacklist(s).",
         len(domains_combined_orig), level=LOG['INFO'])
 
@@ -877,112 +3392,590 @@ def generate(config, no_cache, cache_expire):
             "remote sources, only the local " + CUSTOM_BLACKLIST +
             " will be used.", level=LOG['WARNING'])
 
-    domains_combined_orig = validate_domain_list(domains_combined_orig)
+    # every source was validated as it was parsed
     eprint('%d validated remote blacklisted domains.',
         len(domains_combined_orig), level=LOG['INFO'])
+    METRICS.count('remote_domains', len(domains_combined_orig))
+    return domains_combined_orig, domains_sources
 
-    domains_combined = copy.deepcopy(domains_combined_orig) # need to iterate through _orig later
-
-    if config.block_at_psl and config.mode != 'hosts':
-        domains_combined = strip_to_psl(domains_combined)
-        eprint("%d blacklisted domains left after stripping to PSL domains.",
-            len(domains_combined), level=LOG['INFO'])
-
-        if domains_whitelist:
-            eprint("Subtracting %d whitelisted domains.",
-                len(domains_whitelist), level=LOG['INFO'])
-            domains_combined = domains_combined - domains_whitelist
-            eprint("%d blacklisted domains left after subtracting the whitelist.",
-                len(domains_combined), level=LOG['INFO'])
-            eprint('Iterating through the original %d whitelisted domains and ' +
-                'making sure none are blocked by * rules.',
-                len(domains_whitelist), level=LOG['INFO'])
-            for domain in domains_whitelist:
-                domain_psl = extract_psl_domain(domain)
-                if domain_psl in domains_combined:
-                    domains_combined.remove(domain_psl)
-
-        # this needs to happen even if len(whitelisted_domains) == 0
-        eprint('Iterating through original %d blacklisted domains to re-add subdomains' +
-            ' that are not whitelisted', len(domains_combined_orig), level=LOG['INFO'])
-        # re-add subdomains that are not explicitly whitelisted or already blocked
-        for orig_domain in domains_combined_orig: # check every original full hostname
-            if orig_domain not in domains_whitelist: # if it's not in the whitelist
-                if orig_domain not in domains_combined: # and it's not in the current blacklist
-                                                        # (almost none will be if --block-at-psl)
-                    # get it's psl to see if it's already blocked
-                    orig_domain_psl = extract_psl_domain(orig_domain)
-
-                    if orig_domain_psl not in domains_combined: # if the psl is not already blocked
-                        eprint("Re-adding: %s", orig_domain, level=LOG['DEBUG'])
-                        domains_combined.add(orig_domain) # add the full hostname to the blacklist
-
+def apply_local_rules(config, domains_combined_orig, domains_whitelist,
+        domains_blacklist, no_psl_cache=False, pool=None, prune=True):
+    '''
+    Strip to psl domains if configured, subtract the whitelist and add the
+    blacklist. Returns the final rules as a Domain_Store, without the rules
+    a parent rule already covers in the output unless prune is False.
+    '''
+    domains_combined = domains_combined_orig # Domain_Store is immutable, _orig is kept
+
+    if config.block_at_psl and OUTPUT_WRITERS[config.mode].covers_subdomains:
+        METRICS.stage('psl')
+        if not no_psl_cache:
+            psl_version = get_psl_version()
+            PSL_DOMAINS.load(PSL_CACHE, psl_version)
+        psl_groups = group_by_psl_domain(domains_combined_orig, pool=pool)
+        eprint("%d psl domains for %d blacklisted domains.", len(psl_groups),
+            len(domains_combined_orig), level=LOG['INFO'])
+
+        domains_combined = Domain_Store(block_psl_groups(psl_groups,
+            domains_whitelist))
+        del psl_groups
         eprint('%d blacklisted domains after re-adding non-explicitly blacklisted subdomains',
             len(domains_combined), level=LOG['INFO'])
-
-    elif config.block_at_psl and config.mode == 'hosts':
+        eprint('PSL lookups: %d cached, %d resolved.', PSL_DOMAINS.hits,
+            PSL_DOMAINS.misses, level=LOG['DEBUG'])
+        METRICS.count('psl_hits', PSL_DOMAINS.hits)
+        METRICS.count('psl_misses', PSL_DOMAINS.misses)
+        if not no_psl_cache and PSL_DOMAINS.misses:
+            PSL_DOMAINS.save(PSL_CACHE, psl_version)
+
+    elif config.block_at_psl:
         eprint("ERROR: --block-at-psl is not possible in hosts mode. Exiting.",
             level=-LOG['ERROR'])
         quit(1)
 
     # apply whitelist before applying local blacklist
+    METRICS.stage('whitelist')
     domains_combined = domains_combined - domains_whitelist  # remove exact whitelist matches
     eprint("%d blacklisted domains after subtracting the %d whitelisted domains",
         len(domains_combined), len(domains_whitelist), level=LOG['INFO'])
 
     # must happen after subdomain stripping and after whitelist subtraction
-    blacklist_file = os.path.abspath(CUSTOM_BLACKLIST)
+    METRICS.stage('blacklist')
+    if domains_blacklist:
+        eprint("Re-adding %d domains in the local blacklist %s to override the whitelist.",
+            len(domains_blacklist), CUSTOM_BLACKLIST, level=LOG['INFO'])
+        domains_combined = domains_combined | domains_blacklist # union
+        eprint("%d blacklisted domains after re-adding the custom blacklist.",
+            len(domains_combined), level=LOG['INFO'])
+
+    METRICS.stage('prune')
+    if prune and OUTPUT_WRITERS[config.mode].covers_subdomains: # /etc/hosts rules do not
+        domains_combined = domains_combined.without_redundant_rules()
+        eprint('%d blacklisted domains after removing redundant rules.', len(domains_combined),
+            level=LOG['INFO'])
+    return domains_combined
+
+def patch_local_rules(config, state, domains_whitelist, domains_blacklist):
+    '''
+    Returns a new Rule_State for the changed local lists without touching
+    the rest of the rules: only the subtree under each changed domain (under
+    its psl domain with block_at_psl) is re-run through apply_local_rules()
+    and spliced into state.domains_combined.
+    '''
+    changed = (state.domains_whitelist ^ domains_whitelist) | \
+        (state.domains_blacklist ^ domains_blacklist)
+    covers_subdomains = OUTPUT_WRITERS[config.mode].covers_subdomains
+    if config.block_at_psl and covers_subdomains: # a public suffix is its own root
+        changed = set(extract_psl_domain(domain) or domain for domain in changed)
+
+    domains_combined = state.domains_combined
+    for root in Domain_Store(changed).without_redundant_rules(): # disjoint subtrees
+        suffix = b'.' + root
+        subtree_whitelist = set(domain for domain in domains_whitelist
+            if domain == root or domain.endswith(suffix))
+        subtree_blacklist = set(domain for domain in domains_blacklist
+            if domain == root or domain.endswith(suffix))
+        subtree_rules = apply_local_rules(config, state.domains_remote.subtree(root),
+            subtree_whitelist, subtree_blacklist, no_psl_cache=True)
+        if covers_subdomains and domains_combined.covering_rule(root) not in (None, root):
+            subtree_rules = Domain_Store() # a parent domain is blocked, so is all of it
+        eprint('%s: %d rules replaced by %d.', root.decode('utf8'),
+            len(domains_combined.subtree(root)), len(subtree_rules), level=LOG['INFO'])
+        domains_combined = domains_combined.replace_subtree(root, subtree_rules)
+
+    return Rule_State(state.domains_remote, domains_whitelist, domains_blacklist,
+        domains_combined, domains_sources=state.domains_sources, fetched=state.fetched)
+
+@dnsgate.command(help=CHECK_HELP, short_help='Show if and why domains are blocked')
+@click.argument('domains', required=True, nargs=-1)
+def check(domains):
     try:
-        domains_blacklist = extract_domain_set_from_dnsgate_format_file(blacklist_file)
+        index = Rule_Index()
     except FileNotFoundError:
-        domains_blacklist = set()
-        eprint('WARNING: %s is missing, only the default remote sources ' +
-            'will be used. Run "dnsgate configure --help" to fix.',
-            CUSTOM_BLACKLIST, level=LOG['WARNING'])
-    else:
-        if domains_blacklist: # ignore empty blacklist
-            eprint("Got %s domains from the CUSTOM_BLACKLIST: %s",
-                len(domains_blacklist), blacklist_file, level=LOG['DEBUG'])
-            eprint("Re-adding %d domains in the local blacklist %s to override the whitelist.",
-                len(domains_blacklist), CUSTOM_BLACKLIST, level=LOG['INFO'])
-            domains_combined = domains_combined | domains_blacklist # union
-            eprint("%d blacklisted domains after re-adding the custom blacklist.",
-                len(domains_combined), level=LOG['INFO'])
-
-    eprint("Validating final domain blacklist.", level=LOG['DEBUG'])
-    domains_combined = validate_domain_list(domains_combined)
-    eprint('%d validated blacklisted domains.', len(domains_combined),
-        level=LOG['DEBUG'])
+        eprint("ERROR: %s is missing, run \"dnsgate generate\" first.", RULE_INDEX,
+            level=LOG['ERROR'])
+        quit(1)
+    except ValueError as e:
+        eprint("ERROR: %s, run \"dnsgate generate\" to rebuild it.", e,
+            level=LOG['ERROR'])
+        quit(1)
+    eprint("Rules written to %s on %s.", index.header['output'],
+        time.ctime(index.header['written']), level=LOG['INFO'])
+    for name in domains:
+        domain = normalize_domain(name.encode('utf8').rstrip(b'.'))
+        if domain is None:
+            eprint("WARNING: %s is not a valid domain.", name, level=LOG['WARNING'])
+            continue
+        rule = index.blocking_rule(domain)
+        whitelisted = domain in index.whitelist
+        if rule is None:
+            reason = 'whitelisted in ' + CUSTOM_WHITELIST if whitelisted \
+                else 'no rule matches'
+            click.echo(name + ': allowed, ' + reason)
+        else:
+            click.echo(name + ': blocked by ' + rule.decode('utf8') +
+                (', despite being whitelisted' if whitelisted else ''))
+        for source, listed in index.listed_by(domain, rule):
+            if rule is None:
+                click.echo('    listed in ' + source)
+            elif listed == rule:
+                click.echo('    from ' + source)
+            else:
+                click.echo('    from ' + source + ', which lists ' + listed.decode('utf8'))
+
+@dnsgate.command(help=SERVE_HELP, short_help='Run a filtering DNS proxy')
+@click.option('--listen',       is_flag=False, help=LISTEN_HELP, default=PROXY_LISTEN)
+@click.option('--port',         is_flag=False, help=PORT_HELP,
+    type=int, default=PROXY_PORT)
+@click.option('--upstream',     is_flag=False, help=UPSTREAM_HELP, default=PROXY_UPSTREAM)
+@click.option('--cache-size',   is_flag=False, help=PROXY_CACHE_SIZE_HELP,
+    type=int, default=PROXY_CACHE_SIZE)
+@click.option('--max-ttl',      is_flag=False, help=MAX_TTL_HELP,
+    type=int, default=PROXY_MAX_TTL)
+@click.pass_obj
+def serve(config, listen, port, upstream, cache_size, max_ttl):
+    import asyncio
+    upstream = parse_host_port(upstream, 53)
+    proxy = Dns_Proxy(make_suffix_matcher(config), upstream, dest_ip=config.dest_ip,
+        cache=Dns_Cache(max_entries=cache_size, max_ttl=max_ttl))
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        udp_transport, tcp_server = loop.run_until_complete(
+            start_dns_proxy(proxy, listen, port))
+    except OSError as e:
+        eprint("ERROR: can not listen on %s:%d: %s. Exiting.", listen, port, e,
+            level=LOG['ERROR'])
+        quit(1)
 
-    prune_redundant_rules(domains_combined)
-    eprint('%d blacklisted domains after removing redundant rules.', len(domains_combined),
-        level=LOG['INFO'])
+    def reload():
+        def swap(future):
+            try:
+                proxy.matcher = future.result()
+            except BaseException as e: # quit() inside compile_rules
+                eprint("ERROR: reloading rules failed, keeping the old ones: %r", e,
+                    level=LOG['ERROR'])
+                return
+            proxy.cache.clear()
+            eprint("Rules reloaded.", level=LOG['INFO'])
+        eprint("SIGHUP: rebuilding rules.", level=LOG['INFO'])
+        loop.run_in_executor(None, make_suffix_matcher, config).add_done_callback(swap)
+
+    loop.add_signal_handler(signal.SIGHUP, reload)
+    loop.add_signal_handler(signal.SIGTERM, loop.stop)
+    eprint("Listening on %s:%d, forwarding to %s:%d", listen, port,
+        upstream[0], upstream[1], level=LOG['INFO'])
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        udp_transport.close()
+        tcp_server.close()
+        loop.run_until_complete(tcp_server.wait_closed())
+        loop.close()
+        eprint("Blocked %d, forwarded %d, %d cache hits.", proxy.blocked,
+            proxy.forwarded, proxy.cache.hits, level=LOG['INFO'])
+
+@dnsgate.command(help=WATCH_HELP, short_help='Regenerate whenever the rules change')
+@click.option('--refresh',      is_flag=False, help=REFRESH_HELP,
+    type=int, default=CACHE_EXPIRE)
+@click.option('--poll',         is_flag=True,  help=POLL_HELP)
+@click.pass_context
+def watch(ctx, refresh, poll):
+    config = ctx.obj
+    # watch before compiling so an edit made meanwhile is not missed
+    watcher = make_file_watcher([CONFIG_FILE, CUSTOM_WHITELIST, CUSTOM_BLACKLIST], poll=poll)
+    fetcher = Source_Fetcher() # connections are re-used between refreshes
+    state = compile_rules(config, cache_expire=refresh, fetcher=fetcher)
+    publish_rules(config, state)
+    save_rule_state(config, state)
+    next_refresh = time.monotonic() + refresh
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    eprint("Watching %s, %s and %s.", CONFIG_FILE, CUSTOM_WHITELIST,
+        CUSTOM_BLACKLIST, level=LOG['INFO'])
+    try:
+        while True:
+            changed = watcher.wait(max(0, next_refresh - time.monotonic()))
+            started = time.monotonic()
+            if CONFIG_FILE in changed:
+                eprint("%s changed, recompiling all rules.", CONFIG_FILE, level=LOG['INFO'])
+                try:
+                    new_config = read_config_file(no_restart_dnsmasq=config.no_restart_dnsmasq,
+                        backup=config.backup)
+                except (SystemExit, Exception) as e: # quit() or a parse error
+                    eprint("ERROR: keeping the previous configuration: %r", e,
+                        level=LOG['ERROR'])
+                    continue
+                config = ctx.obj = new_config # write_output_file() reads ctx.obj
+                state = compile_rules(config, cache_expire=refresh, fetcher=fetcher)
+                next_refresh = time.monotonic() + refresh
+            elif changed:
+                state = patch_local_rules(config, state, read_local_whitelist(config),
+                    read_local_blacklist())
+            elif time.monotonic() >= next_refresh:
+                eprint("Refreshing remote sources.", level=LOG['INFO'])
+                domains_remote, domains_sources = fetch_remote_rules(config,
+                    cache_expire=refresh, fetcher=fetcher)
+                state = Rule_State(domains_remote, state.domains_whitelist,
+                    state.domains_blacklist, apply_local_rules(config, domains_remote,
+                        state.domains_whitelist, state.domains_blacklist),
+                    domains_sources=domains_sources)
+                next_refresh = time.monotonic() + refresh
+            else:
+                continue # an unrelated file in the same directory
+            if publish_rules(config, state):
+                eprint("%s updated in %.3f seconds, %d rules.", config.output,
+                    time.monotonic() - started, len(state.domains_combined),
+                    level=LOG['INFO'])
+            save_rule_state(config, state) # for the whitelist and blacklist commands
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+        fetcher.close()
+
+
+def iter_rule_lines(domains, batch_size=10000):
+    '''
+    Yields domains one per line, batch_size lines at a time.
+    '''
+    batch = []
+    for domain in domains:
+        batch.append(domain)
+        if len(batch) == batch_size:
+            yield b'\n'.join(batch) + b'\n'
+            batch = []
+    if batch:
+        yield b'\n'.join(batch) + b'\n'
+
+def iter_gunzip(chunks):
+    decompressor = Gzip_Decompressor() # plain if a server already undid gzip
+    for chunk in chunks:
+        yield from decompressor.decompress(chunk)
+    yield from decompressor.flush()
+
+def write_gzip_file(path, chunks):
+    '''
+    Write chunks gzip compressed to a temporary file next to path. Returns
+    its path and the sha1 of the uncompressed chunks, the caller moves it
+    into place or removes it.
+    '''
+    tmp_path = make_tmp_path(path)
+    digest = hashlib.sha1()
+    compressor = zlib.compressobj(PUBLISH_COMPRESS_LEVEL, zlib.DEFLATED, 31)
+    try:
+        with open(tmp_path, 'wb') as fh:
+            for chunk in chunks:
+                digest.update(chunk)
+                fh.write(compressor.compress(chunk))
+            fh.write(compressor.flush())
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return tmp_path, digest.hexdigest()
+
+def read_rules(chunks, validate=True):
+    '''
+    Returns the Domain_Store of the gzip compressed rule lines in chunks (see
+    iter_rule_lines()), without sorting them again. Raises ValueError if they
+    are out of order or, with validate, not normalized valid domains.
+    '''
+    def sorted_keys():
+        previous = b''
+        for block in iter_line_blocks(iter_gunzip(chunks)):
+            for domain in block.split(b'\n'):
+                if not domain:
+                    continue
+                if validate and normalize_domain(domain) != domain:
+                    raise ValueError('invalid domain %r' % domain)
+                key = domain_to_store_key(domain)
+                if key <= previous:
+                    raise ValueError('rules out of order at %r' % domain)
+                previous = key
+                yield key
+    return Domain_Store.from_sorted_keys(sorted_keys())
+
+def read_rules_delta(chunks):
+    '''
+    Returns the (removed, added) domain sets of a delta written by
+    publish_rules_artifact(), raises ValueError on anything else.
+    '''
+    removed, added = set(), set()
+    for block in iter_line_blocks(iter_gunzip(chunks)):
+        for line in block.split(b'\n'):
+            if not line:
+                continue
+            domain = line[1:]
+            if line[:1] == b'-':
+                removed.add(domain)
+            elif line[:1] == b'+' and normalize_domain(domain) == domain:
+                added.add(domain)
+            else:
+                raise ValueError('invalid delta line %r' % line)
+    return removed, added
 
-    domains_combined = group_by_tld(domains_combined) # do last, returns sorted list
-    eprint('Final blacklisted domain count: %d', len(domains_combined),
-        level=LOG['INFO'])
+def read_json_file(path):
+    '''
+    Returns the decoded file, or None if it is missing or unreadable.
+    '''
+    try:
+        with open(path, 'r') as fh:
+            return json.load(fh)
+    except FileNotFoundError:
+        return None
+    except ValueError as e:
+        eprint("WARNING: ignoring unreadable %s: %s", path, e, level=LOG['WARNING'])
+        return None
 
-    if config.backup: # todo: unit test
-        backup_file_if_exists(config.output)
+def publish_rules_artifact(domains_combined, directory, mode,
+        keep=PUBLISH_KEEP_VERSIONS):
+    '''
+    Write domains_combined to directory as the next version, with deltas
+    from the previous keep versions, then PUBLISH_MANIFEST. Files no delta
+    will be made from again are removed afterwards. Returns the manifest,
+    or None if the latest version already holds these rules.
+    '''
+    covers_subdomains = OUTPUT_WRITERS[mode].covers_subdomains
+    os.makedirs(directory, exist_ok=True)
+    manifest = read_json_file(os.path.join(directory, PUBLISH_MANIFEST)) or {}
+    version = manifest.get('version', 0) + 1
+    rules_path = os.path.join(directory, 'rules-%d.gz' % version)
+    rules_tmp_path, content_sha1 = write_gzip_file(rules_path,
+        iter_rule_lines(domains_combined))
+    if manifest.get('format') == PUBLISH_FORMAT and \
+            manifest.get('sha1') == content_sha1 and \
+            manifest.get('covers_subdomains') == covers_subdomains:
+        os.remove(rules_tmp_path)
+        return None
+    os.replace(rules_tmp_path, rules_path)
+    rules_size = os.stat(rules_path).st_size
+
+    deltas = {}
+    for old_version in range(max(1, version - keep), version):
+        old_path = os.path.join(directory, 'rules-%d.gz' % old_version)
+        try:
+            with open(old_path, 'rb') as fh:
+                old_domains = read_rules(iter_file_chunks(fh), validate=False)
+        except FileNotFoundError:
+            continue
+        removed = old_domains - domains_combined
+        added = domains_combined - old_domains
+        delta_path = os.path.join(directory, 'delta-%d-%d.gz' % (old_version, version))
+        delta_tmp_path, _ = write_gzip_file(delta_path, iter_rule_lines(
+            itertools.chain((b'-' + domain for domain in removed),
+                (b'+' + domain for domain in added))))
+        delta_size = os.stat(delta_tmp_path).st_size
+        if delta_size >= rules_size: # cheaper to fetch everything
+            os.remove(delta_tmp_path)
+            continue
+        os.replace(delta_tmp_path, delta_path)
+        deltas[str(old_version)] = {'file': os.path.basename(delta_path),
+            'size': delta_size, 'removed': len(removed), 'added': len(added)}
+
+    manifest = {
+        'format': PUBLISH_FORMAT,
+        'version': version,
+        'published': time.time(),
+        'file': os.path.basename(rules_path),
+        'size': rules_size,
+        'sha1': content_sha1,
+        'count': len(domains_combined),
+        'mode': mode,
+        'covers_subdomains': covers_subdomains,
+        'deltas': deltas,
+        }
+    write_file_bytes_atomic(os.path.join(directory, PUBLISH_MANIFEST),
+        json.dumps(manifest, indent=2).encode('utf-8'))
+
+    for name in os.listdir(directory):
+        match = PUBLISH_FILE_REGEX.fullmatch(name)
+        if not match:
+            continue
+        rules_version, _, delta_to = match.groups()
+        if (rules_version and int(rules_version) <= version - keep) or \
+                (delta_to and int(delta_to) != version):
+            os.remove(os.path.join(directory, name))
+    return manifest
+
+@contextlib.contextmanager
+def open_published_file(location, name, fetcher, etag=None, last_modified=None):
+    '''
+    Yields (chunks, etag, last_modified) of the file name published at
+    location, an http(s) URL or a directory. chunks is None if the file
+    still matches etag or last_modified.
+    '''
+    if location.startswith(('http://', 'https://')):
+        headers = {}
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+        with fetcher.get(location.rstrip('/') + '/' + name, headers) as response:
+            if response.status_code == 304:
+                yield None, etag, last_modified
+                return
+            response.raise_for_status()
+            yield (response.iter_content(DOWNLOAD_CHUNK_SIZE),
+                response.headers.get('ETag'), response.headers.get('Last-Modified'))
+    else:
+        with open(os.path.join(location, name), 'rb') as fh:
+            stat = os.fstat(fh.fileno())
+            file_etag = '"%x-%x"' % (stat.st_mtime_ns, stat.st_size)
+            if file_etag == etag:
+                yield None, etag, None
+                return
+            yield iter_file_chunks(fh), file_etag, None
+
+def check_manifest(manifest):
+    '''
+    Raises ValueError unless manifest is a PUBLISH_FORMAT manifest with the
+    keys pull_rules_artifact() reads, naming files publish_rules_artifact()
+    writes.
+    '''
+    def check_keys(values, keys):
+        for key, key_type in keys.items():
+            if not isinstance(values.get(key), key_type):
+                raise ValueError('the manifest has no valid %r' % key)
+        if not PUBLISH_FILE_REGEX.fullmatch(values['file']):
+            raise ValueError('the manifest names an invalid file %r' % values['file'])
+
+    if not isinstance(manifest, dict):
+        raise ValueError('the manifest is not a JSON object')
+    if manifest.get('format') != PUBLISH_FORMAT:
+        raise ValueError('unsupported format %r' % manifest.get('format'))
+    check_keys(manifest, PUBLISH_MANIFEST_KEYS)
+    for delta in manifest['deltas'].values():
+        if not isinstance(delta, dict):
+            raise ValueError('the manifest has an invalid delta %r' % (delta,))
+        check_keys(delta, PUBLISH_DELTA_KEYS)
+
+def pull_rules_artifact(location, fetcher, mode, output_digest=None):
+    '''
+    Bring the copy of the rules published at location in PULL_DIRECTORY up
+    to date, with a delta from the version pulled last if there is one.
+    Returns the pulled Domain_Store, or None if neither the published
+    manifest nor the output (output_digest, see read_output_file_digest())
+    changed since. Raises OSError or ValueError if the rules can't be pulled.
+    '''
+    state_path = PULL_DIRECTORY + '/state.json'
+    rules_path = PULL_DIRECTORY + '/rules.gz'
+    pulled = read_json_file(state_path) or {}
+    if pulled.get('location') != location or not os.path.exists(rules_path):
+        pulled = {}
+
+    with open_published_file(location, PUBLISH_MANIFEST, fetcher,
+            pulled.get('etag'), pulled.get('last_modified')) as (chunks, etag, last_modified):
+        manifest = None if chunks is None else json.loads(b''.join(chunks).decode('utf-8'))
+    if manifest is not None:
+        check_manifest(manifest)
+
+    if manifest is None or manifest['sha1'] == pulled.get('sha1'):
+        if manifest is not None:
+            pulled.update(etag=etag, last_modified=last_modified)
+            write_file_bytes_atomic(state_path, json.dumps(pulled).encode('utf-8'))
+        if output_digest == pulled.get('output_digest'):
+            return None
+        eprint("Published rules are unchanged, using the pulled copy.", level=LOG['INFO'])
+        with open(rules_path, 'rb') as fh:
+            return read_rules(iter_file_chunks(fh), validate=False)
+
+    if manifest['covers_subdomains'] != OUTPUT_WRITERS[mode].covers_subdomains:
+        raise ValueError('the rules were compiled for %s mode, they can not be ' \
+            'written in %s mode' % (manifest['mode'], mode))
+
+    os.makedirs(PULL_DIRECTORY, exist_ok=True)
+    domains = None
+    delta = manifest['deltas'].get(str(pulled.get('version')))
+    if delta:
+        eprint("Pulling %s, version %d to %d.", delta['file'], pulled['version'],
+            manifest['version'], level=LOG['INFO'])
+        with open(rules_path, 'rb') as fh:
+            domains = read_rules(iter_file_chunks(fh), validate=False)
+        with open_published_file(location, delta['file'], fetcher) as (chunks, _, _):
+            removed, added = read_rules_delta(chunks)
+        domains = (domains - removed) | added
+        tmp_path, content_sha1 = write_gzip_file(rules_path, iter_rule_lines(domains))
+        if content_sha1 != manifest['sha1']:
+            eprint("WARNING: %s does not apply to the pulled copy, pulling every rule.",
+                delta['file'], level=LOG['WARNING'])
+            os.remove(tmp_path)
+            domains = None
+    if domains is None:
+        eprint("Pulling %s, version %d.", manifest['file'], manifest['version'],
+            level=LOG['INFO'])
+        with open_published_file(location, manifest['file'], fetcher) as (chunks, _, _):
+            domains = read_rules(chunks)
+        tmp_path, content_sha1 = write_gzip_file(rules_path, iter_rule_lines(domains))
+        if content_sha1 != manifest['sha1']:
+            os.remove(tmp_path)
+            raise ValueError('%s does not match its sha1 %s' % (manifest['file'],
+                manifest['sha1']))
+    os.replace(tmp_path, rules_path)
+    pulled = {'location': location, 'version': manifest['version'],
+        'sha1': manifest['sha1'], 'etag': etag, 'last_modified': last_modified}
+    write_file_bytes_atomic(state_path, json.dumps(pulled).encode('utf-8'))
+    return domains
 
-    if not domains_combined:
-        eprint("The list of domains to block is empty, nothing to do, exiting.",
+def save_pulled_output_digest(output_digest):
+    '''
+    Remember the output written from the pulled rules, pull skips writing
+    it again while neither it nor the published rules change.
+    '''
+    state_path = PULL_DIRECTORY + '/state.json'
+    pulled = read_json_file(state_path)
+    if pulled is not None:
+        pulled['output_digest'] = output_digest
+        write_file_bytes_atomic(state_path, json.dumps(pulled).encode('utf-8'))
+
+@dnsgate.command(help=PUBLISH_HELP, short_help='Publish the compiled rules for dnsgate pull')
+@click.argument('directory', type=click.Path(file_okay=False))
+@click.option('--keep',         is_flag=False, help=KEEP_HELP,
+    type=click.IntRange(min=1), default=PUBLISH_KEEP_VERSIONS)
+@click.pass_obj
+def publish(config, directory, keep):
+    state = load_rule_state(config)
+    if state is None:
+        eprint('ERROR: there are no recently compiled rules, run "dnsgate generate" ' +
+            'first. Exiting.', level=LOG['ERROR'])
+        quit(1)
+    manifest = publish_rules_artifact(state.domains_combined, directory,
+        config.mode, keep=keep)
+    if manifest is None:
+        eprint("The rules published in %s are unchanged.", directory, level=LOG['INFO'])
+        return
+    eprint("Published version %d, %d rules, to %s with deltas from versions: %s",
+        manifest['version'], manifest['count'], directory,
+        ', '.join(sorted(manifest['deltas'], key=int)) or 'none', level=LOG['INFO'])
+
+@dnsgate.command(help=PULL_HELP, short_help='Write the rules published by dnsgate publish')
+@click.argument('location')
+@click.pass_obj
+def pull(config, location):
+    fetcher = Source_Fetcher()
+    try:
+        domains = pull_rules_artifact(location, fetcher, config.mode,
+            output_digest=read_output_file_digest(config.output))
+    except (OSError, ValueError, zlib.error) as e:
+        eprint("ERROR: could not pull the rules from %s: %s", location, e,
+            level=LOG['ERROR'])
+        quit(1)
+    finally:
+        fetcher.close()
+    if domains is None:
+        eprint("%s is up to date.", config.output, level=LOG['INFO'])
+        return
+    if not domains:
+        eprint("The published list of domains to block is empty, nothing to do, exiting.",
             level=LOG['INFO'])
         quit(1)
-
-    for domain in domains_whitelist:
-        domain_tld = extract_psl_domain(domain)
-        if domain_tld in domains_combined:
-            eprint('WARNING: %s is listed in both %s and %s, '
-                'the local blacklist always takes precedence.', domain.decode('UTF8'),
-                CUSTOM_BLACKLIST, CUSTOM_WHITELIST, level=LOG['WARNING'])
-
-    write_output_file(domains_combined)
-
-    if not config.no_restart_dnsmasq:
-        if config.mode != 'hosts':
-            restart_dnsmasq_service()
-
+    output_written = write_output_file(domains)
+    save_pulled_output_digest(read_output_file_digest(config.output))
+    if output_written and not config.no_restart_dnsmasq:
+        get_output_writer(config).reload()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,76 @@
+# tab-width:4
+
+# writing the output file only when the rules in it change
+
+import click
+import pytest
+from click.testing import CliRunner
+
+from dnsgate import dnsgate
+
+RULES = dnsgate.Domain_Store([b'ads.example.com', b'tracker.net'])
+
+def write(config, domains_combined):
+    with click.Context(dnsgate.dnsgate, obj=config):
+        return dnsgate.write_output_file(domains_combined)
+
+def test_unchanged_rules_are_not_rewritten(tmp_path):
+    output = str(tmp_path / 'output')
+    config = dnsgate.Dnsgate_Config(mode='dnsmasq', sources=['http://one.test/hosts'],
+        output=output)
+    assert write(config, RULES)
+    assert not write(config, RULES)
+    # only the configuration in the header differs
+    config = dnsgate.Dnsgate_Config(mode='dnsmasq', output=output,
+        sources=['http://one.test/hosts', 'http://two.test/hosts'])
+    assert not write(config, RULES)
+    assert write(config, RULES | dnsgate.Domain_Store([b'evil.org']))
+    with open(output, 'rb') as fh:
+        assert b'evil.org' in fh.read()
+
+def configure(tmp_path, monkeypatch, dest_ip='False'):
+    '''
+    Points dnsgate at a dnsmasq mode config in tmp_path, returns the output path.
+    '''
+    output = tmp_path / 'output'
+    config_file = tmp_path / 'config'
+    config_file.write_text('[DEFAULT]\nmode = dnsmasq\nblock_at_psl = False\n' +
+        'dest_ip = %s\nsources = []\noutput = %s\ndnsmasq_config_file = %s\n' %
+        (dest_ip, output, tmp_path / 'dnsmasq.conf'))
+    monkeypatch.setattr(dnsgate, 'CONFIG_FILE', str(config_file))
+    monkeypatch.setattr(dnsgate, 'CACHE_DIRECTORY', str(tmp_path / 'cache'))
+    # their paths are default arguments, bound when dnsgate was imported
+    monkeypatch.setattr(dnsgate.save_rule_state, '__defaults__',
+        (str(tmp_path / 'rule_state'),))
+    monkeypatch.setattr(dnsgate.write_rule_index, '__defaults__',
+        (str(tmp_path / 'rule_index'),))
+    return output
+
+def test_unchanged_generate_makes_no_backup(tmp_path, monkeypatch):
+    output = configure(tmp_path, monkeypatch)
+    monkeypatch.setattr(dnsgate, 'fetch_remote_rules', lambda config, **kwargs:
+        (RULES, {'http://one.test/hosts': RULES}))
+    monkeypatch.setattr(dnsgate, 'read_local_whitelist', lambda config: set())
+    blacklist = set()
+    monkeypatch.setattr(dnsgate, 'read_local_blacklist', lambda: blacklist)
+    for run in range(2):
+        result = CliRunner().invoke(dnsgate.dnsgate,
+            ['--no-restart-dnsmasq', '--backup', 'generate'])
+        assert result.exit_code == 0, result.output
+    assert list(tmp_path.glob('output.bak.*')) == [] # nothing to back up, then unchanged
+    blacklist.add(b'evil.org')
+    result = CliRunner().invoke(dnsgate.dnsgate, ['--no-restart-dnsmasq', '--backup', 'generate'])
+    assert result.exit_code == 0, result.output
+    backups = list(tmp_path.glob('output.bak.*'))
+    assert len(backups) == 1 and b'evil.org' not in backups[0].read_bytes()
+    assert b'evil.org' in output.read_bytes()
+
+@pytest.mark.parametrize('dest_ip, rule', [
+    ('False', b'server=/#/\n'),
+    ('10.0.0.1', b'address=/#/10.0.0.1\n'),
+], ids=['nxdomain', 'dest-ip'])
+def test_blockall(tmp_path, monkeypatch, dest_ip, rule):
+    output = configure(tmp_path, monkeypatch, dest_ip)
+    result = CliRunner().invoke(dnsgate.dnsgate, ['--no-restart-dnsmasq', 'blockall'])
+    assert result.exit_code == 0, result.output
+    assert output.read_bytes().endswith(rule)
@@ -0,0 +1,149 @@
+# tab-width:4
+
+# dnsgate publish, and dnsgate pull from a local http.server
+
+import functools
+import http.server
+import json
+import os
+import threading
+
+import pytest
+from click.testing import CliRunner
+
+from dnsgate import dnsgate
+
+DOMAINS = [b'ads%d.example.com' % number for number in range(500)]
+
+class Publish_Handler(http.server.SimpleHTTPRequestHandler):
+    '''
+    Serves the publish directory and records the paths asked for.
+    '''
+    def log_message(self, *args):
+        self.server.paths.append(self.path)
+
+@pytest.fixture
+def published(tmp_path):
+    '''
+    The publish directory, served over http at published.url.
+    '''
+    directory = tmp_path / 'published'
+    directory.mkdir()
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0),
+        functools.partial(Publish_Handler, directory=str(directory)))
+    server.paths = []
+    server.directory = str(directory)
+    server.url = 'http://127.0.0.1:%d/' % server.server_address[1]
+    thread = threading.Thread(target=server.serve_forever, args=(0.01,), daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture
+def fetcher(monkeypatch, tmp_path):
+    monkeypatch.setattr(dnsgate, 'PULL_DIRECTORY', str(tmp_path / 'pulled'))
+    fetcher = dnsgate.Source_Fetcher(retries=0, timeout=5)
+    yield fetcher
+    fetcher.close()
+
+def publish(published, domains, mode='dnsmasq'):
+    manifest = dnsgate.publish_rules_artifact(dnsgate.Domain_Store(domains),
+        published.directory, mode)
+    if manifest is not None: # Last-Modified has whole seconds, keep versions apart
+        os.utime(os.path.join(published.directory, dnsgate.PUBLISH_MANIFEST),
+            (manifest['version'], manifest['version']))
+    return manifest
+
+def pull(published, fetcher, mode='dnsmasq'):
+    del published.paths[:]
+    return dnsgate.pull_rules_artifact(published.url, fetcher, mode)
+
+def edit_manifest(published, function):
+    path = os.path.join(published.directory, dnsgate.PUBLISH_MANIFEST)
+    with open(path) as fh:
+        manifest = json.load(fh)
+    function(manifest)
+    stat = os.stat(path)
+    with open(path, 'w') as fh:
+        json.dump(manifest, fh)
+    os.utime(path, (stat.st_atime + 1, stat.st_mtime + 1))
+
+def test_full_pull(published, fetcher):
+    manifest = publish(published, DOMAINS)
+    assert manifest['version'] == 1 and manifest['deltas'] == {}
+    assert list(pull(published, fetcher)) == list(dnsgate.Domain_Store(DOMAINS))
+    assert published.paths == ['/latest.json', '/rules-1.gz']
+    assert pull(published, fetcher) is None # unchanged since
+
+def test_delta_pull(published, fetcher):
+    publish(published, DOMAINS)
+    pull(published, fetcher)
+    domains = DOMAINS[1:] + [b'new.example.org']
+    manifest = publish(published, domains)
+    assert manifest['version'] == 2 and list(manifest['deltas']) == ['1']
+    assert publish(published, domains) is None
+    assert list(pull(published, fetcher)) == list(dnsgate.Domain_Store(domains))
+    assert published.paths == ['/latest.json', '/delta-1-2.gz']
+
+def test_delta_that_does_not_apply_pulls_every_rule(published, fetcher):
+    publish(published, DOMAINS)
+    pull(published, fetcher)
+    domains = DOMAINS[1:]
+    publish(published, domains)
+    delta_path = os.path.join(published.directory, 'delta-1-2.gz')
+    tmp_path, _ = dnsgate.write_gzip_file(delta_path, [b'-' + DOMAINS[2] + b'\n'])
+    os.replace(tmp_path, delta_path)
+    assert list(pull(published, fetcher)) == list(dnsgate.Domain_Store(domains))
+    assert published.paths == ['/latest.json', '/delta-1-2.gz', '/rules-2.gz']
+
+def test_sha1_mismatch(published, fetcher):
+    publish(published, DOMAINS)
+    edit_manifest(published, lambda manifest: manifest.update(sha1='0' * 40))
+    with pytest.raises(ValueError, match='does not match its sha1'):
+        pull(published, fetcher)
+    assert not os.path.exists(os.path.join(dnsgate.PULL_DIRECTORY, 'state.json'))
+
+def test_mode_mismatch(published, fetcher):
+    publish(published, DOMAINS, mode='hosts')
+    with pytest.raises(ValueError, match='compiled for hosts mode'):
+        pull(published, fetcher, mode='dnsmasq')
+    assert list(pull(published, fetcher, mode='hosts')) == list(dnsgate.Domain_Store(DOMAINS))
+
+@pytest.mark.parametrize('key', sorted(dnsgate.PUBLISH_MANIFEST_KEYS))
+def test_manifest_without_a_key(published, fetcher, key):
+    publish(published, DOMAINS)
+    edit_manifest(published, lambda manifest: manifest.pop(key))
+    with pytest.raises(ValueError, match=repr(key)):
+        pull(published, fetcher)
+
+@pytest.mark.parametrize('change', [
+    lambda manifest: manifest['deltas']['1'].pop('file'),
+    lambda manifest: manifest['deltas'].update({'1': 'delta-1-2.gz'}),
+    lambda manifest: manifest['deltas']['1'].update(file='../../state.json'),
+    lambda manifest: manifest.update(file='/etc/passwd'),
+], ids=['delta-without-file', 'delta-not-an-object', 'delta-outside', 'rules-outside'])
+def test_invalid_manifest(published, fetcher, change):
+    publish(published, DOMAINS)
+    pull(published, fetcher)
+    publish(published, DOMAINS[1:])
+    edit_manifest(published, change)
+    with pytest.raises(ValueError):
+        pull(published, fetcher)
+
+def test_pull_command_backs_up_the_output(published, fetcher, monkeypatch, tmp_path):
+    output = tmp_path / 'generated_blacklist'
+    output.write_bytes(b'0.0.0.0 old.example.com\n')
+    config_file = tmp_path / 'config'
+    config_file.write_text('[DEFAULT]\nmode = hosts\nblock_at_psl = False\n' +
+        'dest_ip = False\nsources = []\noutput = %s\n' % output)
+    monkeypatch.setattr(dnsgate, 'CONFIG_FILE', str(config_file))
+    monkeypatch.setattr(dnsgate, 'CACHE_DIRECTORY', str(tmp_path / 'cache'))
+    publish(published, DOMAINS, mode='hosts')
+    result = CliRunner().invoke(dnsgate.dnsgate,
+        ['--no-restart-dnsmasq', '--backup', 'pull', published.url])
+    assert result.exit_code == 0, result.output
+    backups = list(tmp_path.glob('generated_blacklist.bak.*'))
+    assert len(backups) == 1
+    assert backups[0].read_bytes() == b'0.0.0.0 old.example.com\n'
+    assert b'0.0.0.0 ads0.example.com\n' in output.read_bytes()
@@ -0,0 +1,137 @@
+# tab-width:4
+
+# whitelist/blacklist edits patched into saved rules, against recompiling
+# them, and the rule index "dnsgate check" reads
+
+import pytest
+
+from dnsgate import dnsgate
+
+SOURCES = {
+    'http://one.test/hosts': [
+        b'ads.example.com', b'x.ads.example.com', b'cdn.example.com',
+        b'tracker.net', b'a.tracker.net', b'b.c.tracker.net',
+        b'co.uk', # a public suffix, never a rule on its own with block_at_psl
+    ],
+    'http://two.test/hosts': [
+        b'pixel.co.uk', b'img.pixel.co.uk', b'stats.shop.co.uk',
+        b'a.tracker.net', b'metrics.org', b'localhost',
+    ],
+}
+WHITELIST = {b'cdn.example.com'}
+BLACKLIST = {b'evil.org'}
+
+# (id, whitelist added, whitelist removed, blacklist added, blacklist removed)
+EDITS = [
+    ('whitelist-subdomain', {b'x.ads.example.com'}, set(), set(), set()),
+    ('whitelist-psl-domain', {b'tracker.net'}, set(), set(), set()),
+    ('unwhitelist', set(), {b'cdn.example.com'}, set(), set()),
+    ('blacklist-new-domain', set(), set(), {b'new.example.com'}, set()),
+    ('blacklist-parent-of-rules', set(), set(), {b'example.com'}, set()),
+    ('both-lists', {b'a.tracker.net'}, set(), {b'a.tracker.net'}, set()),
+    ('blacklist-tld', set(), set(), {b'uk'}, set()),
+    ('whitelist-public-suffix', {b'co.uk'}, set(), set(), set()),
+    ('unblacklist', set(), set(), set(), {b'evil.org'}),
+]
+
+MODES = [('dnsmasq', False), ('dnsmasq', True), ('hosts', False)]
+
+@pytest.fixture(params=MODES, ids=['dnsmasq', 'dnsmasq-block-at-psl', 'hosts'])
+def config(request, tmp_path, monkeypatch):
+    mode, block_at_psl = request.param
+    if block_at_psl: # keep tldextract's copy of the list out of /etc/dnsgate
+        monkeypatch.setattr(dnsgate, 'TLDEXTRACT_CACHE', str(tmp_path / 'tldextract_cache'))
+        monkeypatch.setattr(dnsgate, 'TLD_EXTRACT', None)
+    return dnsgate.Dnsgate_Config(mode=mode, block_at_psl=block_at_psl,
+        sources=sorted(SOURCES), output=str(tmp_path / 'output'))
+
+def compile_state(config, domains_whitelist, domains_blacklist):
+    '''
+    What compile_rules() returns for SOURCES and the given local lists.
+    '''
+    domains_sources = dict((url, dnsgate.Domain_Store(domains))
+        for url, domains in SOURCES.items())
+    domains_remote = dnsgate.Domain_Store()
+    for store in domains_sources.values():
+        domains_remote = domains_remote | store
+    domains_combined = dnsgate.apply_local_rules(config, domains_remote,
+        domains_whitelist, domains_blacklist, no_psl_cache=True)
+    return dnsgate.Rule_State(domains_remote, domains_whitelist, domains_blacklist,
+        domains_combined, domains_sources=domains_sources)
+
+def edit(domains_whitelist, domains_blacklist, whitelist_added, whitelist_removed,
+        blacklist_added, blacklist_removed):
+    return (domains_whitelist | whitelist_added) - whitelist_removed, \
+        (domains_blacklist | blacklist_added) - blacklist_removed
+
+@pytest.mark.parametrize('changes', [changes[1:] for changes in EDITS],
+    ids=[changes[0] for changes in EDITS])
+def test_patch_matches_full_generate(config, changes):
+    state = compile_state(config, WHITELIST, BLACKLIST)
+    domains_whitelist, domains_blacklist = edit(WHITELIST, BLACKLIST, *changes)
+    patched = dnsgate.patch_local_rules(config, state, domains_whitelist, domains_blacklist)
+    full = compile_state(config, domains_whitelist, domains_blacklist)
+    assert list(patched.domains_combined) == list(full.domains_combined)
+    assert patched.domains_whitelist == domains_whitelist
+    assert patched.domains_blacklist == domains_blacklist
+
+def test_patches_in_a_row_match_full_generate(config):
+    '''
+    watch keeps patching the state the previous edit left.
+    '''
+    state = compile_state(config, WHITELIST, BLACKLIST)
+    domains_whitelist, domains_blacklist = WHITELIST, BLACKLIST
+    for changes in EDITS:
+        domains_whitelist, domains_blacklist = edit(domains_whitelist, domains_blacklist,
+            *changes[1:])
+        state = dnsgate.patch_local_rules(config, state, domains_whitelist, domains_blacklist)
+        full = compile_state(config, domains_whitelist, domains_blacklist)
+        assert list(state.domains_combined) == list(full.domains_combined), changes[0]
+
+def test_public_suffix_is_not_blocked_at_psl(config):
+    rules = compile_state(config, WHITELIST, BLACKLIST).domains_combined
+    if config.block_at_psl:
+        assert b'co.uk' not in rules
+        assert b'pixel.co.uk' in rules
+    else:
+        assert b'co.uk' in rules
+
+def test_saved_state_round_trips(config, tmp_path):
+    state = compile_state(config, WHITELIST, BLACKLIST)
+    path = str(tmp_path / 'rule_state')
+    dnsgate.save_rule_state(config, state, path=path)
+    loaded = dnsgate.load_rule_state(config, path=path)
+    assert list(loaded.domains_combined) == list(state.domains_combined)
+    assert list(loaded.domains_remote) == list(state.domains_remote)
+    assert loaded.domains_whitelist == WHITELIST
+    other = dnsgate.Dnsgate_Config(mode=config.mode, block_at_psl=config.block_at_psl,
+        sources=['http://three.test/hosts'], output=config.output)
+    assert dnsgate.load_rule_state(other, path=path) is None
+
+@pytest.mark.parametrize('changes', [changes[1:] for changes in EDITS],
+    ids=[changes[0] for changes in EDITS])
+def test_rule_index_matches_rules(config, changes, tmp_path):
+    domains_whitelist, domains_blacklist = edit(WHITELIST, BLACKLIST, *changes)
+    state = dnsgate.patch_local_rules(config, compile_state(config, WHITELIST, BLACKLIST),
+        domains_whitelist, domains_blacklist)
+    path = str(tmp_path / 'rule_index')
+    dnsgate.write_rule_index(config, state, path=path)
+    index = dnsgate.Rule_Index(path)
+    covers_subdomains = dnsgate.OUTPUT_WRITERS[config.mode].covers_subdomains
+    names = set(state.domains_remote) | domains_whitelist | domains_blacklist | \
+        {b'www.ads.example.com', b'deep.b.c.tracker.net', b'unlisted.test'}
+    for name in names:
+        if covers_subdomains:
+            expected = state.domains_combined.covering_rule(name)
+        else:
+            expected = name if name in state.domains_combined else None
+        assert index.blocking_rule(name) == expected, name
+        if expected is not None:
+            listed = [source for source, _ in index.listed_by(name, expected)]
+            assert listed, name
+            for source in listed:
+                if source == dnsgate.CUSTOM_BLACKLIST:
+                    assert state.domains_blacklist
+                else:
+                    assert state.domains_sources[source].subtree(expected), (name, source)
+    assert set(index.whitelist) == domains_whitelist
@@ -0,0 +1,322 @@
+# tab-width:4
+
+# dnsgate serve against a stub upstream resolver on 127.0.0.1
+
+import asyncio
+import collections
+import socket
+import struct
+
+import pytest
+
+from dnsgate import dnsgate
+
+STUB_ADDRESS = b'\xc0\x00\x02\x01' # 192.0.2.1
+STUB_TTL = 300
+
+Served = collections.namedtuple('Served',
+    ['proxy', 'udp_protocol', 'udp_address', 'tcp_address'])
+
+def make_opt_record(udp_size=4096, dnssec_ok=False):
+    return b'\x00' + struct.pack('!HHIH', dnsgate.DNS_TYPE_OPT, udp_size,
+        dnsgate.DNS_EDNS_DO if dnssec_ok else 0, 0)
+
+def make_query(name, qtype=dnsgate.DNS_TYPE_A, ident=0x1234, opt=b''):
+    question = b''.join(bytes([len(label)]) + label for label in name.split(b'.'))
+    return struct.pack('!HHHHHH', ident, 0x0100, 1, 0, 0, len(opt) and 1) + question + \
+        b'\x00' + struct.pack('!HH', qtype, 1) + opt
+
+def make_stub_response(query, ttl=STUB_TTL, answers=1, opt=b''):
+    answer = struct.pack('!HHHIH', 0xc00c, dnsgate.DNS_TYPE_A, 1, ttl, 4) + STUB_ADDRESS
+    response = dnsgate.make_dns_response(query, dnsgate.DNS_RCODE_NOERROR,
+        answer * answers, ancount=answers)
+    return response[:10] + struct.pack('!H', len(opt) and 1) + response[12:] + opt
+
+def response_counts(response):
+    '''
+    Returns (flags, ancount, nscount, arcount).
+    '''
+    return struct.unpack('!HxxHHH', response[2:12])
+
+def response_rcode(response):
+    return struct.unpack('!H', response[2:4])[0] & 0x000f
+
+def response_answer(response):
+    '''
+    Returns (ttl, rdata) of the first answer of a response to make_query().
+    '''
+    offset = dnsgate.read_dns_name(response, 12)[1] + 4
+    offset = dnsgate.read_dns_name(response, offset)[1]
+    ttl, rdlength = struct.unpack('!IH', response[offset + 4:offset + 10])
+    return ttl, response[offset + 10:offset + 10 + rdlength]
+
+class Stub_Upstream(dnsgate.Datagram_Protocol):
+    '''
+    Answers every query with STUB_ADDRESS and remembers the names asked.
+    '''
+    def __init__(self):
+        self.transport = None
+        self.names = []
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        query = dnsgate.parse_dns_query(data)
+        self.names.append(query.name)
+        self.transport.sendto(make_stub_response(query), addr)
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    yield loop
+    loop.run_until_complete(asyncio.sleep(0)) # closed transports release their sockets
+    loop.close()
+    asyncio.set_event_loop(None)
+
+@pytest.fixture
+def upstream(loop):
+    transport, protocol = loop.run_until_complete(loop.create_datagram_endpoint(
+        Stub_Upstream, local_addr=('127.0.0.1', 0)))
+    yield protocol
+    transport.close()
+
+@pytest.fixture
+def serve(loop, upstream):
+    '''
+    Returns a function that starts a Dns_Proxy forwarding to upstream on
+    ephemeral ports and returns it as a Served.
+    '''
+    servers = []
+
+    def start(dest_ip=None, matcher=None):
+        if matcher is None:
+            matcher = dnsgate.Suffix_Matcher([b'ads.example', b'tracker.test'],
+                [b'ok.ads.example'])
+        proxy = dnsgate.Dns_Proxy(matcher, upstream.transport.get_extra_info('sockname'),
+            dest_ip=dest_ip, timeout=1.0)
+        udp_transport, tcp_server = loop.run_until_complete(
+            dnsgate.start_dns_proxy(proxy, '127.0.0.1', 0))
+        servers.append((udp_transport, tcp_server))
+        return Served(proxy, udp_transport.get_protocol(),
+            udp_transport.get_extra_info('sockname'), tcp_server.sockets[0].getsockname())
+
+    yield start
+    loop.run_until_complete(asyncio.sleep(0.05)) # tcp handlers see the client hang up
+    for udp_transport, tcp_server in servers:
+        udp_transport.close()
+        tcp_server.close()
+        loop.run_until_complete(tcp_server.wait_closed())
+
+def ask(loop, address, message, timeout=1.0):
+    return loop.run_until_complete(dnsgate.forward_dns_udp(message, address, timeout))
+
+def test_blocked_name_gets_nxdomain(loop, upstream, serve):
+    served = serve()
+    for name in (b'ads.example', b'www.ads.example', b'a.b.tracker.test'):
+        response = ask(loop, served.udp_address, make_query(name))
+        assert response_rcode(response) == dnsgate.DNS_RCODE_NXDOMAIN
+    assert served.proxy.blocked == 3
+    assert upstream.names == []
+
+def test_blocked_name_gets_dest_ip(loop, upstream, serve):
+    address = serve(dest_ip='10.0.0.1').udp_address
+    response = ask(loop, address, make_query(b'www.ads.example'))
+    assert response_rcode(response) == dnsgate.DNS_RCODE_NOERROR
+    assert response_answer(response) == (dnsgate.PROXY_BLOCKED_TTL,
+        socket.inet_aton('10.0.0.1'))
+    # other types get an empty answer rather than an address of the wrong family
+    response = ask(loop, address, make_query(b'www.ads.example', qtype=dnsgate.DNS_TYPE_AAAA))
+    assert response_rcode(response) == dnsgate.DNS_RCODE_NOERROR
+    assert struct.unpack('!H', response[6:8])[0] == 0
+    assert upstream.names == []
+
+def test_blocked_name_over_tcp(loop, serve):
+    response = loop.run_until_complete(dnsgate.forward_dns_tcp(
+        make_query(b'ads.example'), serve().tcp_address, 1.0))
+    assert response_rcode(response) == dnsgate.DNS_RCODE_NXDOMAIN
+
+def test_stalled_tcp_client_is_dropped(loop, serve):
+    served = serve()
+    served.proxy.timeout = 0.01
+    async def stall():
+        reader, writer = await asyncio.open_connection(*served.tcp_address)
+        writer.write(b'\x00\x20' + make_query(b'ads.example')[:5]) # then nothing
+        try:
+            return await asyncio.wait_for(reader.read(), 1.0)
+        finally:
+            writer.close()
+    assert loop.run_until_complete(stall()) == b'' # closed by the proxy
+
+def test_whitelisted_subdomain_is_forwarded(loop, upstream, serve):
+    response = ask(loop, serve().udp_address, make_query(b'mail.ok.ads.example'))
+    assert response_answer(response) == (STUB_TTL, STUB_ADDRESS)
+    assert upstream.names == [b'mail.ok.ads.example']
+
+def test_forwarded_response_is_cached(loop, upstream, serve):
+    served = serve()
+    first = ask(loop, served.udp_address, make_query(b'example.com', ident=1))
+    second = ask(loop, served.udp_address, make_query(b'EXAMPLE.com', ident=2))
+    assert upstream.names == [b'example.com']
+    assert (served.proxy.forwarded, served.proxy.cache.hits) == (1, 1)
+    assert first[:2] == b'\x00\x01' and second[:2] == b'\x00\x02'
+    ttl, rdata = response_answer(second)
+    assert rdata == STUB_ADDRESS and 0 < ttl <= STUB_TTL
+
+def test_cached_response_expires_with_its_ttl():
+    query = dnsgate.parse_dns_query(make_query(b'example.com'))
+    cache = dnsgate.Dns_Cache()
+    cache.put(query, make_stub_response(query, ttl=60), now=1000)
+    response = cache.get(query, now=1059.5)
+    assert response_answer(response) == (1, STUB_ADDRESS) # the TTL left is patched in
+    assert cache.get(query, now=1060) is None
+    assert len(cache) == 0
+
+def test_cache_ttl_is_capped_and_negative_answers_expire():
+    query = dnsgate.parse_dns_query(make_query(b'example.com'))
+    cache = dnsgate.Dns_Cache(max_ttl=10)
+    cache.put(query, make_stub_response(query), now=0)
+    assert cache.get(query, now=9) is not None
+    assert cache.get(query, now=10) is None
+    cache = dnsgate.Dns_Cache()
+    cache.put(query, dnsgate.make_dns_response(query, dnsgate.DNS_RCODE_NXDOMAIN), now=0)
+    assert cache.get(query, now=dnsgate.PROXY_NEGATIVE_TTL - 1) is not None
+    assert cache.get(query, now=dnsgate.PROXY_NEGATIVE_TTL) is None
+
+def test_cache_is_bounded():
+    cache = dnsgate.Dns_Cache(max_entries=2)
+    queries = [dnsgate.parse_dns_query(make_query(name)) for name in (b'a.com', b'b.com', b'c.com')]
+    for query in queries:
+        cache.put(query, make_stub_response(query), now=0)
+    assert len(cache) == 2
+    assert cache.get(queries[0], now=1) is None
+
+def test_large_tcp_answer_is_truncated_for_udp_clients(loop, serve, monkeypatch):
+    async def forward_dns_tcp(message, upstream, timeout):
+        return make_stub_response(dnsgate.parse_dns_query(message), answers=40)
+    monkeypatch.setattr(dnsgate, 'forward_dns_tcp', forward_dns_tcp)
+    proxy = serve().proxy
+    response = loop.run_until_complete(proxy.resolve(make_query(b'big.example.com'), tcp=True))
+    assert len(response) > dnsgate.DNS_UDP_SIZE
+    assert len(loop.run_until_complete(proxy.resolve(make_query(b'big.example.com'),
+        tcp=True))) == len(response) # a hit, with the TTL left patched in
+    response = loop.run_until_complete(proxy.resolve(make_query(b'big.example.com')))
+    flags, ancount, nscount, arcount = response_counts(response)
+    assert flags & dnsgate.DNS_FLAG_TC and (ancount, nscount, arcount) == (0, 0, 0)
+    assert len(response) <= dnsgate.DNS_UDP_SIZE
+    response = loop.run_until_complete(proxy.resolve(make_query(b'big.example.com',
+        opt=make_opt_record(udp_size=4096)))) # fits the size this client advertised
+    flags, ancount, nscount, arcount = response_counts(response)
+    assert not flags & dnsgate.DNS_FLAG_TC and (ancount, arcount) == (40, 1)
+    assert (proxy.forwarded, proxy.cache.hits) == (1, 3)
+
+def test_opt_record_is_not_replayed_to_other_clients():
+    cache = dnsgate.Dns_Cache()
+    edns_query = dnsgate.parse_dns_query(make_query(b'example.com',
+        opt=make_opt_record(udp_size=4096)))
+    assert edns_query.udp_size == 4096 and not edns_query.dnssec_ok
+    cache.put(edns_query, make_stub_response(edns_query, opt=make_opt_record(udp_size=1400)),
+        now=0)
+    query = dnsgate.parse_dns_query(make_query(b'example.com'))
+    response = cache.get(query, now=1)
+    assert response_counts(response)[1:] == (1, 0, 0)
+    assert response_answer(response) == (STUB_TTL - 1, STUB_ADDRESS)
+    assert response.endswith(STUB_ADDRESS) # no OPT record after the answer
+    response = cache.get(edns_query, now=1)
+    assert response_counts(response)[1:] == (1, 0, 1)
+    assert response.endswith(b'\x00' + struct.pack('!HHIH', dnsgate.DNS_TYPE_OPT,
+        dnsgate.PROXY_EDNS_SIZE, 0, 0))
+    dnssec_query = dnsgate.parse_dns_query(make_query(b'example.com',
+        opt=make_opt_record(dnssec_ok=True)))
+    assert cache.get(dnssec_query, now=1) is None # answers with DO set carry RRSIGs
+
+def test_malformed_responses_are_not_cached():
+    query = dnsgate.parse_dns_query(make_query(b'example.com'))
+    cache = dnsgate.Dns_Cache()
+    cache.put(query, make_stub_response(query)[:-3], now=0)
+    assert len(cache) == 0
+
+@pytest.mark.parametrize('message', [
+    b'\x12\x34\x01',                                    # short header
+    b'\x12\x34\x81\x00\x00\x01\x00\x00\x00\x00\x00\x00', # a response, not a query
+])
+def test_malformed_packets_are_dropped(loop, upstream, serve, message):
+    address = serve().udp_address
+    with pytest.raises(asyncio.TimeoutError):
+        ask(loop, address, message, timeout=0.2)
+    assert response_rcode(ask(loop, address, make_query(b'ads.example'))) == \
+        dnsgate.DNS_RCODE_NXDOMAIN # still serving
+    assert upstream.names == []
+
+@pytest.mark.parametrize('message', [
+    make_query(b'example.com')[:-2],                     # truncated question
+    make_query(b'example.com')[:12] + b'\x40example\x00', # reserved label type
+    make_query(b'example.com')[:12] + b'\xc0\x0c',        # compression loop
+])
+def test_malformed_queries_get_formerr(loop, upstream, serve, message):
+    response = ask(loop, serve().udp_address, message)
+    assert response[:2] == message[:2]
+    assert response_rcode(response) == dnsgate.DNS_RCODE_FORMERR
+    assert upstream.names == []
+
+def test_answer_tasks_are_kept_until_done(loop, serve):
+    served = serve()
+    served.udp_protocol.datagram_received(make_query(b'ads.example'), ('127.0.0.1', 9))
+    assert len(served.udp_protocol.tasks) == 1
+    loop.run_until_complete(asyncio.sleep(0.01)) # answered, then the done callback ran
+    assert served.udp_protocol.tasks == set()
+    assert served.proxy.blocked == 1
+
+@pytest.fixture
+def local_rules(monkeypatch):
+    monkeypatch.setattr(dnsgate, 'fetch_remote_rules', lambda config, **kwargs:
+        (dnsgate.Domain_Store([b'ads.mail.example.com', b'tracker.test']), {}))
+    monkeypatch.setattr(dnsgate, 'read_local_whitelist', lambda config: {b'mail.example.com'})
+    monkeypatch.setattr(dnsgate, 'read_local_blacklist',
+        lambda: {b'example.com', b'tracker.mail.example.com'})
+
+@pytest.mark.parametrize('mode', ['dnsmasq', 'rpz', 'unbound'])
+def test_blocked_name_under_a_whitelisted_subdomain_of_a_blocked_domain(loop, upstream,
+        serve, local_rules, mode):
+    '''
+    The output drops rules under example.com, serve needs them since
+    mail.example.com is whitelisted.
+    '''
+    config = dnsgate.Dnsgate_Config(mode=mode, sources=['http://one.test/hosts'])
+    address = serve(matcher=dnsgate.make_suffix_matcher(config)).udp_address
+    for name in (b'example.com', b'www.example.com', b'ads.mail.example.com',
+            b'tracker.mail.example.com', b'x.tracker.mail.example.com'):
+        response = ask(loop, address, make_query(name))
+        assert response_rcode(response) == dnsgate.DNS_RCODE_NXDOMAIN, name
+    response = ask(loop, address, make_query(b'www.mail.example.com'))
+    assert response_answer(response) == (STUB_TTL, STUB_ADDRESS)
+    assert upstream.names == [b'www.mail.example.com']
+
+def test_hosts_mode_blocks_only_the_listed_names(loop, upstream, serve, local_rules):
+    '''
+    Like the /etc/hosts generate writes from the same configuration.
+    '''
+    config = dnsgate.Dnsgate_Config(mode='hosts', sources=['http://one.test/hosts'])
+    address = serve(matcher=dnsgate.make_suffix_matcher(config)).udp_address
+    for name in (b'example.com', b'ads.mail.example.com', b'tracker.mail.example.com'):
+        response = ask(loop, address, make_query(name))
+        assert response_rcode(response) == dnsgate.DNS_RCODE_NXDOMAIN, name
+    for name in (b'www.example.com', b'x.tracker.mail.example.com'):
+        response = ask(loop, address, make_query(name))
+        assert response_answer(response) == (STUB_TTL, STUB_ADDRESS), name
+    assert upstream.names == [b'www.example.com', b'x.tracker.mail.example.com']
+
+@pytest.mark.parametrize('dest_ip, rule', [
+    ('False', b'0.0.0.0 ads.example.com\n'),
+    ('10.0.0.1', b'10.0.0.1 ads.example.com\n'),
+], ids=['default', 'configured'])
+def test_hosts_mode_keeps_a_configured_dest_ip(tmp_path, monkeypatch, dest_ip, rule):
+    config_file = tmp_path / 'config'
+    config_file.write_text('[DEFAULT]\nmode = hosts\nblock_at_psl = False\n' +
+        'dest_ip = %s\nsources = []\noutput = %s\n' % (dest_ip, tmp_path / 'output'))
+    monkeypatch.setattr(dnsgate, 'CONFIG_FILE', str(config_file))
+    monkeypatch.setattr(dnsgate, 'CACHE_DIRECTORY', str(tmp_path / 'cache'))
+    config = dnsgate.read_config_file()
+    assert config.dest_ip == (None if dest_ip == 'False' else dest_ip) # what serve answers
+    assert dnsgate.get_output_writer(config).rule(b'ads.example.com') == rule
@@ -0,0 +1,56 @@
+# tab-width:4
+
+# Source_Cache index writes
+
+import hashlib
+import json
+
+from dnsgate import dnsgate
+
+URL = 'http://one.test/hosts'
+BODY = b'0.0.0.0 ads.example.com\n0.0.0.0 tracker.net\n'
+
+def make_cache(tmp_path):
+    cache = dnsgate.Source_Cache(str(tmp_path / 'sources'))
+    writer = cache.writer(URL)
+    writer.write(BODY)
+    cache.store(URL, writer, {'ETag': '"1"'}, len(BODY), hashlib.sha1(BODY).hexdigest())
+    cache.store_parsed(URL, hashlib.sha1(BODY).hexdigest(), {b'ads.example.com', b'tracker.net'})
+    return cache
+
+def read_entry(cache):
+    with open(cache.index_path) as fh:
+        return json.load(fh)['entries'][URL]
+
+def test_reads_do_not_rewrite_the_index(tmp_path, monkeypatch):
+    cache = make_cache(tmp_path)
+    stored_used = read_entry(cache)['used']
+    writes = []
+    write_file_bytes_atomic = dnsgate.write_file_bytes_atomic
+    monkeypatch.setattr(dnsgate, 'write_file_bytes_atomic',
+        lambda path, data: writes.append(path) or write_file_bytes_atomic(path, data))
+    monkeypatch.setattr(dnsgate.time, 'time', lambda: stored_used + 60)
+    for _ in range(3):
+        assert cache.read_parsed(URL) == {b'ads.example.com', b'tracker.net'}
+        parser = dnsgate.Hosts_Stream_Parser()
+        assert cache.read_body(URL, parser)
+        assert parser.close() == {b'ads.example.com', b'tracker.net'}
+    assert writes == []
+    assert read_entry(cache)['used'] == stored_used
+
+    cache.evict() # the end of every fetch_sources() run
+    assert writes == [cache.index_path]
+    assert read_entry(cache)['used'] == stored_used + 60
+
+def test_pending_reads_decide_what_is_evicted(tmp_path, monkeypatch):
+    cache = make_cache(tmp_path)
+    other_url = 'http://two.test/hosts'
+    writer = cache.writer(other_url)
+    writer.write(BODY)
+    cache.store(other_url, writer, {}, len(BODY), hashlib.sha1(BODY).hexdigest())
+    stored_used = read_entry(cache)['used']
+    monkeypatch.setattr(dnsgate.time, 'time', lambda: stored_used + 60)
+    cache.read_parsed(URL) # URL was stored first, only this read keeps it
+    cache.evict(max_bytes=cache.entry(URL)['stored_size'])
+    assert cache.entry(URL) is not None
+    assert cache.entry(other_url) is None
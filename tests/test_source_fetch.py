@@ -0,0 +1,208 @@
+# tab-width:4
+
+# fetching a source from a local http.server and what it does to the cache
+
+import gzip
+import http.server
+import io
+import lzma
+import os
+import threading
+import zipfile
+
+import pytest
+
+from dnsgate import dnsgate
+
+BODY = b'0.0.0.0 ads.example.com\n0.0.0.0 tracker.net\n'
+DOMAINS = {b'ads.example.com', b'tracker.net'}
+ETAG = '"1"'
+COMPRESSORS = {'.gz': gzip.compress, '.xz': lzma.compress,
+    '.zip': lambda data: make_zip(data)}
+
+class Source_Handler(http.server.BaseHTTPRequestHandler):
+    '''
+    Answers with whatever self.server.respond(request headers) returns, a
+    (status, body) tuple, and records the requests.
+    '''
+    def do_GET(self):
+        self.server.requests.append(dict(self.headers))
+        status, body = self.server.respond(self.headers)
+        self.send_response(status)
+        self.send_header('ETag', ETAG)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def server():
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Source_Handler)
+    server.requests = []
+    server.respond = lambda headers: (200, BODY)
+    server.url = 'http://127.0.0.1:%d/hosts' % server.server_address[1]
+    thread = threading.Thread(target=server.serve_forever, args=(0.01,), daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture
+def fetcher(monkeypatch, tmp_path):
+    monkeypatch.setattr(dnsgate, 'SOURCE_CACHE', dnsgate.Source_Cache(str(tmp_path / 'sources')))
+    fetcher = dnsgate.Source_Fetcher(retries=0, timeout=5)
+    yield fetcher
+    fetcher.close()
+
+def fetch(server, fetcher):
+    return dnsgate.extract_domain_set_from_hosts_format_url_or_cached_copy(server.url,
+        fetcher, cache_expire=0)
+
+def test_fetch_is_cached(server, fetcher):
+    assert fetch(server, fetcher) == DOMAINS
+    assert dnsgate.SOURCE_CACHE.entry(server.url)['etag'] == ETAG
+    assert dnsgate.read_cached_domains(server.url, no_cache=True) == DOMAINS
+
+@pytest.mark.parametrize('status', [404, 410, 500, 503])
+def test_error_status_falls_back_to_the_cached_copy(server, fetcher, status):
+    assert fetch(server, fetcher) == DOMAINS
+    entry = dnsgate.SOURCE_CACHE.entry(server.url)
+    server.respond = lambda headers: (status, b'0.0.0.0 error.page.example\n')
+    assert fetch(server, fetcher) == DOMAINS
+    assert dnsgate.SOURCE_CACHE.entry(server.url)['content_sha1'] == entry['content_sha1']
+    assert dnsgate.read_cached_domains(server.url, no_cache=True) == DOMAINS
+
+def test_error_status_without_a_cached_copy_fails(server, fetcher):
+    server.respond = lambda headers: (404, b'0.0.0.0 error.page.example\n')
+    assert fetch(server, fetcher) is False
+    assert dnsgate.SOURCE_CACHE.entry(server.url) is None
+
+def test_empty_response_keeps_the_cached_copy(server, fetcher):
+    assert fetch(server, fetcher) == DOMAINS
+    server.respond = lambda headers: (200, b'<html>maintenance</html>\n')
+    assert fetch(server, fetcher) == DOMAINS
+    assert dnsgate.read_cached_domains(server.url, no_cache=True) == DOMAINS
+
+def test_empty_response_without_a_cached_copy(server, fetcher):
+    server.respond = lambda headers: (200, b'')
+    assert fetch(server, fetcher) == set()
+
+def test_not_modified_with_the_body_gone_refetches(server, fetcher):
+    assert fetch(server, fetcher) == DOMAINS
+    entry = dnsgate.SOURCE_CACHE.entry(server.url)
+    for suffix in ('.gz', '.parsed.gz'):
+        os.remove(dnsgate.SOURCE_CACHE.file_path(entry, suffix))
+    server.respond = lambda headers: (304, b'') if headers.get('If-None-Match') == ETAG \
+        else (200, BODY)
+    assert fetch(server, fetcher) == DOMAINS
+    assert server.requests[1].get('If-None-Match') == ETAG
+    assert 'If-None-Match' not in server.requests[2]
+    assert len(server.requests) == 3
+    assert dnsgate.read_cached_domains(server.url, no_cache=True) == DOMAINS
+
+def test_not_modified_uses_the_cached_copy(server, fetcher):
+    assert fetch(server, fetcher) == DOMAINS
+    server.respond = lambda headers: (304, b'')
+    assert fetch(server, fetcher) == DOMAINS
+    assert len(server.requests) == 2
+
+def make_zip(data, compression=zipfile.ZIP_DEFLATED):
+    body = io.BytesIO()
+    with zipfile.ZipFile(body, 'w', compression) as archive:
+        archive.writestr('hosts', data)
+    return body.getvalue()
+
+@pytest.mark.parametrize('suffix', sorted(COMPRESSORS))
+def test_compressed_source(server, fetcher, suffix):
+    server.respond = lambda headers: (200, COMPRESSORS[suffix](BODY))
+    server.url += suffix
+    assert fetch(server, fetcher) == DOMAINS
+    assert dnsgate.read_cached_domains(server.url, no_cache=True) == DOMAINS
+
+@pytest.mark.parametrize('suffix', ['.gz', '.xz'])
+def test_compression_bomb_is_cut_off(suffix):
+    max_size = 256 * 1024
+    bomb = COMPRESSORS[suffix](b'\n' * (64 * max_size))
+    decompressor = dnsgate.make_source_decompressor('http://one.test/hosts' + suffix, max_size)
+    chunks = []
+    with pytest.raises(dnsgate.Source_Too_Large):
+        for chunk in decompressor.decompress(bomb):
+            chunks.append(len(chunk))
+    assert max(chunks) <= dnsgate.DOWNLOAD_CHUNK_SIZE
+    assert sum(chunks) <= max_size
+
+def test_oversized_zip_is_not_buffered():
+    max_size = 1000
+    body = make_zip(os.urandom(200000), zipfile.ZIP_STORED)
+    decompressor = dnsgate.make_source_decompressor('http://one.test/hosts.zip', max_size)
+    with pytest.raises(dnsgate.Source_Too_Large):
+        for start in range(0, len(body), 100):
+            decompressor.decompress(body[start:start + 100])
+    assert decompressor.compressed_size <= max_size + 100
+    assert sum(len(chunk) for chunk in decompressor.chunks) <= max_size
+
+@pytest.mark.parametrize('suffix', sorted(COMPRESSORS))
+def test_oversized_source_is_not_cached(server, fetcher, suffix):
+    server.respond = lambda headers: (200, COMPRESSORS[suffix](BODY * 1000))
+    server.url += suffix
+    assert dnsgate.extract_domain_set_from_hosts_format_url_or_cached_copy(server.url,
+        fetcher, cache_expire=0, max_size=len(BODY) * 10) is False
+    assert dnsgate.SOURCE_CACHE.entry(server.url) is None
+
+def test_parse_and_validate_are_timed_apart(server, fetcher):
+    for read in (lambda: fetch(server, fetcher), # while it downloads
+            lambda: dnsgate.read_cached_domains(server.url, no_cache=True)):
+        dnsgate.METRICS.reset()
+        assert read() == DOMAINS
+        metrics = dnsgate.METRICS.sources[server.url]
+        assert metrics['parse_seconds'] > 0 and metrics['validate_seconds'] > 0
+
+@pytest.mark.parametrize('inline', [False, True])
+def test_inline_fetches_run_in_the_calling_thread(monkeypatch, fetcher, inline):
+    threads = []
+
+    def fetch_source(url, *args, **kwargs):
+        threads.append(threading.current_thread())
+        return {url.encode('ascii')}
+
+    monkeypatch.setattr(dnsgate, 'extract_domain_set_from_hosts_format_url_or_cached_copy',
+        fetch_source)
+    urls = ['http://one.test/hosts', 'http://two.test/hosts']
+    results = dnsgate.fetch_sources(urls, no_cache=True, fetcher=fetcher, inline=inline)
+    assert results == {url: {url.encode('ascii')} for url in urls}
+    assert (threads == [threading.current_thread()] * 2) == inline
+
+def test_revalidation_after_the_caller_closed_its_fetcher(server, fetcher, monkeypatch):
+    '''
+    generate closes its fetcher as soon as fetch_sources() returns, the
+    background re-fetch of a stale source runs after that.
+    '''
+    assert fetch(server, fetcher) == DOMAINS
+    new_body = BODY + b'0.0.0.0 new.example.org\n'
+    server.respond = lambda headers: (200, new_body)
+    closed = threading.Event()
+    get = dnsgate.Source_Fetcher.get
+
+    def get_once_closed(self, *args, **kwargs):
+        assert closed.wait(5)
+        return get(self, *args, **kwargs)
+
+    monkeypatch.setattr(dnsgate.Source_Fetcher, 'get', get_once_closed)
+    exit_hooks = []
+    monkeypatch.setattr(dnsgate.atexit, 'register',
+        lambda function, *args: exit_hooks.append((function, args)))
+    results = dnsgate.fetch_sources([server.url], cache_expire=0, fetcher=fetcher,
+        stale_while_revalidate=True, deadline=5)
+    assert results == {server.url: DOMAINS}
+    fetcher.close()
+    closed.set()
+
+    [(function, args)] = exit_hooks
+    function(*args)
+    revalidations, _, revalidation_fetcher = args
+    assert [future.exception() for future in revalidations] == [None]
+    assert dnsgate.read_cached_domains(server.url, no_cache=True) == DOMAINS | {b'new.example.org'}
+    assert fetcher.session is None # not re-opened behind the caller's back
+    assert revalidation_fetcher is not fetcher and revalidation_fetcher.session is None
@@ -0,0 +1,36 @@
+# tab-width:4
+
+# commands that need neither the network nor the PSL must not pay for
+# importing what only the others use, see "dev/benchmark --startup"
+
+import os
+import subprocess
+import sys
+
+import pytest
+
+from dnsgate import dnsgate
+
+REPO_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+COMMANDS = [
+    'import dnsgate.dnsgate',
+    'from dnsgate.dnsgate import dnsgate; dnsgate(["--help"])',
+    'from dnsgate.dnsgate import dnsgate; dnsgate(["check", "--help"])',
+    'from dnsgate.dnsgate import dnsgate; dnsgate(["install-help", "--help"])',
+]
+
+def imported_modules(code):
+    '''
+    Returns the top level modules imported by running code in a fresh
+    interpreter.
+    '''
+    script = 'try:\n    %s\nexcept SystemExit:\n    pass\n' \
+        'import sys\nprint(" ".join(sys.modules))' % code
+    output = subprocess.check_output([sys.executable, '-c', script], cwd=REPO_DIRECTORY)
+    return set(module.split('.')[0] for module in output.decode('ascii').split())
+
+@pytest.mark.parametrize('code', COMMANDS)
+def test_deferred_modules_are_not_imported_at_startup(code):
+    # site-packages .pth files may import some of them before dnsgate runs
+    imported = imported_modules(code) - imported_modules('pass')
+    assert imported & set(dnsgate.DEFERRED_MODULES) == set()
@@ -0,0 +1,16 @@
+# tab-width:4
+
+# validating the domains parsed from sources and the local lists
+
+from dnsgate import dnsgate
+
+def test_each_domain_is_normalized_once(monkeypatch):
+    domains = set(b'host%d.example.com' % number for number in range(1000)) | \
+        {b'0.0.0.0', b'bad_name!.com'}
+    normalized = []
+    normalize_domain = dnsgate.normalize_domain
+    monkeypatch.setattr(dnsgate, 'normalize_domain',
+        lambda domain: normalized.append(domain) or normalize_domain(domain))
+    valid = dnsgate.validate_domain_list(domains, invalid_level=dnsgate.LOG['INFO'])
+    assert len(normalized) == len(domains)
+    assert valid == domains - {b'0.0.0.0', b'bad_name!.com'}